@@ -1,8 +1,17 @@
 #!/usr/bin/env python
 """Copyright 2014 Tom Nicholls
 
-Process a directory of Web ARChive files through the warctika library to
-reduce binary document formats to plain text 'conversion' records.
+Produce an inventory of the contents of a list of Web ARChive files: one row
+per record (file, offset, type, URL, underlying Content-Type, length,
+payload digest) plus
+aggregate histograms of record types, MIME types, byte totals and how many
+records (and bytes) would be sent to Tika, for sizing Tika capacity for a
+crawl.
+
+Only the WARC headers of each record are parsed, plus (with --http) the HTTP
+header block of response and revisit records to find the underlying
+Content-Type.
+Payloads are skipped by Content-Length without being materialised.
 
 This work is available under the terms of the GNU General Purpose Licence
 This program is free software: you can redistribute it and/or modify
@@ -26,29 +35,154 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>
 from __future__ import print_function
 
 import sys
-import os
-import warctika
-import re
+import argparse
+import traceback
+from collections import defaultdict
+from functools import partial
+from multiprocessing import Pool
+from hanzo.warctools import WarcRecord
+from warcresponseparse import read_http_header_block, parse_http_header_block
+from warc2mongodb import check_mimetype
 
 def warning(*objs):
     print("WARNING: ", *objs, file=sys.stderr)
 
+def underlying_mimetype(record, http):
+    """Return the Content-Type of the document in a record: for HTTP
+    responses and revisits (if http is True) the HTTP Content-Type,
+    otherwise the record's own Content-Type header."""
+    if (http and record.type in (WarcRecord.RESPONSE, WarcRecord.REVISIT)
+            and (record.url or '').startswith('http')):
+        block = read_http_header_block(record)
+        if block is None:
+            return None
+        _, headers = parse_http_header_block(block)
+        for k, v in headers:
+            if k.lower() == 'content-type':
+                return v.split(';')[0].strip().lower()
+        return None
+    ctype = record.get_header(WarcRecord.CONTENT_TYPE)
+    if ctype:
+        return ctype.split(';')[0].strip().lower()
+    return None
 
-if len(sys.argv) < 2:
-    sys.exit("Must give name of file to list contents of.")
-
-print("Type, URL, Underlying Content-Type, Payload length")
-wf = warctika.WARCFile(sys.argv[1], 'rb')
-for record in wf:
-    rtype = record.type
-    try:
-        rurl = record.url
-    except Exception:
-        rurl = None
+def inventory(infn, http=False, rows=True):
+    """Inventory one WARC file. Returns (rows, stats), where rows is a
+    list of (file, offset, type, url, mimetype, length, digest) tuples
+    (empty if rows is False) and stats a dict of histograms."""
+    out = []
+    stats = {'types': defaultdict(int), 'typebytes': defaultdict(int),
+             'mimes': defaultdict(int), 'mimebytes': defaultdict(int),
+             'tika': defaultdict(int), 'tikabytes': defaultdict(int),
+             'errors': 0}
+    inwf = WarcRecord.open_archive(infn, mode='rb')
     try:
-        rmime = record.get_underlying_mimetype()
+        for offset, record, errors in inwf.read_records(limit=None):
+            if errors:
+                warning("warc errors at %s:%s" % (infn, offset), errors)
+                stats['errors'] += 1
+                break
+            if record is None:
+                break
+            rtype = record.type
+            length = int(record.get_header(WarcRecord.CONTENT_LENGTH) or 0)
+            try:
+                mime = underlying_mimetype(record, http)
+            except Exception:
+                mime = None
+            stats['types'][rtype] += 1
+            stats['typebytes'][rtype] += length
+            if rtype in (WarcRecord.RESPONSE, WarcRecord.RESOURCE,
+                         WarcRecord.CONVERSION):
+                stats['mimes'][mime] += 1
+                stats['mimebytes'][mime] += length
+                tikamime = (rtype != WarcRecord.CONVERSION
+                            and check_mimetype(mime))
+                if tikamime:
+                    stats['tika'][tikamime] += 1
+                    stats['tikabytes'][tikamime] += length
+            if rows:
+                digest = record.get_header(WarcRecord.PAYLOAD_DIGEST)
+                out.append((infn, offset, rtype, record.url, mime, length,
+                            digest))
     except Exception:
-        rmime = None
-    rlen = len(record.payload)
-    print(rtype, rurl, rmime, rlen, sep=", ")
-wf.close()
+        warning("failed reading", infn)
+        traceback.print_exc()
+        stats['errors'] += 1
+    finally:
+        inwf.close()
+    return out, stats
+
+def merge_stats(total, stats):
+    for k, v in stats.items():
+        if k == 'errors':
+            total[k] = total.get(k, 0) + v
+            continue
+        hist = total.setdefault(k, defaultdict(int))
+        for item, n in v.items():
+            hist[item] += n
+
+def print_histogram(title, counts, nbytes, stream):
+    print("\n%s:" % title, file=stream)
+    for item, n in sorted(counts.items(), key=lambda x: -x[1]):
+        print("  %-60s %10d %16d" % (item, n, nbytes.get(item, 0)),
+              file=stream)
+    print("  %-60s %10d %16d" % ('TOTAL', sum(counts.values()),
+                                 sum(nbytes.values())), file=stream)
+
+#####
+#ARGUMENT PARSER
+#####
+
+parser = argparse.ArgumentParser(description='Inventory the records in '
+           'WARC files, reading only headers.')
+parser.add_argument('files', metavar='warc', nargs='*',
+                    help='WARC files to inventory. Default: read a list of '
+                         'filenames from stdin.')
+parser.add_argument('--http', action='store_true',
+                    help='Also read the HTTP header block of response '
+                         'records, to report the underlying Content-Type.')
+parser.add_argument('-q', '--summary-only', action='store_true',
+                    help="Don't print a row per record.")
+parser.add_argument('-j', '--processes', type=int, default=None,
+                    help='Number of worker processes. Default: one per CPU.')
+parser.add_argument('--cost-file', metavar='costfn',
+                    help='Write a filename<TAB>Tika-eligible bytes table, '
+                         'for ukwebdata2mongodb.py --order cost. Needs '
+                         '--http to see the types of HTTP responses.')
+
+#####
+#MAIN
+#####
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    files = args.files or [l.rstrip() for l in sys.stdin if l.strip()]
+    job = partial(inventory, http=args.http, rows=not args.summary_only)
+    total = {}
+    costs = []
+    if not args.summary_only:
+        print("File\tOffset\tType\tURL\tUnderlying Content-Type\tLength\t"
+              "Payload Digest")
+    p = Pool(args.processes)
+    for infn, (rows, stats) in zip(files, p.imap(job, files, 1)):
+        for row in rows:
+            print(*row, sep="\t")
+        merge_stats(total, stats)
+        costs.append((infn, sum(stats['tikabytes'].values())))
+    p.close()
+    p.join()
+
+    print_histogram("Record types (count, bytes)", total.get('types', {}),
+                    total.get('typebytes', {}), sys.stderr)
+    print_histogram("Content-Types (count, bytes)", total.get('mimes', {}),
+                    total.get('mimebytes', {}), sys.stderr)
+    print_histogram("Tika-eligible by canonical type (count, bytes)",
+                    total.get('tika', {}), total.get('tikabytes', {}),
+                    sys.stderr)
+    if total.get('errors'):
+        print("\n%d files had read errors." % total['errors'], file=sys.stderr)
+    if args.cost_file:
+        with open(args.cost_file, 'w') as f:
+            for infn, cost in costs:
+                f.write("%s\t%d\n" % (infn, cost))
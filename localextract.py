@@ -0,0 +1,326 @@
+#!/usr/bin/env python2
+"""In-process plain text extraction for document formats simple enough not
+to need Apache Tika.
+
+Office Open XML (.docx, .xlsx, .pptx) and OpenDocument (.odt, .ods, .odp)
+files are zip archives of XML parts, which are streamed here with zipfile
+and iterparse, one paragraph (or row) at a time. RTF is plain text with
+markup, reduced here by a lightweight tokenizer. Either is far cheaper
+than an HTTP round trip to a JVM, so warctika and warc2mongodb try this
+tier first and only fall back to Tika when it raises
+LocalExtractionException.
+
+Copyright 2014-2016 Tom Nicholls
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+
+#####
+#SETUP
+#####
+
+import re
+import codecs
+import zipfile
+from cStringIO import StringIO
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
+
+_W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+_A = '{http://schemas.openxmlformats.org/drawingml/2006/main}'
+_S = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+_TEXT = '{urn:oasis:names:tc:opendocument:xmlns:text:1.0}'
+
+#####
+#CLASSES
+#####
+
+class LocalExtractionException(Exception):
+    pass
+
+#####
+#UTILITY FUNCTIONS
+#####
+def can_extract(mimetype):
+    """Return True if mimetype is one we can try to extract locally."""
+    if not mimetype:
+        return False
+    mimetype = mimetype.lower()
+    return (mimetype.startswith('application/vnd.openxmlformats-officedocument')
+            or mimetype.startswith('application/vnd.oasis.opendocument')
+            or mimetype in ('text/rtf', 'application/rtf', 'text/richtext',
+                            'application/richtext'))
+
+def extract_text(mimetype, body):
+    """Extract plain text from body, returning it UTF-8 encoded as Tika
+    would. Raises LocalExtractionException if the format is not supported
+    or the document cannot be read."""
+    if not can_extract(mimetype):
+        raise LocalExtractionException("No local extractor for "+
+                                       str(mimetype))
+    try:
+        if 'rtf' in mimetype.lower() or 'richtext' in mimetype.lower():
+            text = rtf_to_text(body)
+        else:
+            text = zipped_xml_to_text(body)
+    except LocalExtractionException:
+        raise
+    except Exception as e:
+        raise LocalExtractionException("Local extraction of "+mimetype+
+                                       " failed: "+str(e))
+    return text.encode('utf-8')
+
+def _sorted_parts(names, prefix):
+    """Return the zip member names like prefix123.xml, in numeric order."""
+    parts = [n for n in names if n.startswith(prefix) and n.endswith('.xml')]
+    def key(n):
+        m = re.search(r'(\d+)\.xml$', n)
+        return int(m.group(1)) if m else 0
+    return sorted(parts, key=key)
+
+def zipped_xml_to_text(body):
+    """Extract the text of an OOXML or ODF document, choosing the parts to
+    read from the archive's contents rather than the (often wrong)
+    declared Content-Type."""
+    try:
+        zf = zipfile.ZipFile(StringIO(body))
+    except (zipfile.BadZipfile, zipfile.LargeZipFile, IOError) as e:
+        raise LocalExtractionException("Not a readable zip archive: "+str(e))
+    names = zf.namelist()
+    out = []
+    if 'word/document.xml' in names:
+        _paragraphs(zf.open('word/document.xml'), _W+'p',
+                    {_W+'t': None}, {_W+'tab': u'\t', _W+'br': u'\n',
+                                     _W+'cr': u'\n'}, out)
+    elif 'xl/workbook.xml' in names:
+        _spreadsheet(zf, names, out)
+    elif 'ppt/presentation.xml' in names:
+        for name in _sorted_parts(names, 'ppt/slides/slide'):
+            _paragraphs(zf.open(name), _A+'p', {_A+'t': None},
+                        {_A+'br': u'\n'}, out)
+            out.append(u'\n')
+    elif 'content.xml' in names:
+        _paragraphs(zf.open('content.xml'), (_TEXT+'p', _TEXT+'h'),
+                    None, {_TEXT+'tab': u'\t', _TEXT+'line-break': u'\n',
+                           _TEXT+'s': _odf_spaces}, out)
+    else:
+        raise LocalExtractionException("Unrecognised zipped document")
+    zf.close()
+    return u''.join(out)
+
+def _odf_spaces(elem):
+    try:
+        return u' ' * int(elem.get(_TEXT+'c', 1))
+    except ValueError:
+        return u' '
+
+def _walk(elem, out, texttags, special):
+    """Append the text of elem and its descendants to out, in document
+    order. If texttags is None, all element text and tails are taken
+    (ODF's mixed content); otherwise only the text of those tags (OOXML,
+    where whitespace between elements is insignificant)."""
+    tag = elem.tag
+    if tag in special:
+        value = special[tag]
+        out.append(value(elem) if callable(value) else value)
+    elif elem.text and (texttags is None or tag in texttags):
+        out.append(elem.text)
+    for child in elem:
+        _walk(child, out, texttags, special)
+        if texttags is None and child.tail:
+            out.append(child.tail)
+
+def _paragraphs(f, paratags, texttags, special, out):
+    """Stream an XML part, appending the text of each paragraph element
+    to out as it completes and then discarding it."""
+    if isinstance(paratags, basestring):
+        paratags = (paratags,)
+    for event, elem in iterparse(f):
+        if elem.tag in paratags:
+            _walk(elem, out, texttags, special)
+            out.append(u'\n')
+            elem.clear()
+    f.close()
+
+def _spreadsheet(zf, names, out):
+    """Append the cell values of each worksheet of an .xlsx file to out,
+    tab-separated by cell and newline-separated by row."""
+    shared = []
+    if 'xl/sharedStrings.xml' in names:
+        f = zf.open('xl/sharedStrings.xml')
+        for event, elem in iterparse(f):
+            if elem.tag == _S+'si':
+                shared.append(u''.join(t.text or u''
+                                       for t in elem.iter(_S+'t')))
+                elem.clear()
+        f.close()
+    for name in _sorted_parts(names, 'xl/worksheets/sheet'):
+        f = zf.open(name)
+        row = []
+        for event, elem in iterparse(f):
+            if elem.tag == _S+'c':
+                ctype = elem.get('t')
+                v = elem.find(_S+'v')
+                if ctype == 'inlineStr':
+                    row.append(u''.join(t.text or u''
+                                        for t in elem.iter(_S+'t')))
+                elif v is not None and v.text is not None:
+                    if ctype == 's':
+                        try:
+                            row.append(shared[int(v.text)])
+                        except (ValueError, IndexError):
+                            pass
+                    else:
+                        row.append(v.text)
+                elem.clear()
+            elif elem.tag == _S+'row':
+                if row:
+                    out.append(u'\t'.join(row) + u'\n')
+                row = []
+                elem.clear()
+        f.close()
+        out.append(u'\n')
+
+# RTF destinations whose contents are not document text
+_rtf_skip = frozenset([
+    'aftncn', 'aftnsep', 'aftnsepc', 'annotation', 'atnauthor', 'atndate',
+    'atnicn', 'atnid', 'atnparent', 'atnref', 'atntime', 'atrfend',
+    'atrfstart', 'author', 'background', 'bkmkend', 'bkmkstart', 'buptim',
+    'colortbl', 'comment', 'company', 'creatim', 'datafield', 'datastore',
+    'do', 'doccomm', 'docvar', 'dptxbxtext', 'falt', 'fchars', 'ffdeftext',
+    'ffentrymcr', 'ffexitmcr', 'ffformat', 'ffhelptext', 'ffl', 'ffname',
+    'ffstattext', 'file', 'filetbl', 'fldinst', 'fldtype', 'fname',
+    'fontemb', 'fontfile', 'fonttbl', 'footer', 'footerf', 'footerl',
+    'footerr', 'formfield', 'ftncn', 'ftnsep', 'ftnsepc',
+    'g', 'generator', 'gridtbl', 'header', 'headerf', 'headerl', 'headerr',
+    'hl', 'hlfr', 'hlinkbase', 'hlloc', 'hlsrc', 'hsv', 'info', 'keywords',
+    'latentstyles', 'lchars', 'levelnumbers', 'leveltext', 'lfolevel',
+    'linkval', 'list', 'listlevel', 'listname', 'listoverride',
+    'listoverridetable', 'listpicture', 'liststylename', 'listtable',
+    'listtext', 'lsdlockedexcept', 'macc', 'maccPr', 'mailmerge', 'maln',
+    'malnScr', 'manager', 'margPr', 'mbar', 'mbarPr', 'mbaseJc', 'mbegChr',
+    'mborderBox', 'mborderBoxPr', 'mbox', 'mboxPr', 'mchr', 'mcount',
+    'mctrlPr', 'md', 'mdeg', 'mdegHide', 'mden', 'mdiff', 'mdPr', 'me',
+    'mendChr', 'meqArr', 'meqArrPr', 'mf', 'mfName', 'mfPr', 'mfunc',
+    'mfuncPr', 'mgroupChr', 'mgroupChrPr', 'mgrow', 'mhideBot', 'mhideLeft',
+    'mhideRight', 'mhideTop', 'mhtmltag', 'mlim', 'mlimloc', 'mlimlow',
+    'mlimlowPr', 'mlimupp', 'mlimuppPr', 'mm', 'mmaddfieldname', 'mmath',
+    'mmathPict', 'mmathPr', 'mmaxdist', 'mmc', 'mmcJc', 'mmconnectstr',
+    'mmconnectstrdata', 'mmcPr', 'mmcs', 'mmdatasource', 'mmheadersource',
+    'mmmailsubject', 'mmodso', 'mmodsofilter', 'mmodsofldmpdata',
+    'mmodsomappedname', 'mmodsoname', 'mmodsorecipdata', 'mmodsosort',
+    'mmodsosrc', 'mmodsotable', 'mmodsoudl', 'mmodsoudldata',
+    'mmodsouniquetag', 'mmPr', 'mmquery', 'mmr', 'mnary', 'mnaryPr',
+    'mnoBreak', 'mnum', 'mobjDist', 'moMath', 'moMathPara', 'moMathParaPr',
+    'mopEmu', 'mphant', 'mphantPr', 'mplcHide', 'mpos', 'mr', 'mrad',
+    'mradPr', 'mrPr', 'msepChr', 'mshow', 'mshp', 'msPre', 'msPrePr',
+    'msSub', 'msSubPr', 'msSubSup', 'msSubSupPr', 'msSup', 'msSupPr',
+    'mstrikeBLTR', 'mstrikeH', 'mstrikeTLBR', 'mstrikeV', 'msub', 'msubHide',
+    'msup', 'msupHide', 'mtransp', 'mtype', 'mvertJc', 'mvfmf', 'mvfml',
+    'mvtof', 'mvtol', 'mzeroAsc', 'mzeroDesc', 'mzeroWid', 'nesttableprops',
+    'nextfile', 'nonesttables', 'objalias', 'objclass', 'objdata', 'object',
+    'objname', 'objsect', 'objtime', 'oldcprops', 'oldpprops', 'oldsprops',
+    'oldtprops', 'oleclsid', 'operator', 'panose', 'password', 'passwordhash',
+    'pgp', 'pgptbl', 'picprop', 'pict', 'pn', 'pnseclvl', 'pntext',
+    'pntxta', 'pntxtb', 'printim', 'private', 'propname', 'protend',
+    'protstart', 'protusertbl', 'pxe', 'result', 'revtbl', 'revtim',
+    'rsidtbl', 'rxe', 'shp', 'shpgrp', 'shpinst', 'shppict', 'shprslt',
+    'sn', 'sp', 'staticval', 'stylesheet', 'subject', 'sv',
+    'svb', 'tc', 'template', 'themedata', 'title', 'txe', 'ud', 'upr',
+    'userprops', 'wgrffmtfilter', 'windowcaption', 'writereservation',
+    'writereservhash', 'xe', 'xform', 'xmlattrname', 'xmlattrvalue',
+    'xmlclose', 'xmlname', 'xmlnstbl', 'xmlopen'])
+
+_rtf_specials = {
+    'par': u'\n', 'sect': u'\n\n', 'page': u'\n\n', 'line': u'\n',
+    'tab': u'\t', 'cell': u'\t', 'row': u'\n', 'emdash': u'\u2014',
+    'endash': u'\u2013', 'emspace': u'\u2003', 'enspace': u'\u2002',
+    'qmspace': u'\u2005', 'bullet': u'\u2022', 'lquote': u'\u2018',
+    'rquote': u'\u2019', 'ldblquote': u'\u201c', 'rdblquote': u'\u201d',
+}
+
+_rtf_token = re.compile(
+    r"\\([a-zA-Z]+)(-?\d+)? ?|\\'([0-9a-fA-F]{2})|\\([^a-zA-Z])|([{}])|"
+    r"[\r\n]+|([^\\{}\r\n]+)")
+
+def rtf_to_text(body):
+    """Reduce an RTF document to unicode plain text."""
+    if not body.lstrip().startswith('{\\rtf'):
+        raise LocalExtractionException("Not an RTF document")
+    stack = []
+    ignorable = False
+    ucskip = 1      # Fallback characters to skip after a \uN
+    curskip = 0     # Fallback characters still to skip
+    codepage = 'cp1252'
+    out = []
+    for m in _rtf_token.finditer(body):
+        word, arg, hexcode, char, brace, text = m.groups()
+        if brace:
+            curskip = 0
+            if brace == '{':
+                stack.append((ucskip, ignorable))
+            elif stack:
+                ucskip, ignorable = stack.pop()
+        elif char:
+            curskip = 0
+            if char == '~':
+                if not ignorable:
+                    out.append(u'\xa0')
+            elif char in '{}\\':
+                if not ignorable:
+                    out.append(unicode(char))
+            elif char == '*':
+                ignorable = True
+            elif char in '\r\n' and not ignorable:
+                out.append(u'\n')
+        elif word:
+            curskip = 0
+            if word in _rtf_skip:
+                ignorable = True
+            elif ignorable:
+                pass
+            elif word in _rtf_specials:
+                out.append(_rtf_specials[word])
+            elif word == 'ansicpg' and arg:
+                try:
+                    codecs.lookup('cp' + arg)
+                    codepage = 'cp' + arg
+                except LookupError:
+                    pass
+            elif word == 'uc' and arg:
+                ucskip = int(arg)
+            elif word == 'u' and arg:
+                c = int(arg)
+                if c < 0:
+                    c += 0x10000
+                out.append(unichr(c))
+                curskip = ucskip
+        elif hexcode:
+            if curskip > 0:
+                curskip -= 1
+            elif not ignorable:
+                out.append(chr(int(hexcode, 16)).decode(codepage, 'replace'))
+        elif text:
+            if curskip > 0:
+                # Skip the ANSI fallback for a preceding \uN
+                if curskip >= len(text):
+                    curskip -= len(text)
+                    continue
+                text = text[curskip:]
+                curskip = 0
+            if not ignorable:
+                out.append(text.decode(codepage, 'replace'))
+    return u''.join(out)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python2
+"""Cheap screening of PDFs for extractable text, to avoid sending scanned
+(image-only) documents to Apache Tika just to get back a few bytes of
+whitespace.
+
+The PDF is scanned for the things a text-bearing PDF must have (font
+resources and text-showing operators in its content streams) and the
+things a scanned one does have (image XObjects). Only the object
+dictionaries (with the stream data cut out) and the non-image streams are
+searched: compressed image data is effectively random, and often looks
+like a text operator. Flate compressed content and object streams are
+inflated, up to a limit, so that PDF 1.5 files keeping their dictionaries
+in object streams are judged on their contents too. Nothing is parsed
+properly, so the result is a confidence rather than a verdict.
+
+Copyright 2014-2016 Tom Nicholls
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+
+#####
+#SETUP
+#####
+
+import re
+import zlib
+
+_font_re = re.compile(r'/Type\s*/Font\b|/BaseFont\b|/FontFile[23]?\b')
+_image_re = re.compile(r'/Subtype\s*/Image\b')
+# A string or array operand followed by a text-showing operator
+_textop_re = re.compile(r'[)>\]]\s*(Tj|TJ|\'|")(?![A-Za-z])')
+_imagecodec_re = re.compile(r'/(DCTDecode|JBIG2Decode|CCITTFaxDecode|'
+                            r'JPXDecode)')
+
+#####
+#UTILITY FUNCTIONS
+#####
+def _stream_spans(body):
+    """Generate (dictstart, start, datastart, end) for each stream object
+    in a PDF: the offsets of its dictionary (roughly), of the 'stream'
+    keyword, and of the start and end of its data."""
+    pos = 0
+    while True:
+        start = body.find('stream', pos)
+        if start < 0:
+            return
+        # Skip 'endstream', which also contains 'stream'
+        if body[start-3:start] == 'end':
+            pos = start + 6
+            continue
+        datastart = start + 6
+        if body[datastart:datastart+2] == '\r\n':
+            datastart += 2
+        elif body[datastart:datastart+1] in ('\n', '\r'):
+            datastart += 1
+        else:
+            pos = datastart
+            continue
+        end = body.find('endstream', datastart)
+        if end < 0:
+            end = len(body)
+        lo = max(0, start - 4096)
+        dictstart = body.rfind('obj', lo, start)
+        if dictstart < 0:
+            dictstart = lo
+        yield dictstart, start, datastart, end
+        pos = end + 9
+
+def _streams(body):
+    """Generate (dictionary, data) for each stream object in a PDF."""
+    for dictstart, start, datastart, end in _stream_spans(body):
+        yield body[dictstart:start], body[datastart:end]
+
+def _without_streams(body):
+    """Return body with the data of its stream objects cut out, leaving
+    the object dictionaries and the rest of the file's syntax."""
+    parts = []
+    pos = 0
+    for _, _, datastart, end in _stream_spans(body):
+        parts.append(body[pos:datastart])
+        pos = end
+    parts.append(body[pos:])
+    return ''.join(parts)
+
+def screen_pdf(body, maxinflate=8*1024*1024):
+    """Return a confidence, from 0.0 to 1.0, that the PDF in body contains
+    no extractable text (i.e. is a scanned image, or nothing at all).
+
+       :maxinflate: maximum total bytes of compressed streams to inflate
+                    while looking for fonts and text operators. If the
+                    limit is hit the confidence is reduced accordingly.
+
+       A PDF with any font resource or text operator scores 0.0: it may
+       still produce little text, but only Tika can tell. Encrypted or
+       unreadable PDFs also score 0.0, as we can't see inside them."""
+    if not body.startswith('%PDF') and '%PDF' not in body[:1024]:
+        return 0.0
+    if '/Encrypt' in body:
+        return 0.0
+    skeleton = _without_streams(body)
+    if _font_re.search(skeleton) or _textop_re.search(skeleton):
+        return 0.0
+    images = len(_image_re.findall(skeleton))
+    inflated = 0
+    uninspected = 0
+    for streamdict, data in _streams(body):
+        if '/Image' in streamdict:
+            images += 1
+            continue
+        if '/FontFile' in streamdict:
+            return 0.0
+        if '/Filter' in streamdict and '/FlateDecode' not in streamdict:
+            # DCT, JBIG2, CCITT etc. are image codecs; anything else
+            # we can't read.
+            if not _imagecodec_re.search(streamdict):
+                uninspected += 1
+            continue
+        if '/FlateDecode' in streamdict:
+            if inflated >= maxinflate:
+                uninspected += 1
+                continue
+            try:
+                d = zlib.decompressobj()
+                data = d.decompress(data, maxinflate - inflated)
+            except zlib.error:
+                uninspected += 1
+                continue
+            inflated += len(data)
+        if _font_re.search(data) or _textop_re.search(data):
+            return 0.0
+        images += len(_image_re.findall(data))
+    if images == 0:
+        # No text and no images either: vector graphics, forms, or
+        # something we've misread. Tika might find something.
+        confidence = 0.5
+    else:
+        confidence = 0.95
+    if uninspected:
+        confidence *= 0.8
+    return confidence
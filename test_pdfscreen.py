@@ -0,0 +1,82 @@
+#!/usr/bin/env python2
+"""Tests for pdfscreen.
+
+Copyright 2014-2016 Tom Nicholls
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+
+import random
+import zlib
+import unittest
+from pdfscreen import screen_pdf
+
+def make_pdf(objects):
+    """Return a PDF file made of objects, a list of (dictionary, stream
+    data or None) tuples numbered from 1."""
+    out = ['%PDF-1.4\n%\xe2\xe3\xcf\xd3\n']
+    for n, (dictionary, data) in enumerate(objects, 1):
+        if data is None:
+            out.append('%d 0 obj\n%s\nendobj\n' % (n, dictionary))
+        else:
+            out.append('%d 0 obj\n%s\nstream\n%s\nendstream\nendobj\n' %
+                       (n, dictionary[:-2] + ' /Length %d >>' % len(data),
+                        data))
+    out.append('trailer\n<< /Root 1 0 R >>\n%%EOF\n')
+    return ''.join(out)
+
+def scanned_pdf(imagesize, seed):
+    """A one-page PDF holding only a DCT-encoded image of imagesize bytes
+    (random, as compressed image data effectively is)."""
+    rng = random.Random(seed)
+    image = ''.join(chr(rng.randrange(256)) for _ in xrange(imagesize))
+    content = 'q 612 0 0 792 0 0 cm /Im0 Do Q'
+    return make_pdf([
+        ('<< /Type /Catalog /Pages 2 0 R >>', None),
+        ('<< /Type /Pages /Kids [3 0 R] /Count 1 >>', None),
+        ('<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+         '/Resources << /XObject << /Im0 5 0 R >> >> /Contents 4 0 R >>',
+         None),
+        ('<< >>', content),
+        ('<< /Type /XObject /Subtype /Image /Width 2480 /Height 3508 '
+         '/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /DCTDecode >>',
+         image)])
+
+def text_pdf():
+    """A one-page PDF with a line of text in a compressed content
+    stream."""
+    content = zlib.compress('BT /F1 12 Tf 72 720 Td (Hello, world) Tj ET')
+    return make_pdf([
+        ('<< /Type /Catalog /Pages 2 0 R >>', None),
+        ('<< /Type /Pages /Kids [3 0 R] /Count 1 >>', None),
+        ('<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+         '/Resources << >> /Contents 4 0 R >>', None),
+        ('<< /Filter /FlateDecode >>', content)])
+
+class ScreenPDFTest(unittest.TestCase):
+    def test_scanned_pdfs_have_no_text(self):
+        for imagesize in (20*1024, 200*1024):
+            for seed in range(5):
+                self.assertEqual(screen_pdf(scanned_pdf(imagesize, seed)),
+                                 0.95, "image of %d bytes, seed %d" %
+                                 (imagesize, seed))
+
+    def test_text_pdf_has_text(self):
+        self.assertEqual(screen_pdf(text_pdf()), 0.0)
+
+    def test_not_a_pdf(self):
+        self.assertEqual(screen_pdf('<html></html>'), 0.0)
+
+if __name__ == '__main__':
+    unittest.main()
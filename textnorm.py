@@ -0,0 +1,186 @@
+#!/usr/bin/env python2
+"""Normalisation of the plain text produced by Apache Tika (or by
+localextract), to cut the bytes written, compressed and stored for each
+converted document.
+
+Tika's output for PDFs and spreadsheets is padded with runs of blank
+lines, page-break whitespace, trailing spaces, NULs and other control
+characters, and (for paged documents) the same running header and footer
+on every page. normalise_text():
+ - strips control characters other than tab and newline, turning form
+   feeds and carriage returns into newlines;
+ - collapses runs of spaces and tabs within a line, and strips them from
+   the ends of lines;
+ - collapses runs of blank lines to one;
+ - for paged document types whose text marks page breaks with form feeds,
+   drops all but the first occurrence of short lines which recur in the
+   first or last few lines of most pages, counting lines which differ
+   only in their digits ("Page 3 of 12") as the same. Lines elsewhere on
+   the page, such as the rows of a table, are never dropped.
+
+Text is handled as UTF-8 encoded bytes, as Tika returns it: no byte of a
+multi-byte UTF-8 sequence is an ASCII control or space character, so none
+is touched. NormaliseStats keeps the size reduction per MIME type.
+
+Copyright 2014-2016 Tom Nicholls
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+
+#####
+#SETUP
+#####
+
+import re
+from collections import defaultdict
+
+_newline_re = re.compile(r'\r\n?|\v')
+_control_re = re.compile(r'[\x00-\x08\x0e-\x1f\x7f]+')
+_spaces_re = re.compile(r'[ \t]+')
+_blanklines_re = re.compile(r'\n{3,}')
+_digits_re = re.compile(r'\d+')
+_letter_re = re.compile(r'[A-Za-z]')
+# Types whose text is laid out in pages, with running headers and footers
+_paged_re = re.compile(r'pdf|word|powerpoint|presentation|'
+                       r'opendocument\.text')
+
+#####
+#UTILITY FUNCTIONS
+#####
+def is_paged(mimetype):
+    """True if documents of type mimetype are laid out in pages, and so
+    may repeat a header or footer on each."""
+    return bool(mimetype and _paged_re.search(mimetype))
+
+def _edges(lines, edge):
+    """Return the indices of the first and last edge non-blank lines of a
+    page, where any header or footer is, taking no more than a third of
+    the page's lines from each end."""
+    nonblank = [i for i, line in enumerate(lines) if line]
+    n = min(edge, len(nonblank) // 3)
+    return set(nonblank[:n] + nonblank[len(nonblank) - n:])
+
+def _boilerplate_keys(pages, edges, minrepeat, minlen, maxlen):
+    """Return the keys (lines with digits masked) of lines at the edges
+    of at least minrepeat pages, and of at least half of them. Keys found
+    twice on one page, or away from its edges, are those of the rows of a
+    table or list rather than a header or footer, and are left out."""
+    counts = defaultdict(int)
+    notkeys = set()
+    for lines, window in zip(pages, edges):
+        keys = set()
+        for i, line in enumerate(lines):
+            if not line:
+                continue
+            key = _digits_re.sub('#', line)
+            if i not in window or key in keys:
+                notkeys.add(key)
+            elif minlen <= len(line) <= maxlen and _letter_re.search(line):
+                keys.add(key)
+        for key in keys:
+            counts[key] += 1
+    return set(k for k, n in counts.iteritems()
+               if n >= minrepeat and 2 * n >= len(pages)
+               and k not in notkeys)
+
+def normalise_text(text, mimetype=None, boilerplate=True, minrepeat=4,
+                   minlen=8, maxlen=200, edge=3):
+    """Return text (UTF-8 bytes) with control characters stripped and
+    whitespace collapsed, and, if boilerplate is True and mimetype is a
+    paged type, repeated header and footer lines dropped.
+
+       :minrepeat: pages a line must head or foot to count as boilerplate
+       :minlen, maxlen: lengths of line (in bytes) which may count
+       :edge: lines at the top and bottom of each page which may be part
+              of a header or footer"""
+    text = _newline_re.sub('\n', text)
+    pages = []
+    for page in text.split('\f'):
+        page = _control_re.sub('', page)
+        pages.append([_spaces_re.sub(' ', line).strip(' ')
+                      for line in page.split('\n')])
+    if boilerplate and is_paged(mimetype) and len(pages) >= minrepeat:
+        edges = [_edges(lines, edge) for lines in pages]
+        keys = _boilerplate_keys(pages, edges, minrepeat, minlen, maxlen)
+        if keys:
+            seen = set()
+            for p, (lines, window) in enumerate(zip(pages, edges)):
+                kept = []
+                for i, line in enumerate(lines):
+                    if i in window and minlen <= len(line) <= maxlen:
+                        key = _digits_re.sub('#', line)
+                        if key in keys:
+                            if key in seen:
+                                continue
+                            seen.add(key)
+                    kept.append(line)
+                pages[p] = kept
+    text = '\n'.join(line for lines in pages for line in lines)
+    text = _blanklines_re.sub('\n\n', text)
+    return text.strip('\n')
+
+#####
+#CLASSES
+#####
+
+class NormaliseStats(object):
+    """Numbers of documents, and of bytes before and after normalisation,
+    per MIME type."""
+    def __init__(self):
+        self.docs = defaultdict(int)
+        self.bytesin = defaultdict(int)
+        self.bytesout = defaultdict(int)
+
+    def add(self, mimetype, before, after):
+        self.docs[mimetype] += 1
+        self.bytesin[mimetype] += before
+        self.bytesout[mimetype] += after
+
+    def normalise(self, text, mimetype=None, **kw):
+        """normalise_text(text, mimetype, ...), counting the reduction."""
+        out = normalise_text(text, mimetype, **kw)
+        self.add(mimetype, len(text), len(out))
+        return out
+
+    def counts(self):
+        """Return the totals, and the bytes per MIME type, as a dict of
+        counts to be kept in tiercounts."""
+        counts = {'normalised': sum(self.docs.values()),
+                  'normalised-bytes-in': sum(self.bytesin.values()),
+                  'normalised-bytes-out': sum(self.bytesout.values())}
+        for mimetype in self.docs:
+            counts['normalised-bytes-in:'+str(mimetype)] = \
+                self.bytesin[mimetype]
+            counts['normalised-bytes-out:'+str(mimetype)] = \
+                self.bytesout[mimetype]
+        return counts
+
+    def report(self):
+        """Return a line per MIME type giving the size reduction, biggest
+        saving first."""
+        lines = []
+        for mimetype in sorted(self.docs, key=lambda m:
+                               self.bytesout[m] - self.bytesin[m]):
+            before = self.bytesin[mimetype]
+            after = self.bytesout[mimetype]
+            lines.append("%s: %d docs, %d -> %d bytes (-%.1f%%)" %
+                         (mimetype, self.docs[mimetype], before, after,
+                          100.0 * (before - after) / before if before
+                          else 0.0))
+        return "\n".join(lines)
+
+    def clear(self):
+        self.docs.clear()
+        self.bytesin.clear()
+        self.bytesout.clear()
@@ -0,0 +1,297 @@
+#!/usr/bin/env python2
+"""Client for Apache Tika's JAX-RS server, shared by warctika and
+warc2mongodb.
+
+Adds to a bare requests.put():
+ - connect and read timeouts, with the read timeout scaled by payload size
+   so that one pathological document can't hang a worker indefinitely;
+ - a circuit breaker per endpoint, so that a dead or wedged Tika is not
+   sent every record in turn (each waiting for its own timeout) but is
+   left alone for a cool-off period, during which callers get an
+   immediate TikaUnavailableException;
+ - routing of documents above a size threshold to a separate "heavy" Tika
+   endpoint, so that big files don't starve the latency of normal ones;
+ - batched submission of small documents, packed into a single zip archive
+   and sent to Tika's recursive metadata endpoint (/rmeta/text), so that
+   per-request HTTP and parser setup overhead is paid once per batch;
+ - optionally, spreading documents across the live servers of a
+   tikafleet.TikaFleet.
+
+Copyright 2014-2016 Tom Nicholls
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+
+#####
+#SETUP
+#####
+
+import sys
+import time
+import zipfile
+import mimetypes
+import requests
+from cStringIO import StringIO
+
+#####
+#UTILITY FUNCTIONS
+#####
+def rmeta_url(url):
+    """Derive the URL of Tika's /rmeta/text endpoint from that of its
+    /tika endpoint."""
+    if url.rstrip('/').endswith('/tika'):
+        return url.rstrip('/')[:-len('/tika')] + '/rmeta/text'
+    return url.rstrip('/') + '/rmeta/text'
+
+#####
+#CLASSES
+#####
+
+class TikaException(Exception):
+    pass
+
+class TikaUnavailableException(TikaException):
+    """Raised without contacting Tika while an endpoint's circuit is open."""
+    pass
+
+class TikaTimeoutException(TikaException):
+    pass
+
+class TikaConnectionException(TikaException):
+    """Raised when Tika refuses or drops the connection, as a crashed
+    server does."""
+    pass
+
+class CircuitBreaker(object):
+    """Track consecutive failures against one endpoint.
+
+       After maxfailures consecutive failures the circuit opens and
+       allow() returns False for cooloff seconds. After that a single
+       probe request is allowed through ("half-open"): success closes the
+       circuit again, failure re-opens it for another cool-off period."""
+    def __init__(self, maxfailures=5, cooloff=60):
+        self._maxfailures = maxfailures
+        self._cooloff = cooloff
+        self.failures = 0
+        self._openuntil = None
+        self._probing = False
+        self.trips = 0
+
+    def allow(self):
+        if self._openuntil is None:
+            return True
+        if time.time() < self._openuntil or self._probing:
+            return False
+        # Cool-off expired: let one probe through
+        self._probing = True
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self._openuntil = None
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._probing or self.failures >= self._maxfailures:
+            if self._openuntil is None or self._probing:
+                self.trips += 1
+            self._openuntil = time.time() + self._cooloff
+            self._probing = False
+
+    def is_open(self):
+        return self._openuntil is not None
+
+class TikaClient(object):
+    """Submits documents to one or two Tika JAX-RS endpoints.
+
+       url: the normal Tika endpoint (e.g. http://localhost:9998/tika);
+       rmetaurl: the recursive metadata endpoint used for batches. By
+           default this is derived from url (.../tika -> .../rmeta/text);
+       heavyurl: optional endpoint for documents of heavythreshold bytes
+           or more. If None, all documents go to url;
+       connecttimeout: seconds allowed to establish a connection;
+       readtimeout: base seconds allowed between bytes of the response;
+       readtimeoutpermb: additional read timeout per MB of payload;
+       maxreadtimeout: cap on the scaled read timeout;
+       maxfailures, cooloff: circuit breaker settings (see CircuitBreaker).
+           Timeouts, connection errors and 503 responses count as
+           failures; other HTTP errors are the document's fault, not
+           Tika's, and do not;
+       fleet: a tikafleet.TikaFleet. If given, each request goes to the
+           least busy of its live servers, and url, rmetaurl and heavyurl
+           are not used. A request whose connection fails is reported to
+           the fleet, which takes the server out of use until it answers
+           again, and retried once on another server."""
+    def __init__(self, url='http://localhost:9998/tika', heavyurl=None,
+                 heavythreshold=10*1024*1024, connecttimeout=5,
+                 readtimeout=30, readtimeoutpermb=10, maxreadtimeout=600,
+                 maxfailures=5, cooloff=60, rmetaurl=None, fleet=None):
+        self.url = url
+        if rmetaurl is None:
+            rmetaurl = rmeta_url(url)
+        self.rmetaurl = rmetaurl
+        self.heavyurl = heavyurl
+        self._heavythreshold = heavythreshold
+        self._connecttimeout = connecttimeout
+        self._readtimeout = readtimeout
+        self._readtimeoutpermb = readtimeoutpermb
+        self._maxreadtimeout = maxreadtimeout
+        self._maxfailures = maxfailures
+        self._cooloff = cooloff
+        self._breakers = {}
+        self._fleet = fleet
+        self._session = requests.Session()
+
+    def breaker(self, url):
+        """Return the CircuitBreaker for a given endpoint URL."""
+        if url not in self._breakers:
+            self._breakers[url] = CircuitBreaker(self._maxfailures,
+                                                 self._cooloff)
+        return self._breakers[url]
+
+    def url_for(self, size):
+        """Choose the endpoint for a payload of size bytes."""
+        if self.heavyurl and size >= self._heavythreshold:
+            return self.heavyurl
+        return self.url
+
+    def timeout_for(self, size):
+        """Return a (connect, read) timeout tuple for a payload of size
+        bytes, suitable for passing to requests."""
+        read = self._readtimeout + self._readtimeoutpermb * size / 1048576.0
+        return (self._connecttimeout, min(read, self._maxreadtimeout))
+
+    def put(self, body, headers=None, url=None, rmeta=False):
+        """PUT body to Tika and return the requests Response object.
+
+           :url:   endpoint to use, rather than choosing one
+           :rmeta: if True, use the recursive metadata endpoint
+
+           Raises TikaUnavailableException immediately if the endpoint's
+           circuit is open, and TikaTimeoutException,
+           TikaConnectionException or TikaException if the request times
+           out or cannot be made."""
+        if url is None and self._fleet is not None:
+            for attempt in range(2):
+                server, generation = self._fleet.acquire()
+                try:
+                    return self.put(body, headers,
+                                    server.rmetaurl if rmeta else server.url)
+                except TikaConnectionException as e:
+                    # Most likely the server has crashed. Timeouts are not
+                    # retried, as a document which wedges one server would
+                    # probably wedge another.
+                    self._fleet.failed(server, generation)
+                    if attempt:
+                        raise
+                    sys.stderr.write(str(e)+". Retrying on another "
+                                     "server.\n")
+                finally:
+                    self._fleet.release(server, generation)
+        size = len(body)
+        if url is None:
+            url = self.rmetaurl if rmeta else self.url_for(size)
+        breaker = self.breaker(url)
+        if not breaker.allow():
+            raise TikaUnavailableException("Tika at "+url+" is unavailable "
+                                           "(circuit open). Not submitting.")
+        try:
+            resp = self._session.put(url, data=body, headers=headers,
+                                     timeout=self.timeout_for(size))
+        except requests.exceptions.Timeout as e:
+            self._failed(breaker, url)
+            raise TikaTimeoutException("Timeout submitting "+str(size)+
+                                       " bytes to Tika at "+url+": "+str(e))
+        except requests.exceptions.ConnectionError as e:
+            self._failed(breaker, url)
+            raise TikaConnectionException("Error connecting to Tika at "+
+                                          url+": "+str(e))
+        except requests.exceptions.RequestException as e:
+            self._failed(breaker, url)
+            raise TikaException("Error submitting to Tika at "+url+": "+
+                                str(e))
+        if resp.status_code == 503:
+            self._failed(breaker, url)
+        else:
+            breaker.record_success()
+        return resp
+
+    def put_batch(self, docs):
+        """Submit several documents to Tika in one request.
+
+           :docs: a list of (mimetype, body) tuples
+
+           The documents are packed (uncompressed) into a zip archive and
+           sent to the rmeta endpoint. Returns a list, in the same order as
+           docs, holding the UTF-8 text extracted from each document, or
+           None for documents Tika failed on or did not report, which the
+           caller should resubmit individually. Raises
+           TikaUnavailableException if the circuit is open."""
+        results = [None] * len(docs)
+        names = {}
+        buf = StringIO()
+        zf = zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED, allowZip64=True)
+        for i, (mimetype, body) in enumerate(docs):
+            # Zip members carry no Content-Type, so give Tika's detector
+            # a hint through the extension.
+            ext = mimetypes.guess_extension(mimetype.split(';')[0]) or ''
+            name = '%06d%s' % (i, ext)
+            zf.writestr(name, body)
+            names[name] = i
+        zf.close()
+        data = buf.getvalue()
+        buf.close()
+        try:
+            resp = self.put(data, rmeta=True,
+                            headers={'Content-Type': 'application/zip',
+                                     'Accept': 'application/json'})
+        except TikaUnavailableException:
+            raise
+        except TikaException as e:
+            sys.stderr.write("Batch of "+str(len(docs))+" documents failed ("+
+                             str(e)+"). Falling back to single requests.\n")
+            return results
+        if resp.status_code != 200:
+            return results
+        try:
+            metadata = resp.json()
+        except ValueError:
+            return results
+        # The first entry describes the container itself; the rest are
+        # its embedded documents (and their own embedded documents, which
+        # we ignore as their text is not what /tika would return).
+        for meta in metadata[1:]:
+            path = meta.get('X-TIKA:embedded_resource_path', '')
+            name = path.lstrip('/')
+            if name not in names:
+                continue
+            if [k for k in meta if k.startswith('X-TIKA:EXCEPTION')]:
+                continue
+            content = meta.get('X-TIKA:content')
+            if isinstance(content, list):
+                content = content[0] if content else None
+            if content is None:
+                continue
+            results[names[name]] = content.encode('utf-8')
+        return results
+
+    def _failed(self, breaker, url):
+        wasopen = breaker.is_open()
+        breaker.record_failure()
+        if breaker.is_open() and not wasopen:
+            sys.stderr.write("Tika at "+url+" failed "+
+                             str(breaker.failures)+" times in a row. "
+                             "Suspending submissions for "+
+                             str(self._cooloff)+"s.\n")
@@ -0,0 +1,322 @@
+#!/usr/bin/env python2
+"""Launching and supervising a fleet of local Tika servers.
+
+Tika JVMs leak memory and fall over on hostile PDFs. A TikaFleet runs
+between minservers and maxservers Tika server processes on consecutive
+local ports, and a supervisor thread:
+ - restarts any which exit (crash) or fail to come up;
+ - recycles any whose resident set grows beyond maxrss, or which have
+   handled maxdocs documents: the server stops being offered new work and
+   is restarted once its requests in flight have finished;
+ - scales the number of servers with the pending Tika work reported by
+   set_demand(), starting more at once but stopping them only after the
+   demand has stayed low for idletime seconds.
+
+A tikaclient.TikaClient built with fleet=... sends each document to the
+least busy live server. If the connection fails, it reports the server
+with failed(), which takes it out of use until the supervisor has seen it
+answer again or restarted it, and retries once on another server. For
+tests, the command can run tikastub.py instead of a real Tika (see
+stub_command()).
+
+Copyright 2014-2016 Tom Nicholls
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+
+#####
+#SETUP
+#####
+
+import sys
+import os
+import time
+import math
+import resource
+import threading
+import subprocess
+import requests
+from tikaclient import TikaUnavailableException
+
+#####
+#UTILITY FUNCTIONS
+#####
+def rss_of(pid):
+    """Return the resident set size of process pid in bytes, or None if
+    it can't be read (no /proc, or the process has gone)."""
+    try:
+        with open('/proc/%d/statm' % pid) as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        return None
+
+def tika_command(jar, java='java', jvmargs=('-Xmx1g',)):
+    """Return a command to run the Tika server jar on '{port}'."""
+    return ([java] + list(jvmargs) +
+            ['-jar', jar, '-h', '127.0.0.1', '-p', '{port}'])
+
+def stub_command(*stubargs):
+    """Return a command to run tikastub.py on '{port}', with any further
+    arguments (such as '--crash-after', '5') given."""
+    stub = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'tikastub.py')
+    return [sys.executable, stub, '--port', '{port}'] + list(stubargs)
+
+#####
+#CLASSES
+#####
+
+class TikaServer(object):
+    """One supervised Tika server process, on a given port."""
+    STARTING, LIVE, DRAINING, STOPPED = 'starting', 'live', 'draining', \
+                                        'stopped'
+
+    def __init__(self, port, command):
+        self.port = port
+        self.url = 'http://127.0.0.1:%d/tika' % port
+        self.rmetaurl = 'http://127.0.0.1:%d/rmeta/text' % port
+        self._command = [arg.replace('{port}', str(port))
+                         for arg in command]
+        self.proc = None
+        self.state = self.STOPPED
+        self.inflight = 0
+        self.docs = 0
+        self.restarts = 0
+        self.started = None
+        # Incremented on each start, so that requests acquired before a
+        # restart are not counted against the new process
+        self.generation = 0
+
+    def start(self):
+        devnull = open(os.devnull, 'wb')
+        self.proc = subprocess.Popen(self._command, stdout=devnull,
+                                     stderr=devnull, close_fds=True)
+        devnull.close()
+        self.state = self.STARTING
+        self.inflight = 0
+        self.docs = 0
+        self.started = time.time()
+        self.generation += 1
+
+    def stop(self, grace=10):
+        """Terminate the process, killing it if it hasn't exited after
+        grace seconds."""
+        self.state = self.STOPPED
+        if self.proc is None or self.proc.poll() is not None:
+            return
+        self.proc.terminate()
+        deadline = time.time() + grace
+        while self.proc.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+
+    def exited(self):
+        return self.proc is not None and self.proc.poll() is not None
+
+    def ready(self):
+        """True if the server answers HTTP requests."""
+        try:
+            return requests.get(self.url, timeout=1).status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+
+class TikaFleet(object):
+    """A supervised, self-scaling set of local Tika servers.
+
+       command: the command (a list) to start one server, with '{port}'
+           standing for its port (see tika_command() and stub_command());
+       baseport: port of the first server; others use the ports after it;
+       minservers, maxservers: bounds on the number of servers;
+       maxrss: recycle a server whose RSS exceeds this many bytes;
+       maxdocs: recycle a server after it has handled this many documents;
+       perserver: units of demand (see set_demand()) per server wanted;
+       idletime: seconds demand must stay low before servers are stopped;
+       starttimeout: seconds a server may take to start answering before
+           it is killed and started again;
+       interval: seconds between supervision passes."""
+    def __init__(self, command, baseport=9998, minservers=1, maxservers=4,
+                 maxrss=None, maxdocs=None, perserver=1, idletime=60,
+                 starttimeout=120, interval=2):
+        self._command = command
+        self._minservers = minservers
+        self._maxservers = maxservers
+        self._maxrss = maxrss
+        self._maxdocs = maxdocs
+        self._perserver = perserver
+        self._idletime = idletime
+        self._starttimeout = starttimeout
+        self._interval = interval
+        self.servers = [TikaServer(baseport + i, command)
+                        for i in range(maxservers)]
+        self._demand = 0
+        self._target = minservers
+        self._lowsince = None
+        self._lock = threading.Condition()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.restarts = 0
+        self.recycles = 0
+
+    def start(self):
+        """Start minservers servers and the supervisor thread."""
+        with self._lock:
+            for server in self.servers[:self._minservers]:
+                server.start()
+        self._thread = threading.Thread(target=self._supervise)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the supervisor and every server."""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        for server in self.servers:
+            server.stop()
+
+    def set_demand(self, pending):
+        """Report the amount of Tika-bound work pending (for example, the
+        number of files waiting to be processed), for scaling."""
+        with self._lock:
+            self._demand = pending
+
+    def live(self):
+        """Return the servers currently accepting work."""
+        with self._lock:
+            return [s for s in self.servers if s.state == TikaServer.LIVE]
+
+    def acquire(self, timeout=None):
+        """Return (server, generation): the least busy live server,
+        counting a request in flight on it, and its generation, waiting
+        up to timeout seconds (default: starttimeout) for one to be live.
+        Raises TikaUnavailableException if none is. Pair with
+        release(server, generation)."""
+        if timeout is None:
+            timeout = self._starttimeout
+        deadline = time.time() + timeout
+        with self._lock:
+            while True:
+                live = [s for s in self.servers
+                        if s.state == TikaServer.LIVE]
+                if live:
+                    server = min(live, key=lambda s: s.inflight)
+                    server.inflight += 1
+                    return server, server.generation
+                remaining = deadline - time.time()
+                if remaining <= 0 or self._stopping.is_set():
+                    raise TikaUnavailableException("No Tika server in the "
+                                                   "fleet is live.")
+                self._lock.wait(min(remaining, 1))
+
+    def release(self, server, generation):
+        """Finish a request on a server returned by acquire(). A request
+        acquired before the server was last (re)started is ignored: its
+        count went with the old process."""
+        with self._lock:
+            if generation != server.generation:
+                self._lock.notify_all()
+                return
+            server.inflight = max(0, server.inflight - 1)
+            server.docs += 1
+            if (self._maxdocs and server.docs >= self._maxdocs and
+                    server.state == TikaServer.LIVE):
+                server.state = TikaServer.DRAINING
+            self._lock.notify_all()
+
+    def failed(self, server, generation):
+        """Report that a request to a server returned by acquire() could
+        not be made: it refused or dropped the connection. Unless it has
+        been restarted since, the server is offered no more work until the
+        supervisor finds it answering again, or restarts it if it has
+        exited."""
+        with self._lock:
+            if (generation == server.generation and
+                    server.state == TikaServer.LIVE):
+                server.state = TikaServer.STARTING
+                server.started = time.time()
+
+    def _supervise(self):
+        while not self._stopping.wait(self._interval):
+            try:
+                self.supervise()
+            except Exception as e:
+                sys.stderr.write("Tika fleet supervisor: %s\n" % e)
+
+    def supervise(self):
+        """One supervision pass (normally run by the supervisor thread)."""
+        with self._lock:
+            self._rescale()
+            servers = list(self.servers)
+        for i, server in enumerate(servers):
+            if server.state == TikaServer.STOPPED:
+                if i < self._target:
+                    server.start()
+                continue
+            if server.exited():
+                if i >= self._target:
+                    # Was being scaled down anyway
+                    server.stop()
+                    continue
+                sys.stderr.write("Tika server on port %d exited (%s). "
+                                 "Restarting.\n" %
+                                 (server.port, server.proc.returncode))
+                self._restart(server)
+                continue
+            if server.state == TikaServer.STARTING:
+                if server.ready():
+                    with self._lock:
+                        server.state = TikaServer.LIVE
+                        self._lock.notify_all()
+                elif time.time() - server.started > self._starttimeout:
+                    sys.stderr.write("Tika server on port %d failed to "
+                                     "start. Restarting.\n" % server.port)
+                    self._restart(server)
+                continue
+            if (server.state == TikaServer.LIVE and self._maxrss and
+                    (rss_of(server.proc.pid) or 0) > self._maxrss):
+                sys.stderr.write("Tika server on port %d is over its RSS "
+                                 "limit. Recycling.\n" % server.port)
+                with self._lock:
+                    server.state = TikaServer.DRAINING
+            if (server.state == TikaServer.DRAINING and
+                    server.inflight <= 0):
+                server.stop()
+                if i < self._target:
+                    self.recycles += 1
+                    server.start()
+
+    def _restart(self, server):
+        server.stop()
+        self.restarts += 1
+        server.restarts += 1
+        server.start()
+
+    def _rescale(self):
+        """Set the target number of servers from the demand, draining any
+        beyond it. Called with the lock held."""
+        wanted = int(math.ceil(float(self._demand) / self._perserver))
+        wanted = max(self._minservers, min(self._maxservers, wanted))
+        if wanted >= self._target:
+            self._target = wanted
+            self._lowsince = None
+        elif self._lowsince is None:
+            self._lowsince = time.time()
+        elif time.time() - self._lowsince >= self._idletime:
+            self._target = wanted
+            self._lowsince = None
+        for server in self.servers[self._target:]:
+            if server.state in (TikaServer.LIVE, TikaServer.STARTING):
+                server.state = TikaServer.DRAINING
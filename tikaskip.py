@@ -0,0 +1,262 @@
+#!/usr/bin/env python2
+"""Learning which (host, MIME type) buckets are not worth sending to
+Apache Tika.
+
+Some sites serve documents which Tika can do nothing with, time after
+time: a council publishing only scanned PDFs, say, or a server whose
+"Word documents" are error pages. SkipLearner keeps a success rate per
+(host, canonical MIME type) of the documents actually converted, and once
+a bucket has been tried often enough with almost nothing to show for it,
+stops sending its documents, keeping the originals instead. One document
+in every probeevery of a skipped bucket is still sent, so that a site
+which starts publishing proper documents is noticed; and old observations
+are decayed away, so that the table follows such changes.
+
+The table is persisted across runs as a tab-separated file, which is also
+readable for review. A learner is safe to share between threads, and
+several processes may save to the same file: each save merges in what
+the others have saved since. Run as a script to list a saved table,
+least productive buckets first.
+
+Copyright 2014-2016 Tom Nicholls
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+
+#####
+#SETUP
+#####
+
+import sys
+import os
+import time
+import fcntl
+import thread
+import argparse
+import threading
+from urlparse import urlsplit
+
+_COLUMNS = ['host', 'mimetype', 'attempts', 'successes', 'bytes',
+            'skipped', 'lastprobe', 'rate', 'state']
+
+#####
+#UTILITY FUNCTIONS
+#####
+def url_host(url):
+    """Return the lower-cased host of url, or '' if it has none."""
+    try:
+        return (urlsplit(url).hostname or '').lower()
+    except (ValueError, AttributeError):
+        return ''
+
+#####
+#CLASSES
+#####
+
+class _Bucket(object):
+    __slots__ = ('attempts', 'successes', 'bytes', 'skipped', 'lastprobe',
+                 'sinceprobe')
+
+    def __init__(self, attempts=0.0, successes=0.0, bytes=0, skipped=0,
+                 lastprobe=0):
+        self.attempts = attempts
+        self.successes = successes
+        # Bytes sent to Tika, to show what an unproductive bucket costs
+        self.bytes = bytes
+        self.skipped = skipped
+        self.lastprobe = lastprobe
+        self.sinceprobe = 0
+
+class SkipLearner(object):
+    """Per-(host, MIME type) record of how often conversion succeeds,
+    deciding which documents to send to Tika.
+
+       filename: tab-separated file to load the table from (if it exists)
+           and to save() it to, or None to learn afresh every run;
+       minattempts: documents a bucket must have been tried on before it
+           can be skipped;
+       minrate: success rate below which a bucket is skipped;
+       probeevery: of the documents in a skipped bucket, one in this many
+           is sent anyway, to re-probe it;
+       reprobeafter: seconds after which a skipped bucket's next document
+           is always sent, however few have been seen since the last;
+       window: once a bucket's attempts reach this, its counts are halved,
+           so that old results are forgotten.
+
+       Saving merges the counts gathered since the last save into the
+       table on disk, under a lock on filename + '.lock', then takes the
+       merged table as its own, so that processes sharing a file learn
+       from each other."""
+    def __init__(self, filename=None, minattempts=20, minrate=0.05,
+                 probeevery=50, reprobeafter=7*24*3600, window=200):
+        self.filename = filename
+        self._minattempts = minattempts
+        self._minrate = minrate
+        self._probeevery = probeevery
+        self._reprobeafter = reprobeafter
+        self._window = window
+        self._buckets = {}
+        # Counts added since the last save, to merge into the file
+        self._deltas = {}
+        self._lock = threading.Lock()
+        if filename is not None and os.path.exists(filename):
+            self.load(filename)
+
+    @staticmethod
+    def _get(buckets, key):
+        try:
+            return buckets[key]
+        except KeyError:
+            b = buckets[key] = _Bucket()
+            return b
+
+    def _unproductive(self, b):
+        return (b.attempts >= self._minattempts and
+                b.successes < self._minrate * b.attempts)
+
+    def should_send(self, url, mimetype):
+        """Return True if the document at url, of canonical type mimetype,
+        should be converted, or False if it should be kept as it is. A
+        False is counted as a skip."""
+        key = (url_host(url), mimetype)
+        with self._lock:
+            b = self._buckets.get(key)
+            if b is None or not self._unproductive(b):
+                return True
+            b.sinceprobe += 1
+            if (b.sinceprobe >= self._probeevery or
+                    time.time() - b.lastprobe >= self._reprobeafter):
+                b.sinceprobe = 0
+                b.lastprobe = int(time.time())
+                self._get(self._deltas, key).lastprobe = b.lastprobe
+                return True
+            b.skipped += 1
+            self._get(self._deltas, key).skipped += 1
+            return False
+
+    def record(self, url, mimetype, success, size=0):
+        """Record the outcome of trying to convert a document of size
+        bytes: success is True if it gave usable text."""
+        key = (url_host(url), mimetype)
+        with self._lock:
+            b = self._get(self._buckets, key)
+            if b.attempts + 1 > self._window:
+                b.attempts /= 2.0
+                b.successes /= 2.0
+            b.attempts += 1
+            if success:
+                b.successes += 1
+            b.bytes += size
+            d = self._get(self._deltas, key)
+            d.attempts += 1
+            if success:
+                d.successes += 1
+            d.bytes += size
+
+    def rows(self):
+        """Return the table as a list of tuples in _COLUMNS order, least
+        productive (then most costly) buckets first."""
+        out = []
+        for (host, mimetype), b in self._buckets.iteritems():
+            rate = b.successes / b.attempts if b.attempts else 1.0
+            state = 'skip' if self._unproductive(b) else 'send'
+            out.append((host, mimetype, b.attempts, b.successes, b.bytes,
+                        b.skipped, b.lastprobe, rate, state))
+        out.sort(key=lambda r: (r[7], -r[4]))
+        return out
+
+    def export(self, f, skippedonly=False):
+        """Write the table to file object f as tab-separated text with a
+        header line, optionally only the buckets currently skipped."""
+        f.write('\t'.join(_COLUMNS) + '\n')
+        for row in self.rows():
+            if skippedonly and row[-1] != 'skip':
+                continue
+            f.write('\t'.join(['%g' % v if isinstance(v, float) else str(v)
+                               for v in row]) + '\n')
+
+    @staticmethod
+    def _read(filename):
+        """Return the buckets of a table saved by save() or export()."""
+        buckets = {}
+        with open(filename, 'rb') as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if not line or line.startswith('host\t'):
+                    continue
+                fields = line.split('\t')
+                buckets[(fields[0], fields[1])] = _Bucket(
+                    float(fields[2]), float(fields[3]), int(fields[4]),
+                    int(fields[5]), int(fields[6]))
+        return buckets
+
+    def load(self, filename):
+        """Merge in a table saved by save() or export()."""
+        buckets = self._read(filename)
+        with self._lock:
+            self._buckets.update(buckets)
+
+    def _merge(self, buckets):
+        """Add the counts gathered since the last save to buckets (read
+        from disk), halving them as record() does."""
+        for key, d in self._deltas.iteritems():
+            b = self._get(buckets, key)
+            b.attempts += d.attempts
+            b.successes += d.successes
+            while b.attempts > self._window:
+                b.attempts /= 2.0
+                b.successes /= 2.0
+            b.bytes += d.bytes
+            b.skipped += d.skipped
+            b.lastprobe = max(b.lastprobe, d.lastprobe)
+
+    def save(self, filename=None):
+        """Merge the counts gathered since the last save into the table in
+        filename (default: the one it was loaded from), replacing it
+        atomically, and adopt the merged table."""
+        if filename is None:
+            filename = self.filename
+        if filename is None:
+            return
+        with self._lock:
+            with open(filename + '.lock', 'a') as lockf:
+                fcntl.lockf(lockf, fcntl.LOCK_EX)
+                buckets = {}
+                if os.path.exists(filename):
+                    buckets = self._read(filename)
+                self._merge(buckets)
+                for key, b in buckets.iteritems():
+                    if key in self._buckets:
+                        b.sinceprobe = self._buckets[key].sinceprobe
+                self._buckets = buckets
+                tmpfn = '%s.%d.%d.tmp' % (filename, os.getpid(),
+                                          thread.get_ident())
+                with open(tmpfn, 'wb') as f:
+                    self.export(f)
+                os.rename(tmpfn, filename)
+                self._deltas = {}
+
+#####
+#MAIN
+#####
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='List a table of Tika '
+        'success rates per host and MIME type, as learnt by warctika, '
+        'least productive first.')
+    parser.add_argument('tablefn', help='Table saved by a SkipLearner.')
+    parser.add_argument('-s', '--skipped-only', action='store_true',
+                        help='Only list buckets currently being skipped.')
+    args = parser.parse_args()
+    SkipLearner(args.tablefn).export(sys.stdout, args.skipped_only)
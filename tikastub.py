@@ -0,0 +1,142 @@
+#!/usr/bin/env python2
+"""A stand-in for Apache Tika's JAX-RS server, for testing tikaclient,
+tikafleet and warctika without a JVM.
+
+It answers GET /tika (as a liveness check), PUT /tika with the runs of
+printable ASCII found in the document, and PUT /rmeta/text with the same
+for each member of a zip archive, in Tika's JSON format. Options make it
+slow, fail, leak memory or crash, to exercise the callers' handling of
+misbehaving servers.
+
+Copyright 2014-2016 Tom Nicholls
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+
+#####
+#SETUP
+#####
+
+import os
+import re
+import json
+import time
+import zipfile
+import argparse
+import threading
+import BaseHTTPServer
+import SocketServer
+from cStringIO import StringIO
+
+_printable_re = re.compile(r'[\x20-\x7e\t\r\n]{4,}')
+
+#####
+#UTILITY FUNCTIONS
+#####
+def stub_text(body):
+    """Return the 'extracted text' of a document: its runs of four or
+    more printable ASCII characters."""
+    return '\n'.join(_printable_re.findall(body))
+
+#####
+#CLASSES
+#####
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, code, body, ctype='text/plain; charset=UTF-8'):
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/tika':
+            self._reply(200, 'This is Tika Server (stub). Please PUT\n')
+        else:
+            self._reply(404, 'Not found\n')
+
+    def do_PUT(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with server.lock:
+            server.docs += 1
+            docs = server.docs
+        args = server.args
+        if args.leak:
+            server.leaked.append(' ' * args.leak)
+        if args.crash_after and docs >= args.crash_after:
+            os._exit(1)
+        if args.delay:
+            time.sleep(args.delay)
+        if args.fail_every and docs % args.fail_every == 0:
+            self._reply(422, 'Unprocessable (stub)\n')
+            return
+        path = self.path.rstrip('/')
+        if path == '/tika':
+            self._reply(200, stub_text(body))
+        elif path == '/rmeta/text':
+            try:
+                zf = zipfile.ZipFile(StringIO(body))
+            except zipfile.BadZipfile:
+                self._reply(422, 'Not a zip archive\n')
+                return
+            metadata = [{'Content-Type': 'application/zip'}]
+            for name in zf.namelist():
+                metadata.append({'X-TIKA:embedded_resource_path': '/'+name,
+                                 'X-TIKA:content':
+                                     stub_text(zf.read(name)).decode('ascii')})
+            self._reply(200, json.dumps(metadata), 'application/json')
+        else:
+            self._reply(404, 'Not found\n')
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, args):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _Handler)
+        self.args = args
+        self.lock = threading.Lock()
+        self.docs = 0
+        self.leaked = []
+
+#####
+#ARGUMENT PARSER
+#####
+
+parser = argparse.ArgumentParser(description='Stub Tika server for tests.')
+parser.add_argument('--host', default='127.0.0.1',
+                    help='Address to listen on. Default: 127.0.0.1.')
+parser.add_argument('--port', type=int, default=9998,
+                    help='Port to listen on. Default: 9998.')
+parser.add_argument('--delay', type=float, default=0,
+                    help='Seconds to take over each document.')
+parser.add_argument('--fail-every', type=int, default=0, metavar='N',
+                    help='Answer every Nth document with a 422.')
+parser.add_argument('--crash-after', type=int, default=0, metavar='N',
+                    help='Exit abruptly on receiving the Nth document.')
+parser.add_argument('--leak', type=int, default=0, metavar='BYTES',
+                    help='Leak this much memory per document.')
+
+#####
+#MAIN
+#####
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    StubServer((args.host, args.port), args).serve_forever()
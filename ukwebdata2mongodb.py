@@ -2,37 +2,202 @@
 import csv
 import sys
 import os
-from multiprocessing import Pool
-from warc2mongodb import *
+import signal
+import argparse
+from warc2mongodb import (md5_hash, warc_to_text, init_worker,
+                          get_content_filter_keepset, load_stored_keys,
+                          resolve_revisits, get_mongo_client, TextCache)
 from functools import partial
-from itertools import imap
-import pprint
-import pymongo
+from warcpool import (run_pool, run_serial, load_costs, parse_size,
+                      DigestSet)
+from warcmonitor import RecordMonitor
+from warcsample import RecordSampler, read_index
+
+parser = argparse.ArgumentParser(description='Extract text from a list of '
+           'WARC files (read from stdin) into MongoDB, using a pool of '
+           'worker processes.')
+parser.add_argument('-j', '--workers', type=int, default=8,
+                    help='Number of worker processes. Default: 8.')
+parser.add_argument('--pipeline', type=int, default=0, metavar='N',
+                    help='Process files one at a time, each with a reader '
+                         'process and N extractor processes, instead of '
+                         'one file per worker. Suits a few large files.')
+parser.add_argument('--order', choices=['size', 'cost', 'list'],
+                    default='size',
+                    help='Scheduling order: largest file first (size), '
+                         'largest index-estimated cost first (cost, needs '
+                         '--cost-file) or as listed (list). Default: size.')
+parser.add_argument('--cost-file', metavar='costfn',
+                    help='Tab-separated filename/cost table for --order '
+                         'cost. Files missing from it are costed by size.')
+parser.add_argument('--maxtasksperchild', type=int, default=None,
+                    help='Recycle each worker after this many files.')
+parser.add_argument('--max-rss', default=None,
+                    help='Recycle a worker once its RSS exceeds this size '
+                         '(e.g. 2G) after finishing a file.')
+parser.add_argument('--filter-file',
+                    default='output/nodemap-sorted-filtered.tsv',
+                    help='TSV whose first column lists the URLs to keep.')
+parser.add_argument('--filter-cache', metavar='cachefn',
+                    help='Keep the prepared filter set in this file, and '
+                         'map it from there (instead of re-reading the '
+                         'filter file) while it is newer than the filter '
+                         'file.')
+parser.add_argument('--incremental', action='store_true',
+                    help='Skip documents whose URL and payload digest are '
+                         'already stored in MongoDB, e.g. when re-running '
+                         'after a failure or over an extended crawl.')
+parser.add_argument('--sink-cache', metavar='cachefn',
+                    help='With --incremental, map the set of stored '
+                         'documents from this file if it exists, instead '
+                         'of reading it from MongoDB, and otherwise save it '
+                         'there. A stale cache only means that documents '
+                         'stored since it was made are processed again.')
+parser.add_argument('--sample', type=float, default=None, metavar='rate',
+                    help='Process only this fraction of the documents (e.g. '
+                         '0.01), picked by a hash of their URLs, so that '
+                         'the same sample is drawn every run.')
+parser.add_argument('--sample-salt', default='', metavar='salt',
+                    help='With --sample, a string mixed into the hash, to '
+                         'draw a different sample.')
+parser.add_argument('--sample-stratify', choices=['host', 'mimetype'],
+                    help='With --sample, take the same number of documents '
+                         'from each host or MIME type. Needs '
+                         '--sample-index.')
+parser.add_argument('--sample-index', metavar='indexfn',
+                    help='With --sample, an index of the files from '
+                         'listwarccts.py --http, used to stratify and to '
+                         'seek straight to the records sampled.')
+parser.add_argument('--normalise', action='store_true',
+                    help='Normalise the text of converted documents '
+                         '(collapsing whitespace, dropping control '
+                         'characters and repeated page headers and '
+                         'footers), reporting the saving per MIME type.')
+parser.add_argument('--duplicates', choices=['reuse', 'skip'],
+                    help='Recognise HTML bodies identical to one recently '
+                         'seen by the same worker by their hash, and store '
+                         'the text already extracted from it (reuse) or '
+                         'nothing (skip) instead of parsing them again.')
+parser.add_argument('--duplicate-entries', type=int, default=10000,
+                    metavar='N',
+                    help='With --duplicates, number of bodies each worker '
+                         'remembers. Default: 10000.')
+parser.add_argument('--duplicate-memory', default='64M', metavar='size',
+                    help='With --duplicates, approximate size of the text '
+                         'each worker keeps. Default: 64M.')
+parser.add_argument('--slow-log', metavar='logfn',
+                    help='Log records taking longer than --slow-threshold, '
+                         'with the time spent in each stage, to this file.')
+parser.add_argument('--slow-threshold', type=float, default=5.0,
+                    help='Seconds a record must take to be logged as slow. '
+                         'Default: 5.')
+parser.add_argument('--profile-dir', metavar='dir',
+                    help='Profile each file with cProfile, writing the '
+                         'stats to this directory.')
+parser.add_argument('--mem-every', type=int, default=0, metavar='N',
+                    help='Log memory use (top allocation sites if '
+                         'tracemalloc is available, otherwise RSS) every N '
+                         'records.')
+parser.add_argument('--dump-on-usr1', action='store_true',
+                    help='On SIGUSR1, workers write the record they are '
+                         'processing and their stacks to stderr.')
+parser.add_argument('--skip', type=int, default=0,
+                    help='Skip the first N files of the list, e.g. to '
+                         'avoid re-processing after an error.')
+args = parser.parse_args()
+
+def read_filter_file(fn):
+    with open(fn, 'rb') as f:
+        for line in csv.reader(f, dialect='excel-tab'):
+            yield md5_hash(unicode(line[0].rstrip()))
 
 sys.stderr.write("Preparing content filter set...")
-s = set()
-with open('output/nodemap-sorted-filtered.tsv', 'rb') as f:
-    for line in csv.reader(f, dialect='excel-tab'):
-        s.update({md5_hash(unicode(line[0].rstrip()))})
-sys.stderr.write(" done.\n")
+if (args.filter_cache and os.path.exists(args.filter_cache) and
+        os.path.getmtime(args.filter_cache) >=
+        os.path.getmtime(args.filter_file)):
+    s = DigestSet.load(args.filter_cache)
+else:
+    s = DigestSet.from_iterable(read_filter_file(args.filter_file))
+    if args.filter_cache:
+        s.save(args.filter_cache)
+sys.stderr.write(" done (%d URLs).\n" % len(s))
 
-files = [infn.rstrip() for infn in sys.stdin]
+stored = None
+if args.incremental:
+    sys.stderr.write("Reading documents already stored...")
+    if args.sink_cache and os.path.exists(args.sink_cache):
+        stored = DigestSet.load(args.sink_cache)
+    else:
+        stored = load_stored_keys()
+        if args.sink_cache:
+            stored.save(args.sink_cache)
+    sys.stderr.write(" done (%d documents).\n" % len(stored))
 
-mongoclient = pymongo.mongo_client.MongoClient()
+sampler = None
+if args.sample is not None:
+    index = None
+    if args.sample_index:
+        index = read_index(args.sample_index)
+    elif args.sample_stratify:
+        sys.exit("--sample-stratify requires --sample-index")
+    sampler = RecordSampler(args.sample, args.sample_salt,
+                            args.sample_stratify, index)
 
-# XXX Avoid re-processing in the event of errors
-for i in xrange(243):
-    files.pop(0)
+files = [infn.rstrip() for infn in sys.stdin][args.skip:]
 
-p = Pool(8)
-process = partial(warc_to_text, discardfilter=get_content_filter_keepset(s))
+costs = None
+if args.cost_file:
+    costs = load_costs(args.cost_file)
+elif args.order == 'cost':
+    sys.exit("--order cost requires --cost-file")
 
+monitor = None
+if (args.slow_log or args.profile_dir or args.mem_every or
+        args.dump_on_usr1):
+    monitor = RecordMonitor(args.slow_log, args.slow_threshold,
+                            args.profile_dir, args.mem_every,
+                            signal.SIGUSR1 if args.dump_on_usr1 else None)
 
-p.map(process, files, 1)
-#for tup in imap(process, files):
-#for tup in p.imap(process, files):
-#    url, text = tup
-#    mongoclient.warctext.bs.save({'_id' : url, 'value' :text})
-sys.stderr.write("Done!\n")
+textcache = None
+if args.duplicates:
+    textcache = TextCache(args.duplicate_entries,
+                          parse_size(args.duplicate_memory),
+                          skip=(args.duplicates == 'skip'))
 
+# The filter and stored sets, and the sampler's index, reach each worker
+# once, through the initializer, rather than with every file; so does the
+# (empty) text cache, which each worker then keeps across its files.
+discardfilter = get_content_filter_keepset(s)
+initargs = (discardfilter, None, 'http://localhost:9998/tika', monitor,
+            stored, sampler, textcache)
 
+# Revisits of documents in other files are given their text once all the
+# files are done, wherever their first captures were
+revisits = []
+def collect(result):
+    revisits.extend(result.get('revisits', ()))
+
+if args.pipeline:
+    from warcpipeline import pipeline_warc_to_text
+    failed = run_serial(partial(pipeline_warc_to_text,
+                                extractors=args.pipeline,
+                                normalise=args.normalise),
+                        files, order=args.order, costs=costs,
+                        initializer=init_worker, initargs=initargs,
+                        collect=collect)
+else:
+    failed = run_pool(partial(warc_to_text, normalise=args.normalise),
+                      files, processes=args.workers,
+                      order=args.order, costs=costs,
+                      maxtasksperchild=args.maxtasksperchild,
+                      maxrss=parse_size(args.max_rss),
+                      initializer=init_worker, initargs=initargs,
+                      collect=collect)
+if revisits:
+    sys.stderr.write("Resolving %d revisits..." % len(revisits))
+    counts = resolve_revisits(get_mongo_client(), revisits, discardfilter,
+                              textcache)
+    sys.stderr.write(" done: %s.\n" % sorted(counts.items()))
+if failed:
+    sys.stderr.write("Failed files:\n"+"\n".join(failed)+"\n")
+sys.stderr.write("Done!\n")
@@ -30,62 +30,91 @@ import sys
 import os
 import traceback
 import re
-import requests
 #import html2text
-import pymongo
 import argparse
-from bs4 import UnicodeDammit
-from bs4 import BeautifulSoup
-from readability.readability import Document as ReadabilityDocument
 #from warctika import *
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from functools import partial
 # These can both be installed with 'pip install warctools'. Beware that there
 # are several old versions floating around under different names in the index.
 from hanzo.warctools import WarcRecord
-from hanzo.httptools import RequestMessage, ResponseMessage
 import hashlib
+import base64
+from warcreader import (open_archive, iter_lazy_records, iter_records_at,
+                        can_seek_records)
+from tikaclient import TikaClient
+import localextract
+from pdfscreen import screen_pdf
+from warctika import TikaProvenance
+from warcmonitor import NULL_MONITOR
+from textnorm import NormaliseStats
+from warcpool import DigestSet
+# bs4, lxml, readability and pymongo are slow to import, so are imported
+# where they are first used (or by init_worker), not here.
 
 #####
 #UTILITY FUNCTIONS AND CLASSES
 #####
-def parse_http_response_charset(record):
-    """Parses the payload of an HTTP 'response' record, returning code,
-    content type, declared character set and body.
-
-    Adapted from github's internetarchive/warctools hanzo/warcfilter.py,
-    commit 1850f328e31e505569126b4739cec62ffa444223. MIT licenced."""
-    message = ResponseMessage(RequestMessage())
-    remainder = message.feed(record.content[1])
-    message.close()
-    if remainder or not message.complete():
-        if remainder:
-            print 'trailing data in http response for', record.url
-        if not message.complete():
-            print 'truncated http response for', record.url
-    header = message.header
-
-    mime_type = [v for k,v in header.headers if k.lower() == b'content-type']
-    charset = None
-    if mime_type:
-        match = re.search(r'charset=(\S+)', mime_type[0], re.I)
-        if match:
-            charset = match.group(1).lower()
-        mime_type = mime_type[0].split(b';')[0]
-    else:
-        mime_type = None
-
-    return header.code, mime_type, charset, message.get_body()
-
-def tikaise(mimetype, body, url='http://localhost:9998/tika'):
+_tikaclients = {}
+_mongoclients = {}
+# State set up once per pool worker by init_worker()
+_worker = {}
+
+def get_tika_client(url='http://localhost:9998/tika'):
+    """Return this process's shared TikaClient for a given Tika URL,
+    creating it with default timeouts and circuit breaker if necessary."""
+    if url not in _tikaclients:
+        _tikaclients[url] = TikaClient(url)
+    return _tikaclients[url]
+
+def get_mongo_client(host=None):
+    """Return this process's shared MongoClient for host (default:
+    localhost on the standard port), creating it if necessary."""
+    if host not in _mongoclients:
+        import pymongo
+        _mongoclients[host] = pymongo.mongo_client.MongoClient(host)
+    return _mongoclients[host]
+
+def init_worker(discardfilter=None, mongohost=None,
+                tikaurl='http://localhost:9998/tika', monitor=None,
+                stored=None, sampler=None, textcache=None):
+    """Pool initializer (see warcpool.run_pool) doing one-time setup in
+    each worker process: import the HTML libraries, and connect to MongoDB
+    and Tika. discardfilter, monitor, stored, sampler and textcache become
+    the defaults for warc_to_text, so that they, and any large set the
+    filter refers to, are inherited over fork() once per worker instead of
+    being pickled with every task; textcache is then shared by all the
+    files the worker processes."""
+    # Clients inherited from the parent share its sockets; start afresh.
+    _tikaclients.clear()
+    _mongoclients.clear()
+    import lxml.etree
+    import bs4
+    import readability.readability
+    _worker['discardfilter'] = discardfilter
+    _worker['monitor'] = monitor
+    if monitor is not None:
+        monitor.install_handler()
+    _worker['stored'] = stored
+    _worker['sampler'] = sampler
+    _worker['textcache'] = textcache
+    _worker['mongoclient'] = get_mongo_client(mongohost)
+    _worker['tikaclient'] = get_tika_client(tikaurl)
+
+def tikaise(mimetype, body, url='http://localhost:9998/tika', client=None):
     """Process a file through Apache Tika, reducing to plain text
        if possible.
 
        :mimetype: an HTTP Content-Type
        :body:     the document body
        :url:      the Tika server's URL (default: http://localhost:9998/tika)
+       :client:   a tikaclient.TikaClient to use instead of the default
+                  client for url. Raises tikaclient.TikaException on
+                  timeouts or while Tika is unavailable.
     """
-    resp = requests.put(url, data=body, headers={'Content-Type': mimetype}) 
+    if client is None:
+        client = get_tika_client(url)
+    resp = client.put(body, headers={'Content-Type': mimetype})
     if resp.status_code != 200:
         raise Exception("Bad response code from Tika ("+
                         str(resp.status_code)+") "+
@@ -118,6 +147,12 @@ _mimemappings=[
     (r'^acrobat$',
         'application/pdf')
     ]
+_mimedispatch = [(re.compile(pattern, re.IGNORECASE), canonical)
+                 for pattern, canonical in _mimemappings]
+# Content-Type -> check_mimetype() result. Crawls have few distinct types,
+# but cap it anyway against servers inventing them.
+_mimecache = {}
+_MIMECACHE_MAX = 10000
 
 def check_mimetype(mimetype):
     """Return a canonical mimetype if mimetype matches our list to process,
@@ -127,17 +162,128 @@ def check_mimetype(mimetype):
         # Note: we can make Tika guess the Content-Type without assistance
         # by setting it to the root type 'application/octet-stream'.
         # return 'application/octet-stream'
-    if mimetype is not None:
-        for tup in _mimemappings:
-            if re.search(tup[0], mimetype, re.IGNORECASE):
-                if tup[1] is None:
-                    return mimetype
-                return tup[1]
-    return False
+    if mimetype is None:
+        return False
+    try:
+        return _mimecache[mimetype]
+    except KeyError:
+        pass
+    result = False
+    for regex, canonical in _mimedispatch:
+        if regex.search(mimetype):
+            result = canonical if canonical is not None else mimetype
+            break
+    if len(_mimecache) >= _MIMECACHE_MAX:
+        _mimecache.clear()
+    _mimecache[mimetype] = result
+    return result
 
 def md5_hash(s):
     return hashlib.md5(s).digest()
 
+def payload_digest(body):
+    """Return a WARC-Payload-Digest style digest ('sha1:' and base32) of
+    body, for records which don't carry one."""
+    return 'sha1:' + base64.b32encode(hashlib.sha1(body).digest())
+
+def sink_key(url, digest):
+    """Return the key under which a stored (URL, payload digest) pair is
+    looked up when skipping unchanged documents."""
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    return md5_hash(url + '\0' + str(digest))
+
+def load_stored_keys(mongoclient=None, batchsize=10000):
+    """Return a warcpool.DigestSet of the sink_key() of every document in
+    the sink stored with its payload digest, read with a single projected
+    scan of the collection rather than a query per record."""
+    if mongoclient is None:
+        mongoclient = get_mongo_client()
+    cursor = mongoclient.warctext.bs.find({'digest': {'$exists': True}},
+                                          {'url': 1, 'digest': 1, '_id': 0})
+    cursor.batch_size(batchsize)
+    return DigestSet.from_iterable(sink_key(doc['url'], doc['digest'])
+                                   for doc in cursor)
+
+def sample_counter(sampler, tiercounts):
+    """Return a function of (url, mimetype) for doc_from_warc's sample,
+    asking sampler and counting the documents left out in tiercounts."""
+    def sample(url, mimetype):
+        if sampler(url, mimetype):
+            return True
+        tiercounts['sample-skipped'] += 1
+        return False
+    return sample
+
+def stored_skipper(stored, tiercounts=None):
+    """Return a function of (url, digest) for doc_from_warc's skip,
+    which is True for pairs whose sink_key() is in stored, counting them
+    in tiercounts if given."""
+    def skip(url, digest):
+        if sink_key(url, digest) in stored:
+            if tiercounts is not None:
+                tiercounts['unchanged-skipped'] += 1
+            return True
+        return False
+    return skip
+
+class TextCache(object):
+    """A bounded LRU mapping a hash of each HTML body (and its charset)
+    to the text reduce_doc extracted from it, so that byte-identical
+    copies served under other URLs aren't decoded and parsed again.
+
+       maxentries: number of bodies to remember;
+       maxbytes: approximate size of cached text to keep, in characters;
+       skip: if True, duplicates are not stored at all (and no text is
+           kept), rather than stored again with the cached text."""
+    def __init__(self, maxentries=10000, maxbytes=64*1024*1024, skip=False):
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self.skip = skip
+        self.size = 0
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def key(body, charset):
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        h = hashlib.md5(body)
+        h.update('\0' + str(charset))
+        return h.digest()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, key):
+        """Return the text cached for key, making it the most recently
+        used, or raise KeyError."""
+        text = self._entries.pop(key)
+        self._entries[key] = text
+        return text
+
+    def __setitem__(self, key, text):
+        if self.skip:
+            text = None
+        if key in self._entries:
+            self.size -= len(self._entries.pop(key) or '')
+        self._entries[key] = text
+        self.size += len(text or '')
+        while self._entries and (len(self._entries) > self.maxentries or
+                                 self.size > self.maxbytes):
+            _, old = self._entries.popitem(last=False)
+            self.size -= len(old or '')
+
+    @staticmethod
+    def report(tiercounts):
+        """Return a line giving the hit rate recorded in tiercounts."""
+        checked = tiercounts.get('duplicate-checked', 0)
+        hits = (tiercounts.get('duplicate-reused', 0) +
+                tiercounts.get('duplicate-skipped', 0))
+        return ("%d of %d HTML bodies were duplicates (%.1f%%), %d bytes not "
+                "parsed" % (hits, checked,
+                            100.0 * hits / checked if checked else 0.0,
+                            tiercounts.get('duplicate-bytes', 0)))
+
 def content_filter_set(s, mode, url, code, content):
     if mode == 'keep':
         return md5_hash(url) not in s
@@ -152,13 +298,54 @@ def get_content_filter_keepset(s):
 def get_content_filter_dropset(s):
     return partial(content_filter_set, s, 'drop')
 
-def doc_from_warc(infn, gzip='auto'):
-    """Generator to process a WARC at a given infn."""
+def doc_from_warc(infn, gzip='auto', wanted=None, provenance=None,
+                  skip=None, sample=None, offsets=None, unresolved=None):
+    """Generator to process a WARC at a given infn, yielding (url,
+       mimetype, body, httpcode, charset, digest) tuples, where digest is
+       the record's payload digest. An identical-payload-digest revisit
+       record is yielded like a response, with the body of the record it
+       refers to if that is earlier in the same file.
+
+       :wanted: optional function of (url, httpcode, mimetype), called with
+                what can be learnt from the record's headers. If it returns
+                False the record is skipped without reading its body.
+       :provenance: optional warctika.TikaProvenance, told about the file's
+                conversion records as they are read. Records
+                which a conversion record refers to are then not yielded:
+                those seen before their conversion, and (as each document
+                is held back until the next record has been read) those
+                immediately followed by it. Nor are originals marked as
+                ones Tika failed on (see TikaProvenance.already_failed).
+       :skip:   optional function of (url, digest), returning True for
+                records not to yield (such as those already stored). It is
+                called before the body is read if the record carries a
+                WARC-Payload-Digest, otherwise with one computed from the
+                body.
+       :sample: optional function of (url, mimetype), such as a
+                warcsample.RecordSampler, returning True for the documents
+                to yield. It is called before the body is read.
+       :offsets: optional sorted list of the offsets of the only records
+                to read (see warcsample.RecordSampler.offsets_for), which
+                are seeked to. Ignored for .warc.zst files, whose offsets
+                are not file positions.
+       :unresolved: optional function of (url, httpcode, mimetype,
+                digest), called for each revisit (which would otherwise
+                be yielded) whose first capture is not in the file."""
     # These are objects of type RecordStream (or a subclass), unlike with
     # the IA library
-    inwf = WarcRecord.open_archive(infn, mode='rb', gzip=gzip)
+    inwf = open_archive(infn, gzip=gzip)
     sys.stderr.write("Processing "+str(infn)+"\n")
-    for record in inwf:
+    if offsets is not None and can_seek_records(inwf):
+        records = iter_records_at(inwf, offsets)
+    else:
+        records = iter_lazy_records(inwf)
+    # (record ID, document) held back in case a conversion of it follows
+    held = None
+    # Record ID -> offset of responses which revisits may refer to, and a
+    # second stream to read them from
+    firsts = {}
+    lookup = None
+    for record in records:
 #                print "\nStarting record: "+str(record.url)
         try:
             if record.get_header('WARC-Segment-Number'):
@@ -172,25 +359,104 @@ def doc_from_warc(infn, gzip='auto'):
             # output from WarcTika, which are in that format.
             # TODO: generalise this.
             # We also handle HTTP response records.
+            if provenance is not None:
+                if record.type == WarcRecord.CONVERSION:
+                    refersto = record.get_header(WarcRecord.REFERS_TO)
+                    provenance.add_conversion(refersto)
+                    if held is not None and held[0] == refersto:
+                        held = None
+                elif (record.id in provenance.converted or
+                      provenance.already_failed(record)):
+                    continue
             if (record.type == WarcRecord.RESPONSE and
                   record.url.startswith('http')):
-                httpcode, mimetype, charset, body = parse_http_response_charset(record)
+                digest = record.get_header(WarcRecord.PAYLOAD_DIGEST)
+                if digest is not None:
+                    firsts[record.id] = record.offset
+                if wanted is not None or sample is not None:
+                    httpcode, _ = record.http_headers()
+                    mimetype, _ = record.http_content_type()
+                    if (sample is not None and
+                            not sample(record.url, mimetype)):
+                        continue
+                    if (wanted is not None and
+                            not wanted(record.url, httpcode, mimetype)):
+                        continue
+                if (skip is not None and digest is not None and
+                        skip(record.url, digest)):
+                    continue
+                httpcode, mimetype, charset, body = record.http_response()
+
+            elif (record.type == WarcRecord.REVISIT and
+                  record.url.startswith('http') and
+                  str(record.get_header(WarcRecord.PROFILE)).endswith(
+                      'identical-payload-digest')):
+                # The block holds only the HTTP headers; the payload is
+                # that of the capture referred to
+                if wanted is not None or sample is not None:
+                    httpcode, _ = record.http_headers()
+                    mimetype, _ = record.http_content_type()
+                    if (sample is not None and
+                            not sample(record.url, mimetype)):
+                        continue
+                    if (wanted is not None and
+                            not wanted(record.url, httpcode, mimetype)):
+                        continue
+                digest = record.get_header(WarcRecord.PAYLOAD_DIGEST)
+                if (skip is not None and digest is not None and
+                        skip(record.url, digest)):
+                    continue
+                httpcode, mimetype, charset, _ = record.http_response()
+                body = None
+                offset = firsts.get(record.get_header(WarcRecord.REFERS_TO))
+                if offset is not None:
+                    if lookup is None:
+                        lookup = open_archive(infn, gzip=gzip)
+                    if can_seek_records(lookup):
+                        for first in iter_records_at(lookup, [offset]):
+                            body = first.http_response()[3]
+                if body is None:
+                    if unresolved is not None:
+                        unresolved(record.url, httpcode, mimetype, digest)
+                    continue
 
             elif (record.type == WarcRecord.RESOURCE
                   or record.type == WarcRecord.CONVERSION):
-                mimetype, body = record.content
                 httpcode = 200 # "Success" for stored content
                 charset = None # Not recorded
-                
+                if (sample is not None and
+                        not sample(record.url, record.content_type)):
+                    continue
+                if (wanted is not None and
+                        not wanted(record.url, httpcode, record.content_type)):
+                    continue
+                digest = record.get_header(WarcRecord.PAYLOAD_DIGEST)
+                if (skip is not None and digest is not None and
+                        skip(record.url, digest)):
+                    continue
+                mimetype, body = record.content
+
             # If 'metadata', 'request', 'revisit', 'continuation',
             # or something exotic, we can't do anything interesting
             elif (record.type == WarcRecord.METADATA
                   or record.type == WarcRecord.WARCINFO
-                  or record.type == WarcRecord.REQUEST):
+                  or record.type == WarcRecord.REQUEST
+                  or record.type == WarcRecord.REVISIT):
                 continue
             else:
                 sys.stderr.write("Can't handle"+str(record.type)+", "+str(record.url))
-            yield (record.url, mimetype, body, httpcode, charset)
+                continue
+            if digest is None:
+                digest = payload_digest(body)
+                if skip is not None and skip(record.url, digest):
+                    continue
+            doc = (record.url, mimetype, body, httpcode, charset, digest)
+            if provenance is None:
+                yield doc
+                continue
+            if held is not None:
+                yield held[1]
+            held = (record.id, doc)
         except Exception:
             # General catch to avoid multiprocessing taking down the whole job
             # for one bogus record
@@ -198,8 +464,25 @@ def doc_from_warc(infn, gzip='auto'):
                              +" from file "+infn+":\n")
             traceback.print_exc()
             sys.stderr.write("Continuing.\n\n\n")
+    if held is not None:
+        yield held[1]
+    if lookup is not None:
+        lookup.close()
     inwf.close()
-    
+
+def is_textish(mimetype):
+    """True if mimetype is vaguely text-y: something we can store as
+       text, perhaps after reducing its markup."""
+    return ('xml' in mimetype or 'html' in mimetype
+            or mimetype.startswith('text/'))
+
+def doc_wanted(url, httpcode, mimetype):
+    """Return True if a record with this mimetype could result in stored
+       text, either directly or after Tika/local extraction. Used to skip
+       other records without reading their bodies."""
+    if mimetype is None:
+        return False
+    return bool(check_mimetype(mimetype)) or is_textish(mimetype)
 
 def doc_to_unicode(body, charset):
     if charset is None:
@@ -216,6 +499,7 @@ def doc_to_unicode(body, charset):
         # This turns out to be computationally expensive, though
         # necessary for HTML2text and also useful for
         # standardization in the database
+        from bs4 import UnicodeDammit
         dammit = UnicodeDammit(body)
         body = dammit.unicode_markup
 #           if dammit.contains_replacement_characters:
@@ -224,6 +508,7 @@ def doc_to_unicode(body, charset):
 
 
 def bs_html_to_better_text(body, bsparser='lxml'):
+    from bs4 import BeautifulSoup
     soup = BeautifulSoup(body, bsparser)
     # kill all script and style elements, to prevent dross ending up
     # in the output
@@ -233,75 +518,400 @@ def bs_html_to_better_text(body, bsparser='lxml'):
 
 
 def rb_html_to_text(body):
+    from readability.readability import Document as ReadabilityDocument
     return bs_html_to_better_text(ReadabilityDocument(body).summary())
 
 
-def warc_to_text(infn, discardfilter=get_content_filter_dropset({}),
-                 html_to_text=bs_html_to_better_text,
-                 gzi='auto'):
-    """Process a WARC at a given infn to (url, text) tuples."""
-    mongoclient = pymongo.mongo_client.MongoClient()
-    for (url, mimetype, body, httpcode, charset) in doc_from_warc(infn):
-        # The input data have already been processed through Apache
-        # Tika during the fetch process to minimse storage space, but
-        # short text output resulted in a retention of the original
-        # document to avoid data loss with image-based PDFs.
-        # For dealing with text only processing, we muust do our best
-        # come what may.
-        # So, canonicalise the mimetype using warctika, then
-        # if PDFish/Wordish, tikaise without benefit of clergy.
+def reduce_doc(url, mimetype, body, httpcode, charset,
+               discardfilter=get_content_filter_dropset({}),
+               html_to_text=bs_html_to_better_text, textcache=None,
+               tiercounts=None):
+    """Reduce a (possibly already Tikaised) document to the text to store,
+    returning None if it is filtered out or not text-y. With a TextCache,
+    an HTML body already seen gives the text cached for it (or None, if
+    the cache skips duplicates) without being parsed again, counted in
+    tiercounts if given."""
+    # It's possible that the record is various kinds of junk; if
+    # so, don't store it
+    if discardfilter(url, httpcode, mimetype):
+        return None
+
+    # If its not vaguely text-y, we don't want to know
+    if not is_textish(mimetype):
+        return None
+
+    if textcache is None or not ('xml' in mimetype or 'html' in mimetype):
+        return _body_to_text(mimetype, body, charset, html_to_text)
+
+    if tiercounts is None:
+        tiercounts = defaultdict(int)
+    tiercounts['duplicate-checked'] += 1
+    key = textcache.key(body, charset)
+    try:
+        text = textcache[key]
+    except KeyError:
+        text = _body_to_text(mimetype, body, charset, html_to_text)
+        textcache[key] = text
+        return text
+    tiercounts['duplicate-bytes'] += len(body)
+    if textcache.skip:
+        tiercounts['duplicate-skipped'] += 1
+        return None
+    tiercounts['duplicate-reused'] += 1
+    return text
+
+
+def _body_to_text(mimetype, body, charset, html_to_text):
+    """Decode a text-y body, and reduce it to text if HTMLish, returning
+    None if that fails."""
+    try:
+        body = doc_to_unicode(body, charset)
+    except Exception:
+        # Sometimes this just doesn't work. Carry on anyway if possible.
+        pass
 
+    # If HTMLish, make it textish
+    if 'xml' in mimetype or 'html' in mimetype:
         try:
-            tikamimetype = check_mimetype(mimetype)
-            if tikamimetype:
-                try:
-                    mimetype, body = tikaise(tikamimetype, body)
-                except Exception:
-                    # Can't be Tika-d - abort
-                    continue
+            body = html_to_text(body)
+            mimetype = "text/plain"
+        except Exception as e:
+            # This is variably successful with random input
+            # if it fails, give up
+            return None
+
+    return body
 
-            # It's possible that the record is various kinds of junk; if
-            # so, don't store it
-            if discardfilter(url, httpcode, mimetype):
-                continue
 
-            # If its not vaguely text-y, we don't want to know
-            if ('xml' not in mimetype and 'html' not in mimetype
-                    and not mimetype.startswith('text/')):
+def save_doc(mongoclient, url, text, digest=None):
+    """Save a document's text to MongoDB, with the payload digest of the
+    original, if given, for incremental runs."""
+    try:
+        # TODO: Abstract collection etc.?
+        mongoclient.warctext.bs.save({'url' : url, 'text' : text,
+                                      'digest' : digest})
+    except Exception:
+        sys.stderr.write("Writing to MongoDB failed for "+url+"\n")
+        traceback.print_exc()
+
+
+def store_doc(mongoclient, url, mimetype, body, httpcode, charset,
+              discardfilter=get_content_filter_dropset({}),
+              html_to_text=bs_html_to_better_text, digest=None,
+              textcache=None, tiercounts=None):
+    """Reduce a (possibly already Tikaised) document to text and save it
+    to MongoDB, unless it is filtered out or not text-y. The payload digest
+    of the original is saved with it, if given, for incremental runs.
+    textcache and tiercounts are as for reduce_doc."""
+    text = reduce_doc(url, mimetype, body, httpcode, charset,
+                      discardfilter, html_to_text, textcache, tiercounts)
+    if text is not None:
+        save_doc(mongoclient, url, text, digest)
+
+
+def resolve_revisits(mongoclient, revisits, discardfilter, textcache=None,
+                     tiercounts=None, batchsize=1000):
+    """Save, under the URL of each revisit (url, httpcode, mimetype,
+    digest) whose first capture was in another file, the text already
+    stored with the same payload digest. Revisits of documents not
+    stored, and all of them if textcache skips duplicates, are counted in
+    tiercounts but not saved. Call it once every file has been processed
+    (with the revisits warc_to_text returned for each), so that the first
+    captures are stored whichever order the files were in. An index on
+    'digest' makes the lookups cheap. Returns tiercounts."""
+    if tiercounts is None:
+        tiercounts = defaultdict(int)
+    revisits = [r for r in revisits
+                if not discardfilter(r[0], r[1], r[2])]
+    if textcache is not None and textcache.skip:
+        tiercounts['duplicate-skipped'] += len(revisits)
+        return tiercounts
+    for start in range(0, len(revisits), batchsize):
+        chunk = revisits[start:start+batchsize]
+        texts = {}
+        for doc in mongoclient.warctext.bs.find(
+                {'digest': {'$in': list(set(r[3] for r in chunk))}},
+                {'digest': 1, 'text': 1, '_id': 0}):
+            texts.setdefault(doc['digest'], doc['text'])
+        for url, _, _, digest in chunk:
+            text = texts.get(digest)
+            if text is None:
+                tiercounts['revisit-unresolved'] += 1
                 continue
+            tiercounts['revisit-stored'] += 1
+            save_doc(mongoclient, url, text, digest)
+    return tiercounts
+
+
+def _store_batch(mongoclient, infn, batch, tikaclient, discardfilter,
+                 html_to_text, normstats=None):
+    """Tikaise a batch of documents and store the results."""
+    for (url, mimetype, text, httpcode, charset,
+         digest) in tikaise_batch(batch, client=tikaclient,
+                                  normstats=normstats):
+        try:
+            store_doc(mongoclient, url, mimetype, text, httpcode, charset,
+                      discardfilter=discardfilter,
+                      html_to_text=html_to_text, digest=digest)
+        except Exception:
+            sys.stderr.write("\n\n***** Uncaught exception processing "+
+                             url+" from "+infn+":\n")
+            traceback.print_exc()
+            sys.stderr.write("Continuing.\n\n\n")
 
+
+def tikaise_batch(docs, client=None, normstats=None):
+    """Generator to Tikaise a batch of small documents in one request.
+
+       :docs:   a list of (url, mimetype, body, httpcode, charset, digest)
+                tuples, where mimetype is the canonical type to send to Tika
+       :client: a tikaclient.TikaClient (default: the shared client)
+       :normstats: a textnorm.NormaliseStats to normalise the text with,
+                or None to leave it as Tika returned it
+
+       Yields (url, 'text/plain', text, httpcode, charset, digest) for each
+       document
+       that could be Tikaised. Documents that failed within the batch are
+       resubmitted individually; those that still fail are dropped."""
+    if client is None:
+        client = get_tika_client()
+    try:
+        results = client.put_batch([(mimetype, body) for
+                                    (_, mimetype, body, _, _, _) in docs])
+    except Exception:
+        # Tika unavailable: can't be Tika-d
+        return
+    for (url, mimetype, body, httpcode, charset,
+         digest), text in zip(docs, results):
+        if text is None:
             try:
-                body = doc_to_unicode(body, charset)
+                _, text = tikaise(mimetype, body, client=client)
             except Exception:
-                # Sometimes this just doesn't work. Carry on anyway if possible.
-                pass
-
-            # If HTMLish, make it textish
-            if 'xml' in mimetype or 'html' in mimetype:
-                try:
-                    body = html_to_text(body)
-                    mimetype = "text/plain"
-                except Exception as e:
-                    # This is variably successful with random input
-                    # if it fails, give up
-                    continue
+                continue
+        if normstats is not None:
+            text = normstats.normalise(text, mimetype)
+        yield (url, 'text/plain', text, httpcode, charset, digest)
+
 
-            # If we're here it's (now) textish, so save it
+def extract_locally(mimetype, body, tiercounts=None):
+    """Try to convert a document to plain text in-process, without Tika,
+    returning ('text/plain', text), or None if it should go to Tika
+    instead. Updates the tiercounts dict if given."""
+    if not localextract.can_extract(mimetype):
+        return None
+    try:
+        text = localextract.extract_text(mimetype, body)
+    except localextract.LocalExtractionException:
+        if tiercounts is not None:
+            tiercounts['local-failed'] += 1
+        return None
+    if tiercounts is not None:
+        tiercounts['local'] += 1
+        tiercounts['local-bytes'] += len(body)
+    return ('text/plain', text)
+
+
+def convert_doc(mimetype, body, charset, tikaclient=None, localextract=True,
+                pdfscreen=0.9, tiercounts=None, monitor=NULL_MONITOR,
+                holdback=None, normstats=None):
+    """Convert a PDFish/Wordish document to text, by local extraction or
+    through Tika, returning the (mimetype, body, charset) to store: the
+    document unchanged if it is of no type Tika handles, or None if it
+    should not be stored (or has been held back). Arguments are as for
+    warc_to_text, with:
+
+       :tiercounts: a dict (defaultdict(int)) of documents and bytes
+                    handled by each extraction tier, to update.
+       :holdback:   optional function of (tikamimetype, body) returning
+                    True if it has taken a Tika-bound document to convert
+                    later (in a batch), rather than now.
+       :normstats:  a textnorm.NormaliseStats to normalise converted text
+                    with, or None to leave it as extracted."""
+    if tiercounts is None:
+        tiercounts = defaultdict(int)
+    tikamimetype = check_mimetype(mimetype)
+    if not tikamimetype:
+        return (mimetype, body, charset)
+    if localextract:
+        monitor.mark('local')
+        converted = extract_locally(tikamimetype, body, tiercounts)
+        if converted:
+            mimetype, body = converted
+            if normstats is not None:
+                body = normstats.normalise(body, tikamimetype)
+            return (mimetype, body, 'UTF-8')
+    if tikamimetype == 'application/pdf' and pdfscreen is not None:
+        monitor.mark('pdfscreen')
+        if screen_pdf(body) >= pdfscreen:
+            # Image-only: Tika would give us nothing
+            tiercounts['pdfscreen-skipped'] += 1
+            return None
+        tiercounts['pdfscreen-passed'] += 1
+    tiercounts['tika'] += 1
+    tiercounts['tika-bytes'] += len(body)
+    if holdback is not None and holdback(tikamimetype, body):
+        return None
+    monitor.mark('tika')
+    try:
+        mimetype, body = tikaise(tikamimetype, body, client=tikaclient)
+    except Exception:
+        # Can't be Tika-d - abort
+        return None
+    if normstats is not None:
+        body = normstats.normalise(body, tikamimetype)
+    return (mimetype, body, charset)
+
+
+def warc_to_text(infn, discardfilter=None,
+                 html_to_text=bs_html_to_better_text,
+                 gzi='auto', tikaclient=None, tikabatchsize=0,
+                 tikabatchmaxdoc=256*1024, localextract=True,
+                 pdfscreen=0.9, mongoclient=None, monitor=None, stored=None,
+                 normalise=False, sampler=None, textcache=None):
+    """Process a WARC at a given infn to (url, text) tuples, stored in
+       MongoDB. Returns a dict of the numbers of documents (and bytes)
+       handled by each extraction tier, and under 'revisits' a list of
+       the file's revisit records whose first capture is in another file.
+
+       :discardfilter: function of (url, httpcode, mimetype) returning
+                    True for documents not to store (default: that given to
+                    init_worker, or keep everything).
+       :tikaclient: a tikaclient.TikaClient for Tika submissions (default:
+                    that set up by init_worker, or the process's shared
+                    client for localhost:9998).
+       :tikabatchsize: if non-zero, Tika-bound documents of up to
+                    tikabatchmaxdoc bytes are submitted in batches of
+                    this many (see tikaise_batch).
+       :localextract: try in-process extraction of OOXML, ODF and RTF
+                    documents before falling back to Tika.
+       :pdfscreen:  confidence threshold at which PDFs judged by
+                    pdfscreen.screen_pdf() to have no text are skipped
+                    without calling Tika, or None to disable screening.
+       :mongoclient: a pymongo MongoClient (default: that set up by
+                    init_worker, or the process's shared client for
+                    localhost).
+       :monitor:    a warcmonitor.RecordMonitor, to log records which are
+                    slow to process and for opt-in profiling (default:
+                    that given to init_worker, or none).
+       :stored:     a set (such as a DigestSet from load_stored_keys) of the
+                    sink_key() of documents already in the sink, which are
+                    skipped before any decoding or Tika work (default: that
+                    given to init_worker, or none: process everything).
+       :normalise:  normalise the text of converted documents (see
+                    textnorm.normalise_text), reporting the size reduction
+                    per MIME type.
+       :sampler:    a warcsample.RecordSampler, to process only a sample
+                    of the documents, skipping the rest before their
+                    bodies are read, or whole records if it has an index
+                    (default: that given to init_worker, or none).
+       :textcache:  a TextCache of the text extracted from HTML bodies,
+                    so that exact duplicates aren't parsed again, with
+                    the hit rate reported for the file (default: that
+                    given to init_worker, or none).
+
+       The revisits returned are not stored: pass those of all the files
+       to resolve_revisits once every file has been processed, by when
+       their first captures are too."""
+    if discardfilter is None:
+        discardfilter = (_worker.get('discardfilter') or
+                         get_content_filter_dropset({}))
+    if tikaclient is None:
+        tikaclient = _worker.get('tikaclient')
+    if mongoclient is None:
+        mongoclient = _worker.get('mongoclient') or get_mongo_client()
+    if monitor is None:
+        monitor = _worker.get('monitor') or NULL_MONITOR
+    if stored is None:
+        stored = _worker.get('stored')
+    if sampler is None:
+        sampler = _worker.get('sampler')
+    if textcache is None:
+        textcache = _worker.get('textcache')
+    monitor.start_file(infn)
+    batch = []
+    tiercounts = defaultdict(int)
+    normstats = NormaliseStats() if normalise else None
+    provenance = TikaProvenance()
+    skip = None
+    if stored is not None:
+        skip = stored_skipper(stored, tiercounts)
+    sample = offsets = None
+    if sampler is not None:
+        sample = sample_counter(sampler, tiercounts)
+        offsets, tiercounts['sample-unread'] = sampler.offsets_for(infn)
+    revisits = []
+    docs = doc_from_warc(infn, gzip=gzi, wanted=doc_wanted,
+                         provenance=provenance, skip=skip, sample=sample,
+                         offsets=offsets,
+                         unresolved=lambda *revisit: revisits.append(revisit))
+    try:
+        for (url, mimetype, body, httpcode, charset, digest) in docs:
+            # The input data have usually already been processed through
+            # Apache Tika during the fetch process to minimse storage space,
+            # with short text output resulting in a retention of the original
+            # document to avoid data loss with image-based PDFs. Converted
+            # documents arrive here as text from their conversion records,
+            # and originals Tika has already failed on are not passed on at
+            # all. Otherwise, canonicalise the mimetype using warctika, then
+            # if PDFish/Wordish, tikaise without benefit of clergy.
+
+            monitor.start_record(url, mimetype, len(body))
             try:
-                # TODO: Abstract collection etc.?
-                mongoclient.warctext.bs.save({'url' : url, 'text' : body})
+                holdback = None
+                if tikabatchsize:
+                    def holdback(tikamimetype, body):
+                        if len(body) > tikabatchmaxdoc:
+                            return False
+                        # Small document: hold it back for a batch
+                        batch.append((url, tikamimetype, body, httpcode,
+                                      charset, digest))
+                        if len(batch) >= tikabatchsize:
+                            # Charged to the document which fills the batch
+                            monitor.mark('batch')
+                            _store_batch(mongoclient, infn, batch,
+                                         tikaclient, discardfilter,
+                                         html_to_text, normstats)
+                            del batch[:]
+                        return True
+                converted = convert_doc(mimetype, body, charset, tikaclient,
+                                        localextract, pdfscreen, tiercounts,
+                                        monitor, holdback, normstats)
+                if converted is None:
+                    continue
+                mimetype, body, charset = converted
+
+                monitor.mark('store')
+                store_doc(mongoclient, url, mimetype, body, httpcode, charset,
+                          discardfilter, html_to_text, digest, textcache,
+                          tiercounts)
             except Exception:
-                sys.stderr.write("Writing to MongoDB failed for "+url+"\n")
+                # General catch to avoid multiprocessing taking down the
+                # whole job for one bogus record
+                sys.stderr.write("\n\n***** Uncaught exception processing "+
+                                 url+"from "+infn+":\n")
                 traceback.print_exc()
-        except Exception:
-            # General catch to avoid multiprocessing taking down the whole job
-            # for one bogus record
-            sys.stderr.write("\n\n***** Uncaught exception processing "+url+
-                             "from "+infn+":\n")
-            traceback.print_exc()
-            sys.stderr.write("Continuing.\n\n\n")
+                sys.stderr.write("Continuing.\n\n\n")
+            finally:
+                monitor.end_record()
+        if batch:
+            _store_batch(mongoclient, infn, batch, tikaclient,
+                         discardfilter, html_to_text, normstats)
+    finally:
+        monitor.end_file()
+    tiercounts['viatika-converted'] = len(provenance.converted)
+    tiercounts['viatika-failed'] = len(provenance.failed)
+    if normstats is not None:
+        sys.stderr.write("****Normalisation:\n"+normstats.report()+"\n")
+        tiercounts.update(normstats.counts())
+    if textcache is not None:
+        sys.stderr.write("****Duplicates: "+TextCache.report(tiercounts)+
+                         "\n")
+    sys.stderr.write("****Extraction tiers: "+str(tiercounts.items())+"\n")
 
     sys.stderr.write("****Finished file.\n")
+    tiercounts = dict(tiercounts)
+    tiercounts['revisits'] = revisits
+    return tiercounts
 
 
 #class WARCMongoDBProcessorHTML2Text(WARCMongoDBProcessor):
@@ -0,0 +1,570 @@
+#!/usr/bin/env python2
+"""Running per-file WARC jobs (warc2mongodb.warc_to_text, or
+WARCTikaProcessor.process) across several machines.
+
+A coordinator owns the list of files. Workers, on any number of hosts,
+connect to it over TCP and lease one file at a time. While a worker
+processes its file it sends heartbeats; a lease which goes without one
+for ttl seconds (because its worker or host died) expires, and its file
+is leased again, up to a maximum number of attempts. When a worker
+finishes a file it reports success or failure, the time taken and its
+metrics (the extraction tier counts), which the coordinator totals and
+reports alongside its progress. For the text job, it also sends back the
+file's revisit records whose first capture is in another file; once
+every file has finished, the coordinator leases them to one worker, to
+be given the text stored for their first captures.
+
+The protocol is one JSON object per line in each direction. There is no
+encryption; an optional shared secret keeps stray clients out.
+
+For example, on one host:
+    warccluster.py coordinator --port 9876 < filelist
+and on each processing host (which must see the files at the same paths):
+    warccluster.py worker coordhost:9876 --job text -j 8
+
+Copyright 2014-2016 Tom Nicholls
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+
+#####
+#SETUP
+#####
+
+import sys
+import os
+import re
+import time
+import json
+import socket
+import argparse
+import threading
+import traceback
+import SocketServer
+from collections import defaultdict, deque
+from multiprocessing import Process
+from warcpool import order_files, load_costs, ProgressReporter
+
+#####
+#UTILITY FUNCTIONS
+#####
+def parse_address(s, defaultport=9876):
+    """Parse 'host:port' (or 'host') into a (host, port) tuple."""
+    if ':' in s:
+        host, port = s.rsplit(':', 1)
+        return (host, int(port))
+    return (s, defaultport)
+
+def numeric_metrics(metrics):
+    """Return the numeric entries of a metrics dict, with string keys, for
+    sending as JSON."""
+    out = {}
+    for k, v in (metrics or {}).items():
+        if isinstance(v, (int, long, float)):
+            out[str(k)] = v
+    return out
+
+def split_metrics(metrics):
+    """Return (numeric metrics, revisits) from what a job returned: see
+    numeric_metrics and warc2mongodb.warc_to_text."""
+    return numeric_metrics(metrics), list((metrics or {}).get('revisits',
+                                                              ()))
+
+def viatika_name(infn):
+    """Return the output filename for WARCTikaProcessor: foo.warc.gz ->
+    foo-ViaTika.warc.gz (likewise for .warc and .warc.zst)."""
+    return re.sub(r'\.warc(\.gz|\.zst|)$', r'-ViaTika.warc\1', infn)
+
+#####
+#CLASSES
+#####
+
+class Coordinator(object):
+    """The queue of files, and the leases on them. Methods are thread safe.
+
+       files: filenames, leased in the order given;
+       ttl: seconds a lease lasts without a heartbeat before its file is
+           leased again;
+       maxattempts: number of times one file may be leased before it is
+           given up on as failed. Files whose job raised an exception are
+           not retried;
+       progress: a warcpool.ProgressReporter, updated as files finish;
+       secret: if given, requests must carry it.
+
+       Revisits reported with the files are kept, and once every file
+       has finished they are leased, as a last task named RESOLVE, to be
+       resolved in one pass."""
+    RESOLVE = '(revisits)'
+
+    def __init__(self, files, ttl=60, maxattempts=3, progress=None,
+                 secret=None):
+        self._queue = deque(files)
+        self._ttl = ttl
+        self._maxattempts = maxattempts
+        self._progress = progress
+        self._secret = secret
+        # lease id -> [filename, worker, expiry time]
+        self._leases = {}
+        self._nextlease = 0
+        self._attempts = defaultdict(int)
+        self._remaining = len(self._queue)
+        self._lock = threading.Lock()
+        self.finished = threading.Event()
+        if not self._remaining:
+            self.finished.set()
+        self.metrics = defaultdict(int)
+        self.revisits = []
+        self._resolving = False
+        self.failed = []
+        # worker name -> time last heard from
+        self.workers = {}
+
+    def dispatch(self, msg):
+        """Handle one request, returning the reply."""
+        if self._secret is not None and msg.get('secret') != self._secret:
+            return {'error': 'bad secret'}
+        op = msg.get('op')
+        worker = msg.get('worker')
+        if op == 'lease':
+            return self.lease(worker)
+        elif op == 'heartbeat':
+            return self.heartbeat(msg['lease'], worker)
+        elif op == 'complete':
+            return self.complete(msg['lease'], msg['file'], worker,
+                                 msg['ok'], msg.get('elapsed'),
+                                 msg.get('metrics', {}),
+                                 msg.get('revisits', []))
+        elif op == 'status':
+            return self.status()
+        return {'error': 'unknown op '+str(op)}
+
+    def expire(self):
+        """Re-queue (or give up on) the files of expired leases."""
+        with self._lock:
+            self._expire()
+
+    def _expire(self):
+        # Must be called with the lock held
+        now = time.time()
+        for leaseid, (fn, worker, expiry) in self._leases.items():
+            if expiry >= now:
+                continue
+            del self._leases[leaseid]
+            sys.stderr.write("Lease %d on %s by %s expired.\n" %
+                             (leaseid, fn, worker))
+            if self._attempts[fn] < self._maxattempts:
+                # To the front: it has already waited its turn
+                self._queue.appendleft(fn)
+            else:
+                self._finish(fn, False, None)
+
+    def _finish(self, fn, ok, elapsed):
+        self._remaining -= 1
+        if not ok:
+            self.failed.append(fn)
+        if self._progress is not None and fn != self.RESOLVE:
+            self._progress.update(fn, ok, elapsed)
+        if not self._remaining:
+            if self.revisits and not self._resolving:
+                self._resolving = True
+                self._queue.append(self.RESOLVE)
+                self._remaining += 1
+            else:
+                self.finished.set()
+
+    def lease(self, worker):
+        with self._lock:
+            self._expire()
+            self.workers[worker] = time.time()
+            if self._queue:
+                fn = self._queue.popleft()
+                self._attempts[fn] += 1
+                self._nextlease += 1
+                self._leases[self._nextlease] = [fn, worker,
+                                                 time.time() + self._ttl]
+                reply = {'lease': self._nextlease, 'file': fn,
+                         'ttl': self._ttl}
+                if fn == self.RESOLVE:
+                    reply['revisits'] = self.revisits
+                return reply
+            if self._leases:
+                # Nothing now, but an expiring lease may free a file
+                return {'wait': min(10.0, self._ttl / 4.0)}
+            return {'done': True}
+
+    def heartbeat(self, leaseid, worker):
+        with self._lock:
+            self._expire()
+            self.workers[worker] = time.time()
+            lease = self._leases.get(leaseid)
+            if lease is None:
+                return {'ok': False}
+            lease[2] = time.time() + self._ttl
+            return {'ok': True}
+
+    def complete(self, leaseid, fn, worker, ok, elapsed, metrics,
+                 revisits=()):
+        with self._lock:
+            self.workers[worker] = time.time()
+            lease = self._leases.pop(leaseid, None)
+            if lease is None:
+                # Expired. If the file hasn't been leased again yet, this
+                # result is as good as any; otherwise the new lease's is.
+                if fn not in self._queue:
+                    return {'ok': False}
+                self._queue.remove(fn)
+            for k, v in metrics.items():
+                self.metrics[k] += v
+            self.revisits.extend(revisits)
+            self._finish(fn, ok, elapsed)
+            return {'ok': True}
+
+    def status(self):
+        with self._lock:
+            return {'queued': len(self._queue), 'leased': len(self._leases),
+                    'remaining': self._remaining,
+                    'failed': len(self.failed),
+                    'workers': len(self.workers),
+                    'metrics': dict(self.metrics)}
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                reply = self.server.coordinator.dispatch(json.loads(line))
+            except Exception as e:
+                reply = {'error': str(e)}
+            self.wfile.write(json.dumps(reply) + '\n')
+            self.wfile.flush()
+
+class CoordinatorServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """TCP server for a Coordinator, with a thread per connection."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, coordinator):
+        SocketServer.TCPServer.__init__(self, address, _Handler)
+        self.coordinator = coordinator
+
+class _Connection(object):
+    """A worker's connection to the coordinator, reconnecting as needed
+    for up to retryfor seconds before giving up."""
+    def __init__(self, address, secret=None, retryfor=60):
+        self._address = address
+        self._secret = secret
+        self._retryfor = retryfor
+        self._sock = None
+        self._file = None
+
+    def _connect(self):
+        self._sock = socket.create_connection(self._address, 30)
+        self._file = self._sock.makefile('rb')
+
+    def close(self):
+        if self._sock is not None:
+            self._file.close()
+            self._sock.close()
+        self._sock = self._file = None
+
+    def call(self, msg):
+        """Send msg and return the reply. Raises socket.error if the
+        coordinator can't be reached within retryfor seconds."""
+        if self._secret is not None:
+            msg['secret'] = self._secret
+        data = json.dumps(msg) + '\n'
+        deadline = time.time() + self._retryfor
+        while True:
+            try:
+                if self._sock is None:
+                    self._connect()
+                self._sock.sendall(data)
+                line = self._file.readline()
+                if not line:
+                    raise socket.error("Connection closed by coordinator")
+                reply = json.loads(line)
+                if 'error' in reply:
+                    raise ValueError("Coordinator: "+reply['error'])
+                return reply
+            except socket.error:
+                self.close()
+                if time.time() > deadline:
+                    raise
+                time.sleep(2)
+
+class _Heartbeat(threading.Thread):
+    """Keeps a lease alive while its file is processed."""
+    def __init__(self, address, secret, leaseid, worker, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._conn = _Connection(address, secret, retryfor=interval)
+        self._msg = {'op': 'heartbeat', 'lease': leaseid, 'worker': worker}
+        self._interval = interval
+        self._stopping = threading.Event()
+        self.lost = False
+
+    def run(self):
+        while not self._stopping.wait(self._interval):
+            try:
+                if not self._conn.call(dict(self._msg))['ok']:
+                    # Expired and handed to someone else. Carry on: if
+                    # it isn't re-leased first, our result still counts.
+                    self.lost = True
+                    return
+            except Exception as e:
+                sys.stderr.write("Heartbeat failed: %s\n" % e)
+        self._conn.close()
+
+    def stop(self):
+        self._stopping.set()
+        self.join()
+
+def run_worker(address, job, name=None, secret=None, resolve=None):
+    """Lease files from the coordinator at address, calling job(filename)
+    on each, until it has none left (or can no longer be reached). job
+    should return a dict of numeric metrics, or None; for the text job
+    it also holds revisits, which are sent back. Given the revisits of
+    all the files, the worker calls resolve(revisits), which returns
+    metrics like job.
+
+    Returns the number of files processed."""
+    if name is None:
+        name = "%s:%d" % (socket.gethostname(), os.getpid())
+    conn = _Connection(address, secret)
+    done = 0
+    try:
+        while True:
+            try:
+                reply = conn.call({'op': 'lease', 'worker': name})
+            except socket.error:
+                sys.stderr.write("Worker %s: coordinator gone; stopping.\n"
+                                 % name)
+                break
+            if reply.get('done'):
+                break
+            if 'wait' in reply:
+                time.sleep(reply['wait'])
+                continue
+            leaseid, fn = reply['lease'], reply['file']
+            beat = _Heartbeat(address, secret, leaseid, name,
+                              reply['ttl'] / 3.0)
+            beat.start()
+            start = time.time()
+            metrics = None
+            try:
+                if 'revisits' in reply:
+                    if resolve is None:
+                        raise ValueError("This job can't resolve revisits")
+                    metrics = resolve(reply['revisits'])
+                else:
+                    metrics = job(fn)
+                ok = True
+            except Exception:
+                sys.stderr.write("\n\n***** Uncaught exception processing "
+                                 "file "+str(fn)+":\n")
+                traceback.print_exc()
+                ok = False
+            finally:
+                beat.stop()
+            metrics, revisits = split_metrics(metrics)
+            conn.call({'op': 'complete', 'lease': leaseid, 'file': fn,
+                       'worker': name, 'ok': ok,
+                       'elapsed': time.time() - start,
+                       'metrics': metrics, 'revisits': revisits})
+            done += 1
+    finally:
+        conn.close()
+    return done
+
+def run_coordinator(files, address, ttl=60, maxattempts=3, order='size',
+                    costs=None, secret=None, linger=15, stream=sys.stderr):
+    """Serve files to workers from address until all have finished,
+    reporting progress to stream. Files are ordered as by
+    warcpool.run_pool. After the last file finishes the server stays up
+    for linger seconds, so that idle workers hear that there is nothing
+    left.
+
+    Returns the coordinator, with its totalled metrics and failed files."""
+    files, filecosts = order_files(files, order, costs)
+    coordinator = Coordinator(files, ttl, maxattempts,
+                              ProgressReporter(filecosts, stream), secret)
+    server = CoordinatorServer(address, coordinator)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    stream.write("Coordinating %d files on %s:%d.\n" %
+                 ((len(files),) + server.server_address[:2]))
+    try:
+        # Wake regularly, so that expired leases are noticed even when no
+        # worker is asking, and so that KeyboardInterrupt gets through
+        while not coordinator.finished.wait(max(1.0, ttl / 4.0)):
+            coordinator.expire()
+        time.sleep(linger)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return coordinator
+
+#####
+#JOBS
+#####
+
+def _text_job_setup(args):
+    """Prepare a warc_to_text job in the parent, before forking: build
+    the filter set, to be shared with the worker processes."""
+    from warc2mongodb import get_content_filter_keepset, md5_hash
+    from warcpool import DigestSet
+    if not args.filter_file:
+        return None
+    if (args.filter_cache and os.path.exists(args.filter_cache) and
+            os.path.getmtime(args.filter_cache) >=
+            os.path.getmtime(args.filter_file)):
+        s = DigestSet.load(args.filter_cache)
+    else:
+        import csv
+        with open(args.filter_file, 'rb') as f:
+            s = DigestSet.from_iterable(
+                md5_hash(unicode(line[0].rstrip()))
+                for line in csv.reader(f, dialect='excel-tab'))
+        if args.filter_cache:
+            s.save(args.filter_cache)
+    return get_content_filter_keepset(s)
+
+def _worker_process(args, discardfilter):
+    """Body of one worker process."""
+    resolve = None
+    if args.job == 'text':
+        from warc2mongodb import (init_worker, warc_to_text,
+                                  resolve_revisits, get_mongo_client,
+                                  get_content_filter_dropset)
+        init_worker(discardfilter)
+        job = warc_to_text
+        def resolve(revisits):
+            return resolve_revisits(get_mongo_client(), revisits,
+                                    discardfilter or
+                                    get_content_filter_dropset({}))
+    else:
+        from warctika import WARCTikaProcessor
+        dedup = None
+        if args.dedup_db:
+            from warcdedup import DigestIndex
+            dedup = DigestIndex(args.dedup_db)
+        skiplearner = None
+        if args.skip_table:
+            from tikaskip import SkipLearner
+            skiplearner = SkipLearner(args.skip_table)
+        processor = WARCTikaProcessor(dedup=dedup, skiplearner=skiplearner)
+        def job(infn):
+            outfn = viatika_name(infn)
+            if outfn == infn or os.path.exists(outfn):
+                sys.stderr.write("File "+infn+" has already been processed. "
+                                 "Skipping.\n")
+                return None
+            processor.process(infn=infn, outfn=outfn, delete=args.delete)
+            return processor.filecounts
+    run_worker(parse_address(args.address), job, secret=args.secret,
+               resolve=resolve)
+
+#####
+#ARGUMENT PARSER
+#####
+
+parser = argparse.ArgumentParser(description='Process WARC files across '
+    'several machines: a coordinator leases files to workers over TCP.')
+parser.add_argument('--secret', help='Shared secret which workers must '
+                    'present to the coordinator.')
+subparsers = parser.add_subparsers(dest='mode')
+
+cparser = subparsers.add_parser('coordinator', help='Serve a list of files '
+                                '(read from stdin) to workers.')
+cparser.add_argument('--bind', default='',
+                     help='Address to listen on. Default: all.')
+cparser.add_argument('--port', type=int, default=9876,
+                     help='Port to listen on. Default: 9876.')
+cparser.add_argument('--ttl', type=float, default=60,
+                     help='Seconds a lease lasts without a heartbeat. '
+                          'Default: 60.')
+cparser.add_argument('--max-attempts', type=int, default=3,
+                     help='Times a file is leased before it is given up '
+                          'on. Default: 3.')
+cparser.add_argument('--order', choices=['size', 'cost', 'list'],
+                     default='size',
+                     help='Scheduling order, as for ukwebdata2mongodb. '
+                          'Default: size.')
+cparser.add_argument('--cost-file', metavar='costfn',
+                     help='Tab-separated filename/cost table for --order '
+                          'cost.')
+
+wparser = subparsers.add_parser('worker', help='Process files leased from '
+                                'a coordinator.')
+wparser.add_argument('address', help='Coordinator host:port.')
+wparser.add_argument('--job', choices=['text', 'tika'], default='text',
+                     help='text: extract text to MongoDB '
+                          '(warc2mongodb.warc_to_text). tika: write '
+                          '-ViaTika WARCs (WARCTikaProcessor). '
+                          'Default: text.')
+wparser.add_argument('-j', '--processes', type=int, default=1,
+                     help='Number of worker processes. Default: 1.')
+wparser.add_argument('--filter-file',
+                     help='For --job text, TSV whose first column lists the '
+                          'URLs to keep. Default: keep everything.')
+wparser.add_argument('--filter-cache', metavar='cachefn',
+                     help='For --job text, file to keep the prepared filter '
+                          'set in (see ukwebdata2mongodb).')
+wparser.add_argument('--dedup-db', metavar='dbfn',
+                     help='For --job tika, write response records not '
+                          'converted by Tika whose payload digest is in '
+                          'this SQLite database (shared '
+                          'by the workers on a filesystem with working '
+                          'locks) as revisit records, recording the rest.')
+wparser.add_argument('--skip-table', metavar='tablefn',
+                     help='For --job tika, learn which hosts\' documents '
+                          'Tika fails on and stop sending them, keeping '
+                          'the table in this file (shared by the workers, '
+                          'which merge their results into it).')
+wparser.add_argument('--delete', action='store_true',
+                     help='For --job tika, delete each input file once its '
+                          '-ViaTika file has been written and validated.')
+
+#####
+#MAIN
+#####
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.mode == 'coordinator':
+        files = [infn.rstrip() for infn in sys.stdin if infn.strip()]
+        costs = None
+        if args.cost_file:
+            costs = load_costs(args.cost_file)
+        elif args.order == 'cost':
+            sys.exit("--order cost requires --cost-file")
+        coordinator = run_coordinator(files, (args.bind, args.port),
+                                      args.ttl, args.max_attempts,
+                                      args.order, costs, args.secret)
+        sys.stderr.write("****Metrics: "+
+                         str(sorted(coordinator.metrics.items()))+"\n")
+        if coordinator.failed:
+            sys.stderr.write("Failed files:\n"+
+                             "\n".join(coordinator.failed)+"\n")
+        sys.stderr.write("Done!\n")
+    else:
+        discardfilter = None
+        if args.job == 'text':
+            discardfilter = _text_job_setup(args)
+        procs = [Process(target=_worker_process, args=(args, discardfilter))
+                 for i in range(args.processes)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
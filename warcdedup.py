@@ -0,0 +1,123 @@
+#!/usr/bin/env python2
+"""An index of payload digests seen across a crawl, for writing revisit
+records in place of repeated captures of the same document.
+
+WARCTikaProcessor, given a DigestIndex, looks up the WARC-Payload-Digest
+of each response record it copies through unchanged (documents it
+converts with Tika are left alone, as their originals aren't kept). The
+first capture of a payload is recorded (its record ID, URI and date) and
+written out as usual; any later capture with the same digest is written
+as a revisit record of the identical-payload-digest profile referring to
+the first, keeping only its HTTP headers. warc2mongodb stores the text of
+the first capture for the URL of each revisit.
+
+The index is kept in memory, and optionally in a SQLite database, which
+lets several files, worker threads and processes (on one machine, or
+sharing a filesystem with working locks) deduplicate against each other
+and against earlier runs.
+
+Copyright 2014-2016 Tom Nicholls
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+
+#####
+#SETUP
+#####
+
+import os
+import sqlite3
+import threading
+
+#####
+#CLASSES
+#####
+
+class DigestIndex(object):
+    """Maps payload digests to the first capture seen with each.
+
+       filename: SQLite database to keep the index in (created if need
+           be), shared with other processes using the same file, or None
+           to keep it in this process's memory only;
+       timeout: seconds to wait for another process's lock on the
+           database;
+       maxcache: with a database, the number of lookups to cache in
+           memory before the cache is emptied.
+
+       Safe for use from several threads."""
+    def __init__(self, filename=None, timeout=60, maxcache=1000000):
+        self.filename = filename
+        self._timeout = timeout
+        self._maxcache = maxcache
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._db = None
+        self._pid = None
+
+    def _connect(self):
+        """Return this process's connection to the database (connections
+        can't be shared across fork())."""
+        if self._pid != os.getpid():
+            self._db = sqlite3.connect(self.filename, timeout=self._timeout,
+                                       check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS digests "
+                             "(digest TEXT PRIMARY KEY, id TEXT, uri TEXT, "
+                             "date TEXT)")
+            self._db.commit()
+            self._pid = os.getpid()
+        return self._db
+
+    def first_capture(self, digest, recordid, uri, date):
+        """Return the (record ID, URI, date) of the first capture of the
+        payload with digest, recording this capture as the first if there
+        is none. A capture is its own first capture, so re-processing a
+        file finds no duplicates of its own records."""
+        with self._lock:
+            first = self._cache.get(digest)
+            if first is None and self.filename is not None:
+                # Stored as Latin-1, which any byte string round-trips
+                # through (sqlite3 won't take 8-bit byte strings)
+                db = self._connect()
+                with db:
+                    db.execute("INSERT OR IGNORE INTO digests VALUES "
+                               "(?, ?, ?, ?)",
+                               [str(v).decode('latin-1') for v in
+                                (digest, recordid, uri, date)])
+                    first = db.execute("SELECT id, uri, date FROM digests "
+                                       "WHERE digest = ?",
+                                       (digest.decode('latin-1'),)
+                                       ).fetchone()
+                first = tuple(v.encode('latin-1') for v in first)
+            if first is None:
+                first = (recordid, uri, date)
+            if (self.filename is not None and
+                    len(self._cache) >= self._maxcache):
+                self._cache.clear()
+            self._cache[digest] = first
+            return first
+
+    def is_duplicate(self, digest, recordid, uri, date):
+        """Return the (record ID, URI, date) of an earlier capture of the
+        payload with digest, or None if this is the first."""
+        first = self.first_capture(digest, recordid, uri, date)
+        if first[0] == recordid:
+            return None
+        return first
+
+    def __len__(self):
+        if self.filename is None:
+            return len(self._cache)
+        with self._lock:
+            return self._connect().execute(
+                "SELECT COUNT(*) FROM digests").fetchone()[0]
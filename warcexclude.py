@@ -7,6 +7,12 @@ records where e.g. pathological recursion is detected during a crawl. A filter
 attached to the crawl prevents new junk from being fetched, but this script
 strips the junk out from the files already fetched.
 
+Records are excluded along with those concurrent with them (the request
+and metadata records written around a response, linked to it by
+WARC-Concurrent-To), whether they come before or after the matching
+record. To do that in one pass, records are held back in a bounded buffer
+until their group is complete.
+
 This work is available under the terms of the GNU General Purpose Licence
 This program is free software: you can redistribute it and/or modify
 it under the terms of the GNU General Public License as published by
@@ -27,8 +33,12 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>
 #####
 
 import sys
+from collections import deque
 from hanzo.warctools import WarcRecord
-from warcresponseparse import *
+from warcreader import (open_archive, iter_lazy_records, MmapRecordStream,
+                        MmapRecord, is_plain_warc)
+from warcwriter import RecordWriter
+from warcpool import parse_size
 import re
 import argparse
 import time
@@ -56,29 +66,30 @@ def parse_exc_args(argl, exclist=list()):
     return exclist
 
 def check_headers(exclist, record, just_one=False):
-    """Tests the given record against the list of exclusion patterns given in
-       exclist. If just_one is True, testing is optimised by returning after
-       any match has been made.
+    """Tests the given record (a warcreader.LazyRecord or MmapRecord)
+       against the list of exclusion patterns given in exclist. If just_one
+       is True, testing is optimised by returning after any match has been
+       made.
 
        Returns: The number of matches that have been made"""
     matches = 0
     for tup in exclist:
         heads = [h for h in record.headers if h[0] == tup[0]]
         # Try to avoid processing the HTTP Response content unless we have
-        # a pattern which requires it, as it's expensive.
-        # This could be further optimised by caching the body etc. if
-        # calculated once.
+        # a pattern which requires it, as it's expensive. The code and
+        # Content-Type come from the HTTP header block alone; only
+        # XHTTP-Body needs the body to be read.
         if (record.type == WarcRecord.RESPONSE
                 and record.url.startswith('http')
                 and not args.do_not_expose_http_headers):
             if tup[0] == "XHTTP-Response-Code":
-                ccode, _, _ = parse_http_response(record)
+                ccode, _ = record.http_headers()
                 heads.append( ("XHTTP-Response-Code", ccode) )
             elif tup[0] == "XHTTP-Content-Type":
-                _, cmime, _ = parse_http_response(record)
+                cmime, _ = record.http_content_type()
                 heads.append( ("XHTTP-Content-Type", cmime) )
             elif tup[0] == "XHTTP-Body":
-                _, _, cbody = parse_http_response(record)
+                _, _, _, cbody = record.http_response()
                 heads.append( ("XHTTP-Body", cbody) )
         for head in heads:
             # Do the actual match
@@ -90,6 +101,130 @@ def check_headers(exclist, record, just_one=False):
                     return matches
     return matches
 
+class _Group(object):
+    __slots__ = ('ids', 'records', 'exclude', 'last', 'size')
+
+    def __init__(self):
+        self.ids = set()
+        self.records = []
+        self.exclude = False
+        self.last = 0
+        self.size = 0
+
+class GroupBuffer(object):
+    """Holds records back until the group of records concurrent with them
+       (linked by WARC-Concurrent-To, in either direction, such as a
+       response and the request and metadata records Heritrix writes around
+       it) is complete, then writes the whole group, or drops it if any of
+       its records is excluded. Within a group, records are written in the
+       order they were read.
+
+       write: function called with each record to be written;
+       drop: optional function called with each record dropped;
+       window: a group is taken to be complete once this many records
+           outside it have been read since its last member. 0 resolves each
+           record as it is read, so that only later derivatives of an
+           excluded record are dropped;
+       maxbytes: if record bodies read into memory to be held back exceed
+           this, the oldest groups are resolved early. Bodies of records
+           from a memory-mapped file are not read, so cost nothing.
+
+       The IDs of dropped groups are kept, so that any straggling
+       derivative of an excluded record is still dropped after its group
+       has been resolved."""
+    def __init__(self, write, drop=None, window=16, maxbytes=64*1024*1024):
+        self._write = write
+        self._drop = drop
+        self._window = window
+        self._maxbytes = maxbytes
+        self._groups = deque()
+        self._byid = {}
+        self._seq = 0
+        self.bytes = 0
+        self.excluded = set()
+        self.forced = 0
+
+    def add(self, record, exclude=False):
+        """Add a record, excluded or not, resolving any groups now
+        complete."""
+        self._seq += 1
+        ids = {h[1] for h in record.headers
+               if h[0] == WarcRecord.CONCURRENT_TO}
+        if record.id is not None:
+            # Otherwise every record without an ID would join one group
+            ids.add(record.id)
+        if ids & self.excluded:
+            # Derivative of a group already dropped
+            self.excluded.update(ids)
+            if self._drop is not None:
+                self._drop(record)
+            return
+        groups = []
+        for i in ids:
+            g = self._byid.get(i)
+            if g is not None and g not in groups:
+                groups.append(g)
+        if not groups:
+            group = _Group()
+            self._groups.append(group)
+        else:
+            # Records linking two held groups join them, in the place of
+            # the older
+            group = min(groups, key=lambda g: g.records[0][0])
+            for g in groups:
+                if g is not group:
+                    self._merge(group, g)
+        if not isinstance(record, MmapRecord):
+            # A LazyRecord's body must be read before the stream moves on
+            record.content
+            size = record.content_length or 0
+        else:
+            size = 0
+        group.records.append((self._seq, record))
+        group.ids.update(ids)
+        group.exclude = group.exclude or exclude
+        group.last = self._seq
+        group.size += size
+        self.bytes += size
+        for i in ids:
+            self._byid[i] = group
+        self._resolve()
+
+    def _merge(self, group, other):
+        self._groups.remove(other)
+        group.records.extend(other.records)
+        group.records.sort()
+        group.ids.update(other.ids)
+        group.exclude = group.exclude or other.exclude
+        group.last = max(group.last, other.last)
+        group.size += other.size
+        for i in other.ids:
+            self._byid[i] = group
+
+    def _resolve(self, final=False):
+        while self._groups:
+            group = self._groups[0]
+            if not final and self._seq - group.last < self._window:
+                if self.bytes <= self._maxbytes:
+                    break
+                self.forced += 1
+            self._groups.popleft()
+            self.bytes -= group.size
+            for i in group.ids:
+                del self._byid[i]
+            if group.exclude:
+                self.excluded.update(group.ids)
+                if self._drop is not None:
+                    for _, record in group.records:
+                        self._drop(record)
+            else:
+                for _, record in group.records:
+                    self._write(record)
+
+    def flush(self):
+        """Resolve every group held, at the end of the input."""
+        self._resolve(final=True)
+
 #####
 #ARGUMENT PARSER
 #####
@@ -119,14 +254,39 @@ gzinput.add_argument('-gz', '--gzipped-input', action="store_true",
                          'which fails on stdin.')
 gzinput.add_argument('-gp', '--plain-input', action="store_true",
                     help='Treat input stream as plain text.')
+gzinput.add_argument('-zi', '--zstd-input', action="store_true",
+                    help='Treat input stream as Zstandard compressed '
+                         '(.warc.zst). Default: guess, which fails on '
+                         'stdin.')
 
-parser.add_argument('-G', '--gzipped-output', action="store_true", 
+gzoutput = parser.add_mutually_exclusive_group()
+gzoutput.add_argument('-G', '--gzipped-output', action="store_true", 
                     help='Gzip the output stream (record-wise).')
+gzoutput.add_argument('-Z', '--zstd-output', action="store_true",
+                    help='Compress the output stream with Zstandard '
+                         '(record-wise, as .warc.zst).')
+parser.add_argument('-D', '--zstd-dictionary', metavar='dictfn',
+                    help='With -Z, compress using this dictionary (see '
+                         'warcwriter.py), stored at the start of the '
+                         'output.')
 
 parser.add_argument('-a', '--match-any', action="store_true",
                     help='Exclude if any one pattern is matched. '
                          'Default: all')
 
+parser.add_argument('-w', '--group-window', type=int, default=16,
+                    metavar='N',
+                    help='Hold records back until N unrelated records '
+                         'have followed their group of concurrent records '
+                         '(by WARC-Concurrent-To), so that records written '
+                         'before an excluded record, as well as after it, '
+                         'are dropped with it. 0 drops only later '
+                         'derivatives. Default: 16.')
+parser.add_argument('-m', '--group-memory', default='64M', metavar='size',
+                    help='Resolve the oldest held groups early if the '
+                         'record bodies held in memory exceed this size. '
+                         'Default: 64M.')
+
 parser.add_argument('pattern', metavar='patt', nargs='+',
                help="field/regexp, where field is a "
               "WARC header and regexp is a pattern to match against. "
@@ -138,8 +298,6 @@ parser.add_argument('pattern', metavar='patt', nargs='+',
 
 args = parser.parse_args()
 
-uuidsexcluded = set()
-
 exclist = parse_exc_args(args.pattern)
 
 # In theory this could be agnostic as to whether the stream is compressed or
@@ -151,13 +309,20 @@ if args.gzipped_input:
     gzi = 'record'
 elif args.plain_input:
     gzi = False
+elif args.zstd_input:
+    gzi = 'zstd'
 
+# Uncompressed input files are memory-mapped, so that records can be
+# matched and written out without copying them through Python strings.
 if args.in_filename is None:
-    inwf = WarcRecord.open_archive(file_handle=sys.stdin,
-                                   mode='rb', gzip=gzi)
+    inwf = open_archive(file_handle=sys.stdin, gzip=gzi)
+    records = iter_lazy_records(inwf)
+elif gzi is False or (gzi == 'auto' and is_plain_warc(args.in_filename)):
+    inwf = MmapRecordStream(args.in_filename)
+    records = iter(inwf)
 else:
-    inwf = WarcRecord.open_archive(filename=args.in_filename,
-                                   mode='rb', gzip=gzi)
+    inwf = open_archive(filename=args.in_filename, gzip=gzi)
+    records = iter_lazy_records(inwf)
 
 #####
 #MAIN
@@ -166,31 +331,45 @@ else:
 outf = sys.stdout
 if args.out_filename is not None:
     outf = open(args.out_filename, 'wb')
+compression = None
+dictionary = None
+if args.gzipped_output:
+    compression = 'gzip'
+elif args.zstd_output:
+    compression = 'zstd'
+    if args.zstd_dictionary:
+        dictionary = open(args.zstd_dictionary, 'rb').read()
+outwf = RecordWriter(outf, compression, dictionary)
 
-for record in inwf:
+def write_record(record):
+    outwf.write(record)
+    sys.stderr.write('#')
+
+def drop_record(record):
+    # Excluded itself, or derivative of (or concurrent with) one excluded
+    sys.stderr.write('.')
+
+# Records are written or dropped a group of concurrent records at a time
+groups = GroupBuffer(write_record, drop_record, args.group_window,
+                     parse_size(args.group_memory))
+
+for record in records:
     # How many matches constitutes failure?
-    write = len(exclist)
     if args.match_any:
         match_target = 0
     else:
         match_target = len(exclist) - 1
 
-    # Extract "WARC-Concurrent-To" headers
-    concurrentheads = {h[1] for h in record.headers
-                       if h[0] == WarcRecord.CONCURRENT_TO}
-    if uuidsexcluded.intersection(concurrentheads):
-        # Skip records which are derivative of those excluded
-        sys.stderr.write('.')
-        continue
-   
     matches = check_headers(exclist, record, args.match_any)
 
-    if matches <= match_target:
-        record.write_to(outf, gzip=args.gzipped_output)
-        sys.stderr.write('#')
-    else:
-        # Don't write. Additionally, exclude all derivative records.
+    if matches > match_target:
+        # Don't write. Additionally, exclude all concurrent records.
         sys.stderr.write('-')
-        uuidsexcluded.add(record.id)
+    groups.add(record, matches > match_target)
+groups.flush()
+inwf.close()
+if groups.forced:
+    sys.stderr.write("\nGroup buffer full: %d groups resolved early.\n" %
+                     groups.forced)
 sys.stderr.write("Done.\n")
 
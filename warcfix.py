@@ -19,34 +19,268 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>
 from __future__ import print_function
 
 import sys
-from hanzo.warctools import WarcRecord
+import os
+import zlib
+import struct
+import shutil
+from multiprocessing import Pool
+from warcreader import open_archive
+from warcwriter import RecordWriter, compression_for
 import argparse
 
+GZIP_MAGIC = b'\x1f\x8b\x08'
+CHUNK = 1024*1024
+FEED = 64*1024
+
+#####
+#SALVAGE SCANNER
+#####
+
+class _Window(object):
+    """A read buffer over a seekable file, so that scanning forward for
+    and decompressing many small gzip members reads each byte of the file
+    from disk about once."""
+    def __init__(self, f, size=CHUNK):
+        self._f = f
+        self._size = size
+        self._start = 0
+        self._buf = b''
+        self._eof = False
+
+    def get(self, pos, n=FEED):
+        """Return up to n bytes of the file starting at pos (fewer only at
+        the end of the file, where it returns empty)."""
+        bufend = self._start + len(self._buf)
+        if not (self._start <= pos and
+                (pos + n <= bufend or (self._eof and pos <= bufend))):
+            size = max(n, self._size)
+            self._f.seek(pos)
+            self._buf = self._f.read(size)
+            self._start = pos
+            self._eof = len(self._buf) < size
+        off = pos - self._start
+        return self._buf[off:off+n]
+
+def find_member(win, pos, end):
+    """Return the offset of the next gzip member header at or after pos
+    and before end, or None."""
+    overlap = len(GZIP_MAGIC) - 1
+    while pos < end:
+        buf = win.get(pos)
+        if len(buf) < len(GZIP_MAGIC):
+            return None
+        i = buf.find(GZIP_MAGIC)
+        if i >= 0:
+            return pos + i if pos + i < end else None
+        pos += len(buf) - overlap
+    return None
+
+def check_member(win, start, outf=None):
+    """Decompress the gzip member starting at start, checking that it is
+    intact (zlib verifies its CRC) and starts with a WARC record whose
+    Content-Length it covers. Returns the offset at which the member ends,
+    or None if it is not a valid WARC member.
+
+    If outf is given, the compressed bytes of the member are copied to it
+    as they are checked, and removed again if it proves invalid."""
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    head = b''
+    total = 0
+    crc = 0
+    tail = b''
+    pos = start
+    outstart = outf.tell() if outf is not None else None
+    try:
+        while True:
+            buf = win.get(pos)
+            if not buf:
+                # End of file. Complete only if the gzip trailer we last
+                # fed matches what we decompressed.
+                if (len(tail) == 8 and struct.unpack('<II', tail) ==
+                        (crc, total & 0xffffffff)):
+                    break
+                raise ValueError("truncated member")
+            data = d.decompress(buf)
+            if len(head) < FEED:
+                head += data[:FEED-len(head)]
+            total += len(data)
+            crc = zlib.crc32(data, crc) & 0xffffffff
+            if d.unused_data:
+                # The member ended within this buffer
+                used = len(buf) - len(d.unused_data)
+                if outf is not None:
+                    outf.write(buf[:used])
+                pos += used
+                break
+            tail = (tail + buf)[-8:]
+            if outf is not None:
+                outf.write(buf)
+            pos += len(buf)
+            if not head.startswith(b'WARC/'[:len(head)]):
+                raise ValueError("not a WARC record")
+        if not _complete_warc_record(head, total):
+            raise ValueError("not a complete WARC record")
+    except (zlib.error, ValueError):
+        if outf is not None:
+            outf.seek(outstart)
+            outf.truncate()
+        return None
+    return pos
+
+def _complete_warc_record(head, total):
+    """Check that decompressed data starting with head and total bytes
+    long holds a WARC record header and all of its declared content."""
+    if not head.startswith(b'WARC/'):
+        return False
+    hdrend = head.find(b'\r\n\r\n')
+    if hdrend < 0:
+        return False
+    length = None
+    for line in head[:hdrend].split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'content-length':
+            try:
+                length = int(value.strip())
+            except ValueError:
+                return False
+    return length is not None and total >= hdrend + 4 + length
+
+def salvage_range(infn, outfn, rstart, rend):
+    """Copy every valid gzip WARC member starting in [rstart, rend) of infn
+    to outfn, resynchronising on the next valid member after any damage.
+
+    Returns (first, last, damaged, count): the start of the first valid
+    member found, the end of the last, a list of (start, end) damaged
+    byte ranges between them, and the number of members copied."""
+    damaged = []
+    count = 0
+    first = None
+    goodend = None
+    with open(infn, 'rb') as f:
+        with open(outfn, 'wb') as outf:
+            win = _Window(f)
+            pos = find_member(win, rstart, rend)
+            while pos is not None:
+                end = check_member(win, pos, outf)
+                if end is None:
+                    pos = find_member(win, pos + 1, rend)
+                    continue
+                if first is None:
+                    first = pos
+                elif pos > goodend:
+                    damaged.append((goodend, pos))
+                goodend = end
+                count += 1
+                pos = find_member(win, end, rend)
+    return first, goodend, damaged, count
+
+def _salvage_range_star(args):
+    return salvage_range(*args)
+
+def salvage(infn, outfn, processes=1):
+    """Salvage the valid records of a damaged gzipped WARC at infn into
+    outfn, in a single streaming pass. With processes > 1, the file is
+    split into byte ranges scanned in parallel, each resynchronising on
+    its first valid member. Returns (damaged, count)."""
+    size = os.path.getsize(infn)
+    processes = max(1, min(processes, size // CHUNK + 1))
+    bounds = [size * i // processes for i in range(processes + 1)]
+    jobs = [(infn, outfn + '.part%d' % i if processes > 1 else outfn,
+             bounds[i], bounds[i+1]) for i in range(processes)]
+    if processes > 1:
+        p = Pool(processes)
+        results = p.map(_salvage_range_star, jobs, 1)
+        p.close()
+        p.join()
+    else:
+        results = [salvage_range(*jobs[0])]
+
+    damaged = []
+    count = 0
+    prevend = 0
+    for first, last, rdamaged, rcount in results:
+        if first is None:
+            continue
+        if first > prevend:
+            damaged.append((prevend, first))
+        damaged.extend(rdamaged)
+        prevend = last
+        count += rcount
+    if prevend < size:
+        damaged.append((prevend, size))
+
+    if processes > 1:
+        with open(outfn, 'wb') as outf:
+            for job in jobs:
+                with open(job[1], 'rb') as part:
+                    shutil.copyfileobj(part, outf, CHUNK)
+                os.unlink(job[1])
+    return damaged, count
+
+#####
+#ARGUMENT PARSER
+#####
+
 parser = argparse.ArgumentParser(description='Attempt to fix WARC files with '
     'a broken gzipped record. Most WARC tools use the iterator reader, which '
     'fails if any one of the gzip records is damaged.')
-parser.add_argument('infn', help='Input gzipped WARC filename.')
-parser.add_argument('outfn', help='Output gzipped WARC filename.')
-
-args = parser.parse_args()
-
-inwf = WarcRecord.open_archive(args.infn, gzip="auto")
-outwf = open(args.outfn, 'wb')
-for (offset, record, errors) in inwf.read_records(limit=None):
-    # Generates an offset (or None) plus *either* a valid record (and empty
-    # list for errors, *or* a list of errors (and None for record).
-    if errors:
-        print("warc errors at %s:%d"%(args.infn, offset), file=sys.stderr)
-        print(errors, file=sys.stderr)
-        break
-    elif record is not None and record.validate(): # ugh name, returns errorsa
-        print("warc errors at %s:%d"%(args.infn, offset), file=sys.stderr)
-        print(record.validate(), file=sys.stderr)
-        break
-    try:
-        record.validate()
-        record.write_to(outwf, gzip=True)
-    except IOError:
-        print("Failed to read content for record. Skipping.")
-inwf.close()
-outwf.close()
+parser.add_argument('infn', help='Input WARC filename (gzipped, or without '
+                                 '--salvage also .warc.zst).')
+parser.add_argument('outfn', help='Output WARC filename. Gzipped, unless '
+                                  'it ends .zst and --salvage is not given.')
+parser.add_argument('-s', '--salvage', action='store_true',
+                    help='Instead of stopping at the first damaged record, '
+                         'scan forward for the next valid gzip member and '
+                         'WARC record, skipping damaged regions, and '
+                         'carry on. Valid members are copied unchanged.')
+parser.add_argument('-r', '--report', metavar='reportfn',
+                    help='With --salvage, write the damaged byte ranges '
+                         '(start, end, length) to this tab-separated file.')
+parser.add_argument('-j', '--processes', type=int, default=1,
+                    help='With --salvage, scan the file in this many '
+                         'parallel processes. Default: 1.')
+
+#####
+#MAIN
+#####
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.salvage:
+        damaged, count = salvage(args.infn, args.outfn, args.processes)
+        print("Salvaged %d records from %s; %d damaged ranges totalling %d "
+              "bytes." % (count, args.infn, len(damaged),
+                          sum(end - start for start, end in damaged)),
+              file=sys.stderr)
+        report = open(args.report, 'w') if args.report else sys.stderr
+        for start, end in damaged:
+            print(start, end, end - start, sep='\t', file=report)
+        if args.report:
+            report.close()
+        sys.exit(0)
+
+    inwf = open_archive(args.infn)
+    outf = open(args.outfn, 'wb')
+    # Gzipped output unless a .warc.zst is asked for
+    outwf = RecordWriter(outf, compression_for(args.outfn) or 'gzip')
+    for (offset, record, errors) in inwf.read_records(limit=None):
+        # Generates an offset (or None) plus *either* a valid record (and empty
+        # list for errors, *or* a list of errors (and None for record).
+        if errors:
+            print("warc errors at %s:%d"%(args.infn, offset), file=sys.stderr)
+            print(errors, file=sys.stderr)
+            break
+        elif record is None:
+            break
+        elif record is not None and record.validate(): # ugh name, returns errorsa
+            print("warc errors at %s:%d"%(args.infn, offset), file=sys.stderr)
+            print(record.validate(), file=sys.stderr)
+            break
+        try:
+            record.validate()
+            outwf.write(record)
+        except IOError:
+            print("Failed to read content for record. Skipping.")
+    inwf.close()
+    outf.close()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python2
+"""Per-record timing and opt-in profiling for the WARC processing loops of
+WARCTikaProcessor.process and warc2mongodb.warc_to_text.
+
+A RecordMonitor is told when each record starts and when it moves from
+one stage of processing to the next (reading, local extraction, Tika,
+storage...). Any record taking longer than a threshold is written to a
+slow-record log, one tab-separated line giving the file, URL, MIME type,
+size and time spent in each stage. Optionally, it also:
+ - profiles each file with cProfile, dumping the stats to a directory for
+   pstats or snakeviz;
+ - every N records, logs the biggest allocators (where tracemalloc is
+   available) or the resident set size;
+ - installs a signal handler which writes the record being processed, and
+   the stack of every thread, to stderr, so that a wedged worker can be
+   inspected with 'kill -USR1 <pid>'.
+
+Copyright 2014-2016 Tom Nicholls
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+
+#####
+#SETUP
+#####
+
+import sys
+import os
+import time
+import signal
+import cProfile
+import traceback
+from warcpool import current_rss, format_size
+try:
+    import tracemalloc
+except ImportError:
+    # Only in Python 3.4+, or Python 2 with the pytracemalloc backport
+    tracemalloc = None
+
+# The monitors which have processed files in this process, for the signal
+# handler. There is one per thread where threads process files in parallel.
+_active = []
+
+#####
+#UTILITY FUNCTIONS
+#####
+def _dump_state(signum, frame):
+    """Signal handler: write the current record and all stacks to stderr."""
+    out = sys.stderr
+    out.write("\n***** Signal %d: state of process %d\n" %
+              (signum, os.getpid()))
+    for monitor in list(_active):
+        out.write(monitor.describe_current() + "\n")
+    for threadid, threadframe in sys._current_frames().items():
+        out.write("--- Thread %d:\n" % threadid)
+        traceback.print_stack(threadframe, file=out)
+    out.write("*****\n")
+    out.flush()
+
+#####
+#CLASSES
+#####
+
+class NullMonitor(object):
+    """A RecordMonitor which does nothing, used when monitoring is off."""
+    def start_file(self, infn):
+        pass
+    def end_file(self):
+        pass
+    def start_record(self, url, mimetype=None, size=0):
+        pass
+    def note(self, mimetype=None, size=None):
+        pass
+    def mark(self, stage):
+        pass
+    def end_record(self):
+        pass
+    def install_handler(self):
+        pass
+
+NULL_MONITOR = NullMonitor()
+
+class RecordMonitor(NullMonitor):
+    """Times the records of a processing loop, stage by stage.
+
+       slowlog: filename to append slow-record lines to (opened afresh in
+           each process), or None to write them to stderr;
+       threshold: seconds a record must take to be logged as slow;
+       profiledir: if given, each file is profiled with cProfile and the
+           stats dumped to <profiledir>/<file>.<pid>.prof;
+       memevery: if non-zero, log memory use every this many records: the
+           top allocation sites if tracemalloc is available (it is started
+           if need be), otherwise the resident set size;
+       dumpsignal: a signal number (such as signal.SIGUSR1) on which to
+           dump the current record and stacks to stderr, or None. The
+           handler is installed when the monitor is made, so processes
+           forked afterwards inherit it; pool initializers should call
+           install_handler() again. Handlers can only be installed from
+           the main thread, so a monitor made in any other thread must
+           leave this as None; the handler describes the current record
+           of every monitor in the process.
+
+       The time between one record ending and the next starting is
+       counted as its 'read' stage."""
+    def __init__(self, slowlog=None, threshold=5.0, profiledir=None,
+                 memevery=0, dumpsignal=None):
+        self._slowlogfn = slowlog
+        self._threshold = threshold
+        self._profiledir = profiledir
+        self._memevery = memevery
+        self._dumpsignal = dumpsignal
+        self._pid = None
+        self._log = None
+        self._profiler = None
+        self._infn = None
+        self._records = 0
+        self._lastend = time.time()
+        self._url = None
+        self._stages = []
+        self.install_handler()
+
+    def install_handler(self):
+        """Install the dump signal handler in this process. Until it is,
+        the signal has its default action, which for SIGUSR1 is to
+        terminate the process. Must be called from the main thread."""
+        if self._dumpsignal is None:
+            return
+        signal.signal(self._dumpsignal, _dump_state)
+
+    def _setup_process(self):
+        """Open the log, once per process (monitors may be created before
+        a pool forks its workers)."""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        if self._slowlogfn is None:
+            self._log = sys.stderr
+        else:
+            self._log = open(self._slowlogfn, 'a', 1)
+        if self._memevery and tracemalloc is not None:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+        if self not in _active:
+            _active.append(self)
+
+    def start_file(self, infn):
+        self._setup_process()
+        self._infn = infn
+        self._lastend = time.time()
+        if self._profiledir is not None:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def end_file(self):
+        if self._profiler is not None:
+            self._profiler.disable()
+            fn = os.path.join(self._profiledir, "%s.%d.prof" %
+                              (os.path.basename(str(self._infn)),
+                               os.getpid()))
+            self._profiler.dump_stats(fn)
+            self._profiler = None
+        self._infn = None
+
+    def start_record(self, url, mimetype=None, size=0):
+        """Start timing a record, in its 'read' stage."""
+        self._url = url
+        self._mimetype = mimetype
+        self._size = size
+        self._stages = [['read', self._lastend, None]]
+
+    def note(self, mimetype=None, size=None):
+        """Fill in the current record's MIME type or size once known."""
+        if mimetype is not None:
+            self._mimetype = mimetype
+        if size is not None:
+            self._size = size
+
+    def mark(self, stage):
+        """End the current stage of the record and start stage."""
+        now = time.time()
+        if self._stages:
+            self._stages[-1][2] = now
+        self._stages.append([stage, now, None])
+
+    def end_record(self):
+        now = time.time()
+        self._lastend = now
+        if not self._stages:
+            return
+        self._stages[-1][2] = now
+        total = now - self._stages[0][1]
+        if total >= self._threshold:
+            self._write_slow(total)
+        self._stages = []
+        self._url = None
+        self._records += 1
+        if self._memevery and self._records % self._memevery == 0:
+            self._write_memory()
+
+    def _write_slow(self, total):
+        # Add up stages entered more than once (e.g. via retries)
+        times = {}
+        order = []
+        for stage, start, end in self._stages:
+            if stage not in times:
+                order.append(stage)
+                times[stage] = 0.0
+            times[stage] += end - start
+        self._log.write("\t".join([
+            "SLOW", time.strftime("%Y-%m-%dT%H:%M:%S"), str(os.getpid()),
+            str(self._infn), str(self._url), str(self._mimetype),
+            str(self._size), "%.3f" % total,
+            ",".join("%s=%.3f" % (s, times[s]) for s in order)]) + "\n")
+
+    def _write_memory(self):
+        if tracemalloc is not None:
+            stats = tracemalloc.take_snapshot().statistics('lineno')[:10]
+            lines = ["  " + str(stat) for stat in stats]
+            self._log.write("MEMORY\t%s\t%d records\n%s\n" %
+                            (self._infn, self._records, "\n".join(lines)))
+        else:
+            self._log.write("MEMORY\t%s\t%d records\tRSS %s\n" %
+                            (self._infn, self._records,
+                             format_size(current_rss())))
+
+    def describe_current(self):
+        """Return a description of the record being processed."""
+        if not self._stages:
+            return "File %s: between records" % self._infn
+        stage, start, _ = self._stages[-1]
+        return ("File %s: record %s (%s, %s bytes), in stage %s for %.1fs "
+                "(%.1fs on the record)" %
+                (self._infn, self._url, self._mimetype, self._size, stage,
+                 time.time() - start, time.time() - self._stages[0][1]))
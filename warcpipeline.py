@@ -0,0 +1,285 @@
+#!/usr/bin/env python2
+"""Processing one WARC with several processes, for warc2mongodb.
+
+warc_to_text processes a file's records one after another, so its
+CPU-bound stages (decoding, and reducing HTML to text with BeautifulSoup
+or readability) use a single core however big the file. A pipeline splits
+the work over:
+ - a reader process, which decompresses and parses the records, applies
+   the same filters as warc_to_text (wanted records, stored documents,
+   documents Tika has already failed on) and hands out the bodies;
+ - a number of extractor processes, which convert (locally or through
+   Tika) and reduce each document to text;
+ - a writer, the calling process, which saves the text to MongoDB, and
+   returns the revisits of documents in other files, as warc_to_text
+   does.
+
+Bodies are passed from the reader to the extractors through slots in a
+shared memory buffer, not pickled through a pipe; only bodies too large
+for a slot are sent inline. The buffer and the queues are bounded, so a
+reader which gets ahead of the extractors, or extractors ahead of the
+writer, wait.
+
+The processes are forked, so a pipeline can't run inside a pool worker
+(they are daemonic); run files one at a time instead (see
+warcpool.run_serial).
+
+Copyright 2014-2016 Tom Nicholls
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+
+#####
+#SETUP
+#####
+
+import sys
+import mmap
+import traceback
+import multiprocessing
+from Queue import Empty
+from collections import defaultdict
+import warc2mongodb
+from warc2mongodb import (doc_from_warc, doc_wanted,
+                          convert_doc, reduce_doc, save_doc, stored_skipper,
+                          sample_counter, TextCache,
+                          get_content_filter_dropset, get_tika_client,
+                          get_mongo_client, bs_html_to_better_text)
+from warctika import TikaProvenance
+from textnorm import NormaliseStats
+from warcmonitor import NULL_MONITOR
+
+#####
+#CLASSES
+#####
+
+class SlotBuffer(object):
+    """nslots buffers of slotsize bytes in anonymous shared memory, for
+    passing document bodies to processes forked after it is made. put()
+    waits for a slot to be free, so the number of bodies in flight is
+    bounded."""
+    def __init__(self, nslots, slotsize):
+        self.slotsize = slotsize
+        self._mm = mmap.mmap(-1, nslots * slotsize)
+        self._free = multiprocessing.Queue()
+        for slot in range(nslots):
+            self._free.put(slot)
+
+    def put(self, data):
+        """Copy data (of at most slotsize bytes) into a free slot, waiting
+        for one if need be, and return the slot's number."""
+        slot = self._free.get()
+        offset = slot * self.slotsize
+        self._mm[offset:offset + len(data)] = data
+        return slot
+
+    def take(self, slot, length):
+        """Return the length bytes in slot, and free it."""
+        offset = slot * self.slotsize
+        data = self._mm[offset:offset + length]
+        self._free.put(slot)
+        return data
+
+    def close(self):
+        self._mm.close()
+
+#####
+#PROCESSES
+#####
+def _reader(infn, gzi, stored, sampler, buf, work, results, nextractors):
+    """Read the documents of infn, passing them to the extractors through
+    buf and work, then one None for each extractor."""
+    tiercounts = defaultdict(int)
+    try:
+        provenance = TikaProvenance()
+        skip = None
+        if stored is not None:
+            skip = stored_skipper(stored, tiercounts)
+        sample = offsets = None
+        if sampler is not None:
+            sample = sample_counter(sampler, tiercounts)
+            offsets, tiercounts['sample-unread'] = sampler.offsets_for(infn)
+        revisits = []
+        docs = doc_from_warc(infn, gzip=gzi, wanted=doc_wanted,
+                             provenance=provenance, skip=skip,
+                             sample=sample, offsets=offsets,
+                             unresolved=lambda *revisit:
+                                 revisits.append(revisit))
+        for (url, mimetype, body, httpcode, charset, digest) in docs:
+            if len(body) <= buf.slotsize:
+                work.put((url, mimetype, buf.put(body), len(body),
+                          httpcode, charset, digest))
+            else:
+                tiercounts['pipeline-inline'] += 1
+                work.put((url, mimetype, None, body, httpcode, charset,
+                          digest))
+        tiercounts['viatika-converted'] = len(provenance.converted)
+        tiercounts['viatika-failed'] = len(provenance.failed)
+        if revisits:
+            results.put(('revisits', revisits))
+    except Exception:
+        results.put(('error', traceback.format_exc()))
+    finally:
+        for _ in range(nextractors):
+            work.put(None)
+        results.put(('counts', dict(tiercounts)))
+
+def _extractor(infn, buf, work, results, discardfilter, html_to_text,
+               tikaurl, localextract, pdfscreen, monitor, normalise,
+               textcache):
+    """Convert and reduce documents from work until a None, sending the
+    text to be saved to results. Each extractor has its own copy of
+    textcache."""
+    # Don't share the parent's connections to Tika
+    warc2mongodb._tikaclients.clear()
+    tikaclient = get_tika_client(tikaurl)
+    tiercounts = defaultdict(int)
+    normstats = NormaliseStats() if normalise else None
+    monitor.start_file(infn)
+    try:
+        while True:
+            item = work.get()
+            if item is None:
+                break
+            url, mimetype, slot, data, httpcode, charset, digest = item
+            body = data if slot is None else buf.take(slot, data)
+            monitor.start_record(url, mimetype, len(body))
+            try:
+                converted = convert_doc(mimetype, body, charset, tikaclient,
+                                        localextract, pdfscreen, tiercounts,
+                                        monitor, normstats=normstats)
+                if converted is None:
+                    continue
+                mimetype, body, charset = converted
+                monitor.mark('reduce')
+                text = reduce_doc(url, mimetype, body, httpcode, charset,
+                                  discardfilter, html_to_text, textcache,
+                                  tiercounts)
+                if text is not None:
+                    results.put(('doc', url, text, digest))
+            except Exception:
+                sys.stderr.write("\n\n***** Uncaught exception processing "+
+                                 url+" from "+infn+":\n")
+                traceback.print_exc()
+                sys.stderr.write("Continuing.\n\n\n")
+            finally:
+                monitor.end_record()
+    finally:
+        monitor.end_file()
+    if normstats is not None:
+        tiercounts.update(normstats.counts())
+    results.put(('counts', dict(tiercounts)))
+
+#####
+#PIPELINE
+#####
+def pipeline_warc_to_text(infn, extractors=None, discardfilter=None,
+                          html_to_text=bs_html_to_better_text, gzi='auto',
+                          tikaurl='http://localhost:9998/tika',
+                          localextract=True, pdfscreen=0.9,
+                          mongoclient=None, monitor=None, stored=None,
+                          normalise=False, sampler=None, textcache=None,
+                          slots=None, slotsize=1024*1024):
+    """Process a WARC at a given infn to text stored in MongoDB, as
+       warc2mongodb.warc_to_text does, but with a reader process and a
+       number of extractor processes. Returns a dict of the numbers of
+       documents (and bytes) handled by each extraction tier, and the
+       revisits to pass to resolve_revisits, as warc_to_text does; raises
+       an Exception if the reader or an extractor failed.
+
+       :extractors: number of extractor processes (default: cpu_count()).
+       :tikaurl:    the Tika server each extractor sends documents to.
+       :slots:      number of shared memory slots for bodies in flight
+                    (default: four per extractor).
+       :slotsize:   size of each slot; larger bodies are sent inline.
+
+       Other arguments, and their defaults from init_worker, are as for
+       warc_to_text. Tika batching is not used: the extractors already
+       keep several requests in flight. Each extractor starts with a copy
+       of textcache, so duplicates are only found within an extractor."""
+    w = warc2mongodb._worker
+    if discardfilter is None:
+        discardfilter = (w.get('discardfilter') or
+                         get_content_filter_dropset({}))
+    if mongoclient is None:
+        mongoclient = w.get('mongoclient') or get_mongo_client()
+    if monitor is None:
+        monitor = w.get('monitor') or NULL_MONITOR
+    if stored is None:
+        stored = w.get('stored')
+    if sampler is None:
+        sampler = w.get('sampler')
+    if textcache is None:
+        textcache = w.get('textcache')
+    if extractors is None:
+        extractors = multiprocessing.cpu_count()
+    if slots is None:
+        slots = 4 * extractors
+    buf = SlotBuffer(slots, slotsize)
+    work = multiprocessing.Queue(slots)
+    results = multiprocessing.Queue(4 * extractors)
+    procs = [multiprocessing.Process(target=_reader,
+                 args=(infn, gzi, stored, sampler, buf, work, results,
+                       extractors))]
+    for _ in range(extractors):
+        procs.append(multiprocessing.Process(target=_extractor,
+            args=(infn, buf, work, results, discardfilter, html_to_text,
+                  tikaurl, localextract, pdfscreen, monitor, normalise,
+                  textcache)))
+    for p in procs:
+        p.daemon = True
+        p.start()
+
+    tiercounts = defaultdict(int)
+    errors = []
+    revisits = []
+    pending = len(procs)
+    try:
+        while pending:
+            try:
+                msg = results.get(timeout=1)
+            except Empty:
+                dead = [p for p in procs if p.exitcode not in (None, 0)]
+                if dead:
+                    errors.append("%s exited with %s" %
+                                  (dead[0].name, dead[0].exitcode))
+                    break
+                continue
+            if msg[0] == 'doc':
+                save_doc(mongoclient, *msg[1:])
+            elif msg[0] == 'revisits':
+                revisits.extend(msg[1])
+            elif msg[0] == 'counts':
+                for k, v in msg[1].iteritems():
+                    tiercounts[k] += v
+                pending -= 1
+            else:
+                errors.append(msg[1])
+    finally:
+        if pending:
+            for p in procs:
+                p.terminate()
+        for p in procs:
+            p.join()
+        buf.close()
+    if textcache is not None:
+        sys.stderr.write("****Duplicates: "+TextCache.report(tiercounts)+
+                         "\n")
+    sys.stderr.write("****Extraction tiers: "+str(tiercounts.items())+"\n")
+    if errors:
+        raise Exception("Pipeline for "+infn+" failed:\n"+"\n".join(errors))
+    sys.stderr.write("****Finished file.\n")
+    tiercounts = dict(tiercounts)
+    tiercounts['revisits'] = revisits
+    return tiercounts
@@ -0,0 +1,397 @@
+#!/usr/bin/env python2
+"""Process pool scheduling for running per-file WARC jobs (such as
+warc2mongodb.warc_to_text) across many files.
+
+Files are handed out largest-first (by size on disk, or by a cost estimate
+from an index), so that a few huge WARCs at the end of a list do not leave
+most of the workers idle. Results are collected as they complete, with
+progress and an ETA written to stderr, and workers can be recycled after a
+number of files or once their resident set grows beyond a limit.
+
+Per-worker setup is done by an initializer (see run_pool) rather than per
+task. Large read-only lookup tables, such as the URL filter set, should be
+held in a DigestSet and handed to the initializer: its memory is shared
+with the workers by fork() (or mapped from a file), never pickled.
+
+Copyright 2014-2016 Tom Nicholls
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+
+#####
+#SETUP
+#####
+
+import sys
+import os
+import time
+import resource
+import mmap
+import pickle
+import traceback
+from functools import partial
+from multiprocessing.pool import Pool, MaybeEncodingError
+
+#####
+#UTILITY FUNCTIONS
+#####
+def current_rss():
+    """Return the resident set size of this process in bytes. Uses
+    /proc where available (Linux), otherwise falls back to the peak RSS
+    reported by getrusage(), which is good enough for a recycling limit."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        # ru_maxrss is in kilobytes on Linux, bytes on OS X.
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            return maxrss
+        return maxrss * 1024
+
+def parse_size(s):
+    """Parse a human-friendly size such as '1.5G', '800M' or '4096' into
+    a number of bytes."""
+    if s is None:
+        return None
+    s = str(s).strip().upper()
+    multipliers = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    if s and s[-1] == 'B':
+        s = s[:-1]
+    if s and s[-1] in multipliers:
+        return int(float(s[:-1]) * multipliers[s[-1]])
+    return int(s)
+
+def format_size(n):
+    """Format a number of bytes for progress output."""
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(n) < 1024.0:
+            return "%.1f%s" % (n, unit)
+        n /= 1024.0
+    return "%.1fTB" % n
+
+def format_duration(secs):
+    """Format a number of seconds as H:MM:SS."""
+    secs = int(secs)
+    return "%d:%02d:%02d" % (secs // 3600, (secs % 3600) // 60, secs % 60)
+
+def load_costs(costfn):
+    """Load an index-estimated cost table from a tab-separated file of
+    filename<TAB>cost lines (for example the Tika-eligible byte total of
+    each file from listwarccts.py). Returns a dict of filename -> cost."""
+    costs = {}
+    with open(costfn, 'rb') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line or line.startswith('#'):
+                continue
+            fn, cost = line.rsplit('\t', 1)
+            try:
+                costs[fn] = float(cost)
+            except ValueError:
+                # Probably a header line
+                continue
+    return costs
+
+def order_files(files, order='size', costs=None):
+    """Return (files, costs) with files sorted for scheduling.
+
+       :order: 'size' (largest file first), 'cost' (largest cost from the
+               costs table first, falling back to file size for files
+               absent from the table) or 'list' (as given).
+       :costs: a dict of filename -> estimated cost, used for 'cost'
+               ordering.
+
+       The returned costs dict contains the cost used for every file, so
+       that progress can be reported in the same units."""
+    filecosts = {}
+    for fn in files:
+        if order == 'cost' and costs and fn in costs:
+            filecosts[fn] = costs[fn]
+            continue
+        try:
+            filecosts[fn] = os.path.getsize(fn)
+        except OSError:
+            filecosts[fn] = 0
+    if order == 'list':
+        return list(files), filecosts
+    if order not in ('size', 'cost'):
+        raise ValueError("order must be 'size', 'cost' or 'list'")
+    # Stable sort, so equal-cost files keep their list order
+    return sorted(files, key=lambda fn: -filecosts[fn]), filecosts
+
+#####
+#CLASSES
+#####
+
+class DigestSet(object):
+    """A read-only set of fixed-width digests (such as MD5s of URLs),
+    held as one sorted block of memory and searched by bisection.
+
+    Unlike a set of strings, which costs around 100 bytes per entry and
+    whose pages are dirtied (and so copied) by reference counting in each
+    worker, a DigestSet costs width bytes per entry and its memory is
+    genuinely shared: anonymous mappings are inherited over fork(), and
+    file-backed ones (see save() and load()) are shared through the page
+    cache, even between runs."""
+    def __init__(self, data, width=16, filename=None):
+        self._data = data
+        self.width = width
+        self.filename = filename
+        if len(data) % width:
+            raise ValueError("DigestSet data is not a whole number of "
+                             "%d byte digests" % width)
+        self._len = len(data) // width
+
+    @classmethod
+    def from_iterable(cls, digests, width=16):
+        """Build a DigestSet in anonymous shared memory from an iterable
+        of digest strings, each width bytes long."""
+        digests = sorted(set(digests))
+        for d in digests:
+            if len(d) != width:
+                raise ValueError("Digest of %d bytes in a set of %d byte "
+                                 "digests" % (len(d), width))
+        if not digests:
+            return cls('', width)
+        data = mmap.mmap(-1, len(digests) * width)
+        for d in digests:
+            data.write(d)
+        return cls(data, width)
+
+    @classmethod
+    def load(cls, filename, width=16):
+        """Map a DigestSet saved by save() from filename."""
+        with open(filename, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return cls('', width, filename)
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(data, width, filename)
+
+    def save(self, filename):
+        """Write the set to filename, for load() to map later."""
+        with open(filename, 'wb') as f:
+            f.write(self._data[:])
+        self.filename = filename
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, digest):
+        if len(digest) != self.width:
+            return False
+        data, w = self._data, self.width
+        lo, hi = 0, self._len
+        while lo < hi:
+            mid = (lo + hi) // 2
+            d = data[mid*w:mid*w+w]
+            if d < digest:
+                lo = mid + 1
+            elif d > digest:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def __reduce__(self):
+        # A file-backed set pickles as its filename. An anonymous one
+        # can't be pickled: pass it to the pool initializer instead.
+        if self.filename is None:
+            raise pickle.PicklingError("Anonymous DigestSets are shared by "
+                                       "fork(), not pickled: pass them in "
+                                       "initargs")
+        return (_load_digestset, (self.filename, self.width))
+
+def _load_digestset(filename, width):
+    # Module-level, as bound classmethods can't be pickled
+    return DigestSet.load(filename, width)
+
+def _recycling_worker(inqueue, outqueue, initializer=None, initargs=(),
+                      maxtasks=None, maxrss=None):
+    """Pool worker loop, as multiprocessing.pool.worker but also exiting
+    (to be replaced by the pool) once the worker's RSS passes maxrss.
+    The check is made after the result of a task has been sent, so no
+    work is lost when a worker is recycled."""
+    put = outqueue.put
+    get = inqueue.get
+    if hasattr(inqueue, '_writer'):
+        inqueue._writer.close()
+        outqueue._reader.close()
+
+    if initializer is not None:
+        initializer(*initargs)
+
+    completed = 0
+    while maxtasks is None or (maxtasks and completed < maxtasks):
+        try:
+            task = get()
+        except (EOFError, IOError):
+            break
+
+        if task is None:
+            break
+
+        job, i, func, args, kwds = task
+        try:
+            result = (True, func(*args, **kwds))
+        except Exception, e:
+            result = (False, e)
+        try:
+            put((job, i, result))
+        except Exception as e:
+            put((job, i, (False, MaybeEncodingError(e, result[1]))))
+
+        task = job = result = func = args = kwds = None
+        completed += 1
+        if maxrss and current_rss() > maxrss:
+            sys.stderr.write("Worker %d using %s after %d tasks; recycling.\n"
+                             % (os.getpid(), format_size(current_rss()),
+                                completed))
+            break
+
+class RecyclingPool(Pool):
+    """A multiprocessing Pool whose workers are replaced after
+    maxtasksperchild tasks (as standard) or once their resident set size
+    exceeds maxrss bytes, to bound the memory growth of long-running
+    lxml/BeautifulSoup workers."""
+    def __init__(self, processes=None, initializer=None, initargs=(),
+                 maxtasksperchild=None, maxrss=None):
+        # Must be set before Pool.__init__, which starts the workers.
+        self._maxrss = maxrss
+        super(RecyclingPool, self).__init__(processes, initializer,
+                                            initargs, maxtasksperchild)
+
+    def _repopulate_pool(self):
+        for i in range(self._processes - len(self._pool)):
+            w = self.Process(target=_recycling_worker,
+                             args=(self._inqueue, self._outqueue,
+                                   self._initializer, self._initargs,
+                                   self._maxtasksperchild, self._maxrss))
+            self._pool.append(w)
+            w.name = w.name.replace('Process', 'PoolWorker')
+            w.daemon = True
+            w.start()
+
+class ProgressReporter(object):
+    """Report per-file completion, throughput and an ETA to a stream.
+    The ETA is estimated from the proportion of the total cost (normally
+    bytes) completed, which suits largest-first scheduling better than a
+    simple file count."""
+    def __init__(self, costs, stream=sys.stderr):
+        self._costs = costs
+        self._total = sum(costs.values())
+        self._stream = stream
+        self._start = time.time()
+        self.done = 0
+        self.donecost = 0
+        self.failed = []
+
+    def update(self, fn, ok=True, elapsed=None):
+        self.done += 1
+        self.donecost += self._costs.get(fn, 0)
+        if not ok:
+            self.failed.append(fn)
+        wall = time.time() - self._start
+        if self.donecost and self._total:
+            fraction = float(self.donecost) / self._total
+            eta = format_duration(wall / fraction - wall)
+        else:
+            fraction = float(self.done) / max(len(self._costs), 1)
+            eta = '?'
+        self._stream.write(
+            "[%d/%d %.1f%%] %s %s (%s%s) elapsed %s ETA %s\n" %
+            (self.done, len(self._costs), fraction * 100,
+             'done' if ok else 'FAILED', fn,
+             format_size(self._costs.get(fn, 0)),
+             ', %.1fs' % elapsed if elapsed is not None else '',
+             format_duration(wall), eta))
+        self._stream.flush()
+
+def _timed_call(func, fn):
+    """Run func(fn) in a worker, returning (fn, ok, elapsed, result).
+    Exceptions are reported and swallowed so that one bad file doesn't
+    take down the pool."""
+    start = time.time()
+    result = None
+    try:
+        result = func(fn)
+        ok = True
+    except Exception:
+        sys.stderr.write("\n\n***** Uncaught exception processing file "+
+                         str(fn)+":\n")
+        traceback.print_exc()
+        ok = False
+    return fn, ok, time.time() - start, result
+
+def run_pool(func, files, processes=None, order='size', costs=None,
+             maxtasksperchild=None, maxrss=None, initializer=None,
+             initargs=(), stream=sys.stderr, collect=None):
+    """Run func(filename) over files in a process pool, largest first,
+    reporting progress as each file completes.
+
+       :func:      a picklable callable taking a filename
+       :processes: number of workers (default: cpu_count())
+       :order:     'size', 'cost' or 'list' (see order_files)
+       :costs:     optional dict of filename -> index-estimated cost
+       :maxtasksperchild: recycle workers after this many files
+       :maxrss:    recycle workers whose RSS exceeds this many bytes
+       :initializer: called as initializer(*initargs) once in each worker
+                   as it starts, for one-time setup (connections, imports,
+                   shared state). initargs reach the workers by fork(), so
+                   need not be picklable; only func and the filenames are
+                   sent with each task.
+       :collect:   called in this process with what func returned for each
+                   file which succeeded (which must be picklable).
+
+       Returns the list of files which failed."""
+    files, filecosts = order_files(files, order, costs)
+    progress = ProgressReporter(filecosts, stream)
+    stream.write("Scheduling %d files (%s) in %s order.\n" %
+                 (len(files), format_size(sum(filecosts.values())), order))
+    p = RecyclingPool(processes, initializer, initargs,
+                      maxtasksperchild, maxrss)
+    try:
+        for fn, ok, elapsed, result in p.imap_unordered(
+                partial(_timed_call, func), files, 1):
+            progress.update(fn, ok, elapsed)
+            if ok and collect is not None:
+                collect(result)
+        p.close()
+    except KeyboardInterrupt:
+        p.terminate()
+        raise
+    finally:
+        p.join()
+    return progress.failed
+
+def run_serial(func, files, order='size', costs=None, initializer=None,
+               initargs=(), stream=sys.stderr, collect=None):
+    """Run func(filename) over files one at a time in this process, with
+    the same ordering and progress reporting as run_pool, for jobs which
+    parallelise within a file (see warcpipeline). initializer(*initargs)
+    is called once first, and collect, if given, with what func returned
+    for each file which succeeded. Returns the list of files which
+    failed."""
+    files, filecosts = order_files(files, order, costs)
+    progress = ProgressReporter(filecosts, stream)
+    stream.write("Processing %d files (%s) in %s order.\n" %
+                 (len(files), format_size(sum(filecosts.values())), order))
+    if initializer is not None:
+        initializer(*initargs)
+    for fn in files:
+        fn, ok, elapsed, result = _timed_call(func, fn)
+        progress.update(fn, ok, elapsed)
+        if ok and collect is not None:
+            collect(result)
+    return progress.failed
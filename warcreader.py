@@ -0,0 +1,426 @@
+#!/usr/bin/env python2
+"""Lazy reading of WARC records, for tools which decide what to do with a
+record from its headers and only sometimes need its body.
+
+hanzo's RecordStream gives each record a content_file bounded to its
+payload, but anything which touches record.content reads the whole
+payload into a string. A LazyRecord wraps a record so that its WARC
+headers are available immediately, the HTTP header block of a response
+record can be read and parsed without reading the body behind it, and the
+body is only materialised when first asked for. iter_lazy_records()
+generates LazyRecords from a stream, skipping over the payloads of records
+whose bodies were never read: by seeking, for uncompressed files, or
+otherwise in small chunks.
+
+For uncompressed files MmapRecordStream goes further, memory-mapping the
+file and parsing headers in place. Its MmapRecords behave like
+LazyRecords, but their bodies are views into the mapping (memoryview
+where the mmap supports it, otherwise Python 2 buffer objects), so they
+can be matched, written out or sent to Tika without being copied into
+new strings.
+
+open_archive() opens gzipped, Zstandard-compressed (.warc.zst) or plain
+WARC files alike, detecting the format from the file's first bytes.
+
+Copyright 2014-2016 Tom Nicholls
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+
+#####
+#SETUP
+#####
+
+import os
+import io
+import mmap
+import struct
+from gzip import GzipFile
+from hanzo.warctools import WarcRecord
+from hanzo.warctools.stream import RecordStream, GzipRecordStream
+from warcresponseparse import (read_http_header_block,
+                               parse_http_header_block, parse_content_type,
+                               parse_http_response_block,
+                               parse_http_response_charset)
+import warcwriter
+from warcwriter import ZSTD_MAGIC, DICT_MAGIC
+
+#####
+#CLASSES
+#####
+
+class _PrefixedFile(object):
+    """A read-only file-like object which returns prefix and then the rest
+    of fh, used to put back an HTTP header block which has been read from
+    a record's content_file so that the record can still be written out
+    or materialised whole."""
+    def __init__(self, prefix, fh):
+        self._prefix = prefix
+        self._fh = fh
+
+    def read(self, count=None):
+        if not self._prefix:
+            return self._fh.read(count)
+        if count is not None and count < len(self._prefix):
+            result = self._prefix[:count]
+            self._prefix = self._prefix[count:]
+            return result
+        result = self._prefix
+        self._prefix = ''
+        if count is None:
+            return result + self._fh.read()
+        return result + self._fh.read(count - len(result))
+
+    def close(self):
+        self._fh.close()
+
+class _HTTPHeadersMixin(object):
+    """http_content_type() for classes providing http_headers()."""
+    def http_content_type(self):
+        """Return (mimetype, charset) from the HTTP Content-Type header of
+        a response record, without reading its body. Either may be None."""
+        _, headers = self.http_headers()
+        ctypes = [v for k, v in headers if k.lower() == 'content-type']
+        if not ctypes:
+            return None, None
+        return parse_content_type(ctypes[0])
+
+class LazyRecord(_HTTPHeadersMixin):
+    """Wraps a hanzo WarcRecord, deferring reading of its content.
+
+       Attributes not defined here (headers, type, url, id, get_header,
+       content, write_to etc.) are those of the wrapped record. Reading
+       the HTTP header block through http_headers() does not stop the
+       record being written out intact with write_to()."""
+    def __init__(self, record, offset=None):
+        self.record = record
+        self.offset = offset
+        self._http = None
+        self._response = None
+
+    def __getattr__(self, name):
+        return getattr(self.record, name)
+
+    def body_read(self):
+        """True if the record's content has been materialised."""
+        return self.record.content_file is None
+
+    def http_headers(self):
+        """Return (code, headers) for an HTTP response record, reading only
+        its HTTP header block. code is a string, or None if the status
+        line is unreadable; headers is a list of (name, value) tuples."""
+        if self._http is None:
+            fh = self.record.content_file
+            if fh is None:
+                content = self.record.content[1]
+                end = content.find('\r\n\r\n')
+                block = content[:end+4] if end >= 0 else content[:65536]
+            else:
+                block = read_http_header_block(self.record)
+                self.record.content_file = _PrefixedFile(block, fh)
+            self._http = parse_http_header_block(block)
+        return self._http
+
+    def http_response(self):
+        """Materialise and parse an HTTP response record, returning code,
+        mimetype, charset and body (see parse_http_response_charset)."""
+        if self._response is None:
+            self._response = parse_http_response_charset(self.record)
+        return self._response
+
+#####
+#UTILITY FUNCTIONS
+#####
+def _skim(inwf):
+    """Move an uncompressed record stream past the unread remainder of the
+    current record's payload by seeking, rather than letting the stream
+    read through it. Other streams are left to skip it themselves."""
+    if type(inwf) is not RecordStream or not inwf.bytes_to_eoc:
+        return
+    try:
+        inwf.fh.seek(inwf.bytes_to_eoc, 1)
+    except (IOError, AttributeError):
+        # Not seekable (e.g. stdin)
+        return
+    inwf.bytes_to_eoc = 0
+
+def iter_lazy_records(inwf):
+    """Generate a LazyRecord for each record of a hanzo record stream (as
+    returned by WarcRecord.open_archive). Like iterating over the stream
+    itself, raises an Exception if a record cannot be decoded."""
+    for offset, record, errors in inwf.read_records(limit=None):
+        if record:
+            yield LazyRecord(record, offset)
+        elif errors:
+            raise Exception("Errors while decoding %s" %
+                            ",".join(str(error) for error in errors))
+        else:
+            break
+        _skim(inwf)
+
+def can_seek_records(inwf):
+    """True if the records of stream inwf (from open_archive) can be read
+    at the offsets its read_records() gives, as for uncompressed and
+    record-gzipped files but not .warc.zst ones."""
+    return (type(inwf) is GzipRecordStream or
+            (type(inwf) is RecordStream and isinstance(inwf.fh, file)))
+
+def iter_records_at(inwf, offsets):
+    """Generate a LazyRecord for the record at each of offsets (as given
+    by read_records(), e.g. in an index from listwarccts.py) in stream
+    inwf, seeking over everything in between. See can_seek_records()."""
+    for offset in offsets:
+        inwf.seek(offset)
+        # Don't skip the rest of the last record from the new position
+        inwf.bytes_to_eoc = None
+        for _, record, errors in inwf.read_records(limit=1):
+            if record:
+                yield LazyRecord(record, offset)
+            elif errors:
+                raise Exception("Errors while decoding record at %d: %s" %
+                                (offset, ",".join(str(error)
+                                                  for error in errors)))
+
+def is_zstd_file(fh):
+    """True if the file handle fh is positioned at the start of a
+    Zstandard frame (or .warc.zst dictionary). Does not move it."""
+    offset = fh.tell()
+    magic = fh.read(4)
+    fh.seek(offset)
+    return magic in (ZSTD_MAGIC, DICT_MAGIC)
+
+def open_zstd_archive(fh):
+    """Return a hanzo RecordStream reading the records of the .warc.zst
+    file open as fh, using the dictionary stored at its start, if any.
+
+    Offsets from the stream's read_records() are positions in the
+    decompressed data, not in the file."""
+    warcwriter.require_zstandard()
+    zstandard = warcwriter.zstandard
+    kw = {}
+    magic = fh.read(4)
+    if magic == DICT_MAGIC:
+        size, = struct.unpack('<I', fh.read(4))
+        dictionary = fh.read(size)
+        if dictionary.startswith(ZSTD_MAGIC):
+            # The dictionary may itself be compressed
+            dictionary = zstandard.ZstdDecompressor().decompress(dictionary)
+        kw['dict_data'] = zstandard.ZstdCompressionDict(dictionary)
+    else:
+        # Put back what we read, without needing to seek
+        fh = _PrefixedFile(magic, fh)
+    reader = zstandard.ZstdDecompressor(**kw).stream_reader(
+        fh, read_across_frames=True)
+    return RecordStream(io.BufferedReader(reader, 1024*1024),
+                        WarcRecord.make_parser())
+
+def open_archive(filename=None, file_handle=None, gzip='auto'):
+    """Open a WARC file (or file handle), as WarcRecord.open_archive() does
+    but also reading .warc.zst files.
+
+       :gzip: as for WarcRecord.open_archive(), or 'zstd'. If 'auto',
+              Zstandard compression is detected from the first bytes of
+              the file, so file_handle must be seekable."""
+    if file_handle is None:
+        file_handle = open(filename, 'rb')
+    if gzip == 'zstd' or (gzip == 'auto' and is_zstd_file(file_handle)):
+        return open_zstd_archive(file_handle)
+    return WarcRecord.open_archive(filename=filename, file_handle=file_handle,
+                                   mode='rb', gzip=gzip)
+
+#####
+#MEMORY-MAPPED READING
+#####
+
+def _parse_warc_headers(block):
+    """Parse the header lines of a WARC record (after the version line)
+    into a list of (name, value) tuples."""
+    headers = []
+    for line in block.split('\r\n'):
+        if not line:
+            continue
+        if line[0] in ' \t' and headers:
+            # Folded continuation of the previous header
+            headers[-1] = (headers[-1][0], headers[-1][1]+' '+line.strip())
+            continue
+        name, sep, value = line.partition(':')
+        if sep:
+            headers.append((name.strip(), value.strip()))
+    return headers
+
+class MmapRecord(_HTTPHeadersMixin):
+    """A WARC record in a memory-mapped uncompressed file.
+
+       Offers the same attributes and methods as a LazyRecord. In
+       addition, view is the whole record as it appears in the file
+       (from the version line to the blank lines after the content),
+       body is its content block, and http_payload() the HTTP entity body
+       of a response record, all as views into the mapping rather than
+       copies. The views are only valid until the stream is closed."""
+    def __init__(self, stream, offset, version, headers, bodystart, end):
+        self._stream = stream
+        self.offset = offset
+        self.version = version
+        self.headers = headers
+        self._bodystart = bodystart
+        self._end = end
+        self._http = None
+        self._response = None
+
+    def get_header(self, name):
+        name = name.lower()
+        for k, v in self.headers:
+            if k.lower() == name:
+                return v
+
+    @property
+    def type(self):
+        return self.get_header(WarcRecord.TYPE)
+
+    @property
+    def url(self):
+        return self.get_header(WarcRecord.URL)
+
+    @property
+    def id(self):
+        return self.get_header(WarcRecord.ID)
+
+    @property
+    def content_type(self):
+        return self.get_header(WarcRecord.CONTENT_TYPE)
+
+    @property
+    def content_length(self):
+        return self._end - self._bodystart
+
+    @property
+    def view(self):
+        # Include the two CRLFs which end the record
+        return self._stream.view(self.offset, self._end + 4 - self.offset)
+
+    @property
+    def body(self):
+        return self._stream.view(self._bodystart,
+                                 self._end - self._bodystart)
+
+    @property
+    def content(self):
+        """(content type, content), as for a hanzo record. This copies the
+        content into a string; prefer body where a view will do."""
+        return self.content_type, self._stream.mm[self._bodystart:self._end]
+
+    def body_read(self):
+        return True
+
+    def _http_header_end(self):
+        mm = self._stream.mm
+        end = mm.find('\r\n\r\n', self._bodystart,
+                      min(self._end, self._bodystart + 65536))
+        return self._end if end < 0 else end + 4
+
+    def http_headers(self):
+        if self._http is None:
+            block = self._stream.mm[self._bodystart:self._http_header_end()]
+            self._http = parse_http_header_block(block)
+        return self._http
+
+    def http_payload(self):
+        """The HTTP entity body of a response record, as a view. This is
+        the body as transferred: it has not been dechunked or
+        decompressed according to its Transfer- or Content-Encoding."""
+        start = self._http_header_end()
+        return self._stream.view(start, self._end - start)
+
+    def http_response(self):
+        """As for LazyRecord, except that the body is a view into the
+        mapping unless it had to be decoded."""
+        if self._response is None:
+            self._response = parse_http_response_block(self.body)
+        return self._response
+
+    def write_to(self, out, gzip=False):
+        """Write the record out unchanged, straight from the mapping."""
+        if gzip:
+            out = GzipFile(fileobj=out, mode='wb')
+        out.write(self.view)
+        if gzip:
+            out.close()
+
+class MmapRecordStream(object):
+    """Reads the records of an uncompressed WARC file by memory-mapping it.
+    Iterate over it to get MmapRecords."""
+    def __init__(self, filename):
+        self._f = open(filename, 'rb')
+        self.mm = None
+        self._mv = None
+        if os.fstat(self._f.fileno()).st_size:
+            self.mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                self._mv = memoryview(self.mm)
+            except TypeError:
+                # Python 2's mmap lacks the new buffer interface
+                self._mv = None
+
+    def view(self, start, length):
+        """A zero-copy view of length bytes of the file from start."""
+        if self._mv is not None:
+            return self._mv[start:start+length]
+        return buffer(self.mm, start, length)
+
+    def __iter__(self):
+        mm = self.mm
+        if mm is None:
+            return
+        size = len(mm)
+        pos = 0
+        while True:
+            # Skip any sort of valid or invalid record terminator
+            while pos < size and mm[pos] in '\r\n':
+                pos += 1
+            if pos >= size:
+                return
+            offset = pos
+            eol = mm.find('\r\n', pos)
+            hdrend = mm.find('\r\n\r\n', pos)
+            if (not mm[pos:pos+5] == 'WARC/' or eol < 0 or hdrend < 0):
+                raise Exception("Errors while decoding: no WARC record at "
+                                "offset %d" % offset)
+            version = mm[pos:eol]
+            headers = _parse_warc_headers(mm[eol+2:hdrend])
+            length = [v for k, v in headers
+                      if k.lower() == WarcRecord.CONTENT_LENGTH.lower()]
+            try:
+                length = int(length[0])
+            except (IndexError, ValueError):
+                raise Exception("Errors while decoding: missing or invalid "
+                                "Content-Length at offset %d" % offset)
+            bodystart = hdrend + 4
+            if bodystart + length > size:
+                raise Exception("Errors while decoding: truncated record at "
+                                "offset %d" % offset)
+            yield MmapRecord(self, offset, version, headers,
+                             bodystart, bodystart + length)
+            pos = bodystart + length
+
+    def close(self):
+        self._mv = None
+        if self.mm is not None:
+            self.mm.close()
+        self._f.close()
+
+def is_plain_warc(filename):
+    """True if filename looks like an uncompressed WARC file, which can be
+    read with MmapRecordStream."""
+    with open(filename, 'rb') as f:
+        return f.read(5) == 'WARC/'
@@ -1,33 +1,202 @@
-"""Utility functions derived from and for use with the hanzo warcutils
-library; unhelpfully not packaged as part of that library, only with
-the example scripts which accompany it"""
+"""Utility functions for parsing the HTTP messages in WARC records, shared
+by warctika, warc2mongodb, warcreader and the command line tools.
 
-from hanzo.httptools import RequestMessage, ResponseMessage
+These work on the block of bytes in the record directly, rather than
+feeding it through hanzo's incremental (socket-oriented) HTTP parser,
+which copies the whole payload several times over."""
+
+import zlib
+
+# Status codes whose responses never have a body
+_NO_BODY_CODES = (204, 304)
+# How far into a message to look for the end of its headers
+_MAX_HEADER = 65536
 
 #####
 #UTILITY FUNCTIONS
 #####
+def parse_content_type(value):
+    """Split a Content-Type header value into (mimetype, charset). charset
+    is lowercased, and None if not declared."""
+    params = value.split(';')
+    charset = None
+    for param in params[1:]:
+        name, _, pvalue = param.partition('=')
+        if name.strip().lower() == 'charset':
+            charset = pvalue.strip().strip('"\'').lower() or None
+    return params[0].strip(), charset
+
+def _tail(data, start, length=None):
+    """Slice data from start (for length bytes, or to the end), without
+    copying if data is a buffer or memoryview."""
+    end = len(data) if length is None else min(len(data), start + length)
+    if isinstance(data, memoryview):
+        return data[start:end]
+    if isinstance(data, buffer):
+        return buffer(data, start, end - start)
+    return data[start:end]
+
+def _bytes(data):
+    """Return the bytes of data (a string, buffer or memoryview) as a
+    string. str() of a memoryview gives its repr, not its contents."""
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return str(data)
+
+def _dechunk(body):
+    """Reassemble a body sent with chunked Transfer-Encoding. A body which
+    turns out not to be chunked at all is returned as it is."""
+    chunks = []
+    pos = 0
+    while True:
+        eol = body.find('\n', pos)
+        if eol < 0:
+            # Truncated
+            break
+        try:
+            size = int(body[pos:eol].split(';', 1)[0].strip(), 16)
+        except ValueError:
+            if not chunks:
+                return body
+            break
+        if size == 0:
+            break
+        start = eol + 1
+        chunks.append(body[start:start+size])
+        pos = start + size
+        if body[pos:pos+2] == '\r\n':
+            pos += 2
+        elif body[pos:pos+1] == '\n':
+            pos += 1
+    return ''.join(chunks)
+
+def _decode(body, encoding):
+    """Undo gzip or deflate Content-Encoding, returning the body unchanged
+    if it can't be decoded."""
+    # 32+ detects a gzip or zlib header. Some servers claiming 'deflate'
+    # send raw deflate data, with no header at all.
+    wbitses = [32 + zlib.MAX_WBITS]
+    if encoding == 'deflate':
+        wbitses.append(-zlib.MAX_WBITS)
+    for wbits in wbitses:
+        try:
+            return zlib.decompressobj(wbits).decompress(body)
+        except zlib.error:
+            pass
+    return body
+
+def split_http_response(data):
+    """Find the end of the header block of an HTTP response message held in
+    data (a string, buffer or memoryview), and parse the headers. Only the
+    header bytes are read. Returns (code, headers, bodystart), where code
+    and headers are as from parse_http_header_block()."""
+    head = data[:_MAX_HEADER]
+    if isinstance(head, memoryview):
+        head = head.tobytes()
+    end = head.find('\r\n\r\n')
+    if end >= 0:
+        bodystart = end + 4
+    else:
+        end = head.find('\n\n')
+        bodystart = end + 2 if end >= 0 else len(head)
+    code, headers = parse_http_header_block(head[:bodystart])
+    return code, headers, bodystart
+
+def parse_http_response_block(data):
+    """Parse an HTTP response message held in data (a string, buffer or
+    memoryview), returning code, content type, declared character set
+    and body.
+
+    The body is a slice of data, without copying if data is a buffer or
+    memoryview, unless it has to be decoded: chunked Transfer-Encoding is
+    reassembled, and gzip or deflate Content-Encoding decompressed, into
+    a new string."""
+    code, headers, bodystart = split_http_response(data)
+    mime_type = charset = length = None
+    chunked = False
+    encoding = None
+    for name, value in headers:
+        name = name.lower()
+        if name == 'content-type' and mime_type is None:
+            mime_type, charset = parse_content_type(value)
+        elif name == 'content-length':
+            try:
+                length = int(value)
+            except ValueError:
+                pass
+        elif name == 'transfer-encoding':
+            chunked = 'chunked' in value.lower()
+        elif name == 'content-encoding':
+            encoding = value.strip().lower()
+    if code in _NO_BODY_CODES or (code is not None and 100 <= code < 200):
+        return code, mime_type, charset, ''
+    if chunked:
+        # Content-Length is meaningless for chunked bodies
+        body = _dechunk(_bytes(_tail(data, bodystart)))
+    else:
+        body = _tail(data, bodystart, length)
+    if encoding in ('gzip', 'x-gzip', 'deflate') and len(body):
+        body = _decode(_bytes(body), encoding)
+    return code, mime_type, charset, body
+
 def parse_http_response_charset(record):
     """Parses the payload of an HTTP 'response' record, returning code,
-    content type and body.
-
-    Adapted from github's internetarchive/warctools hanzo/warcfilter.py,
-    commit 1850f328e31e505569126b4739cec62ffa444223. MIT licenced."""
-    message = ResponseMessage(RequestMessage())
-    remainder = message.feed(record.content[1])
-    message.close()
-    if remainder or not message.complete():
-        if remainder:
-            raise Exception('trailing data in http response for'+str(record.url))
-        if not message.complete():
-            print Exception('truncated http response for'+str(record.url))
-    header = message.header
-
-    mime_type = [v for k,v in header.headers if k.lower() == b'content-type']
-    if mime_type:
-        mime_type, charset = mime_type[0].split(b';')
-    else:
-        mime_type = None
+    content type, declared character set and body
+    (see parse_http_response_block)."""
+    return parse_http_response_block(record.content[1])
+
+def parse_http_response(record):
+    """Parses the payload of an HTTP 'response' record, returning code,
+    content type and body."""
+    code, mime_type, _, body = parse_http_response_charset(record)
+    return code, mime_type, body
+
+def read_http_header_block(record, maxlen=65536):
+    """Read just the HTTP header block (status line and headers, up to and
+    including the blank line) of a 'response' record from its content_file,
+    leaving the body unread so that the record stream can skip over it
+    without materialising it. Returns the header block, or None if the
+    record has no content_file (e.g. its content has already been read).
 
-    return header.code, mime_type, message.get_body()
+    Note that this consumes the start of the record's content: the record's
+    content tuple will not contain the header block afterwards."""
+    fh = getattr(record, 'content_file', None)
+    if fh is None:
+        return None
+    lines = []
+    length = 0
+    while length < maxlen:
+        line = fh.readline(maxlen - length)
+        if not line:
+            break
+        lines.append(line)
+        length += len(line)
+        if line in ('\r\n', '\n'):
+            break
+    return ''.join(lines)
 
+def parse_http_header_block(block):
+    """Parse an HTTP response header block, returning (code, headers),
+    where code is the integer status code (or None if the status line is
+    unreadable) and headers is a list of (name, value) tuples."""
+    lines = block.splitlines()
+    code = None
+    if lines:
+        parts = lines[0].split(None, 2)
+        if len(parts) >= 2 and parts[0].upper().startswith('HTTP/'):
+            try:
+                code = int(parts[1])
+            except ValueError:
+                pass
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            break
+        if line[0] in ' \t' and headers:
+            # Folded continuation of the previous header
+            headers[-1] = (headers[-1][0], headers[-1][1]+' '+line.strip())
+            continue
+        name, sep, value = line.partition(':')
+        if sep:
+            headers.append((name.strip(), value.strip()))
+    return code, headers
@@ -0,0 +1,170 @@
+#!/usr/bin/env python2
+"""Deterministic sampling of the documents in a crawl, for quick
+experiments on a fraction of its text.
+
+A RecordSampler picks documents by a hash of their URL, so the same
+sample is drawn whichever files it is run over, in whatever order and on
+however many workers, and a different salt draws a different sample.
+Unless the sample is stratified by MIME type, the choice depends only on
+the URL, so an original document and a conversion record made from it
+are picked together.
+
+Given an index of the crawl from listwarccts.py (run with --http, so that
+it records the type of each HTTP response), a sampler can be stratified
+by host or by MIME type: every stratum then contributes the same number
+of documents, as far as it can, rather than a number proportional to its
+size. With an index, doc_from_warc also seeks straight to the records
+sampled, instead of reading (and, for gzipped files, decompressing) the
+whole file. A revisit record sampled brings with it the first capture in
+its file with the same payload digest, which holds its payload.
+
+Copyright 2014-2016 Tom Nicholls
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+
+#####
+#SETUP
+#####
+
+import os
+import struct
+import hashlib
+from collections import defaultdict
+from tikaskip import url_host
+
+# Index record types which hold documents, and those always read
+_DOCTYPES = ('response', 'resource', 'conversion', 'revisit')
+_ALWAYS = ('warcinfo',)
+
+#####
+#UTILITY FUNCTIONS
+#####
+def url_fraction(url, salt=''):
+    """Return a number in [0, 1) fixed by url and salt, uniformly
+    distributed over URLs."""
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    n, = struct.unpack('>Q', hashlib.md5(salt + url).digest()[:8])
+    return n / 18446744073709551616.0
+
+def read_index(indexfn):
+    """Return the rows of an index written by listwarccts.py, as (file,
+    offset, type, url, mimetype, digest) tuples. digest is None for rows
+    without one, and in indexes written before it was listed."""
+    rows = []
+    with open(indexfn, 'rb') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 5 or fields[0] == 'File':
+                continue
+            try:
+                offset = int(fields[1])
+            except ValueError:
+                continue
+            mimetype = fields[4] if fields[4] != 'None' else None
+            digest = None
+            if len(fields) >= 7 and fields[6] != 'None':
+                digest = fields[6]
+            rows.append((fields[0], offset, fields[2], fields[3], mimetype,
+                         digest))
+    return rows
+
+#####
+#CLASSES
+#####
+
+class RecordSampler(object):
+    """Picks a deterministic sample of documents by the hash of their URL.
+
+       rate: the fraction of documents to pick;
+       salt: a string mixed into the hash, to draw a different sample;
+       stratify: None, 'host' or 'mimetype'. Needs index;
+       index: rows from read_index(), to stratify by and to find the
+           offsets of the records sampled in each file (see offsets_for).
+
+       Stratified, the same number of documents is wanted from each
+       stratum: rate times the number of documents over the number of
+       strata. A stratum with fewer than that has all of its documents
+       picked, without the shortfall being made up elsewhere."""
+    def __init__(self, rate, salt='', stratify=None, index=None):
+        if stratify not in (None, 'host', 'mimetype'):
+            raise ValueError("stratify must be None, 'host' or 'mimetype'")
+        if stratify is not None and index is None:
+            raise ValueError("A stratified sample needs an index")
+        self.rate = rate
+        self.salt = salt
+        self.stratify = stratify
+        self._rates = {}
+        self._byfile = None
+        if index is None:
+            return
+        if stratify is not None:
+            counts = defaultdict(int)
+            for _, _, rtype, url, mimetype, _ in index:
+                if rtype in _DOCTYPES:
+                    counts[self.stratum(url, mimetype)] += 1
+            if counts:
+                wanted = rate * sum(counts.values()) / len(counts)
+                for stratum, n in counts.iteritems():
+                    self._rates[stratum] = min(1.0, wanted / n)
+        self._byfile = defaultdict(list)
+        for fn, offset, rtype, url, mimetype, digest in index:
+            self._byfile[os.path.basename(fn)].append(
+                (offset, rtype, url, mimetype, digest))
+
+    def stratum(self, url, mimetype=None):
+        if self.stratify == 'host':
+            return url_host(url)
+        if self.stratify == 'mimetype':
+            if not mimetype:
+                return None
+            return mimetype.split(';')[0].strip().lower()
+        return None
+
+    def __call__(self, url, mimetype=None):
+        """True if the document at url (of type mimetype, needed only
+        when stratifying by it) is in the sample."""
+        rate = self.rate
+        if self.stratify is not None:
+            rate = self._rates.get(self.stratum(url, mimetype), rate)
+        return url_fraction(url, self.salt) < rate
+
+    def offsets_for(self, infn):
+        """Return (offsets, skipped): the sorted offsets of the records of
+        infn to read (its warcinfo records, the documents sampled and the
+        first captures whose payloads sampled revisits share), and the
+        number of its indexed records which needn't be, or (None, 0) if
+        the file isn't in the index."""
+        if self._byfile is None:
+            return None, 0
+        rows = self._byfile.get(os.path.basename(infn))
+        if not rows:
+            return None, 0
+        offsets = set()
+        revisited = set()
+        for offset, rtype, url, mimetype, digest in rows:
+            if rtype in _ALWAYS or (rtype in _DOCTYPES and
+                                    self(url, mimetype)):
+                offsets.add(offset)
+                if rtype == 'revisit' and digest is not None:
+                    revisited.add(digest)
+        if revisited:
+            firsts = {}
+            for offset, rtype, url, mimetype, digest in rows:
+                if rtype == 'response' and digest in revisited:
+                    firsts[digest] = min(offset, firsts.get(digest, offset))
+            offsets.update(firsts.itervalues())
+        offsets = sorted(offsets)
+        return offsets, len(rows) - len(offsets)
@@ -3,7 +3,8 @@
 non-text content with Apache Tika and re-writing a WARC file with
 transformation records in place of the original.
 
-Requirements: TikaJAXRS running on a given port and auto-reloaded.
+Requirements: TikaJAXRS running on a given port and auto-reloaded (or a
+tikafleet.TikaFleet of local servers, as run by warctikad --fleet).
 
 Copyright 2014-2015 Tom Nicholls
 
@@ -31,42 +32,58 @@ import atexit
 import traceback
 import time
 import re
-import requests
 import fcntl
 import copy
 from collections import defaultdict
 # These can both be installed with 'pip install warctools'. Beware that there
 # are several old versions floating around under different names in the index.
 from hanzo.warctools import WarcRecord
-from hanzo.httptools import RequestMessage, ResponseMessage
-
-#####
-#UTILITY FUNCTIONS
-#####
-def parse_http_response(record):
-    """Parses the payload of an HTTP 'response' record, returning code,
-    content type and body.
-
-    Adapted from github's internetarchive/warctools hanzo/warcfilter.py,
-    commit 1850f328e31e505569126b4739cec62ffa444223. MIT licenced."""
-    message = ResponseMessage(RequestMessage())
-    remainder = message.feed(record.content[1])
-    message.close()
-    if remainder or not message.complete():
-        if remainder:
-            print 'trailing data in http response for', record.url
-        if not message.complete():
-            print 'truncated http response for', record.url
-    header = message.header
-
-    mime_type = [v for k,v in header.headers if k.lower() == b'content-type']
-    if mime_type:
-        mime_type = mime_type[0].split(b';')[0]
-    else:
-        mime_type = None
-
-    return header.code, mime_type, message.get_body()
-
+from warcresponseparse import (parse_http_response, split_http_response,
+                               parse_content_type)
+from warcreader import open_archive
+from warcwriter import RecordWriter, compression_for
+from tikaclient import TikaClient, TikaException
+from warcmonitor import NULL_MONITOR
+from textnorm import NormaliseStats
+import localextract
+import pdfscreen
+
+DEFAULT_MIMEMAPPINGS = [
+    # Content-Types taken from a crawl of .gov.uk.
+    # It is astonishing what junk some web servers will supply
+    # for a Content-Type.
+    (r'^application/pdf$',
+        'application/pdf'),
+    (r'^application/(x-)?(vnd\.?)?(ms-?)?(excel)|(xls)',
+        'application/vnd.ms-excel'),
+    (r'^application/(x-)?(vnd\.?)?(ms-?)?(powerpoint)|(pps)|(ppt)',
+        'application/vnd.ms-powerpoint'),
+    (r'^application/(x-)?(vnd\.?)?(ms-?)?(word$)|(doc$)',
+        'application/msword'),
+    (r'^application/vnd\.openxmlformats-officedocument',
+        None),
+    (r'^((text)|(application))/((rtf)|(richtext))$',
+        'text/rtf'),
+    (r'^application/vnd\.oasis\.opendocument',
+        None),
+    (r'^acrobat$',
+        'application/pdf')
+    ]
+
+# Start of the description added to warcinfo records, followed by the
+# regular expressions of the mimemappings used, separated by '; '.
+DESCRIPTION_PREFIX = (
+    "Items collected with content types matching the following "
+    "regular expressions have been processed by Apache Tika to "
+    "attempt to produce plain text formats for storage. These "
+    "processed items have been stored as WARC conversion records: ")
+
+# Header added to an original record kept because Tika (or local
+# extraction and then Tika) tried and failed to convert it, or produced
+# too little text, giving the Content-Type it was sent as. Originals kept
+# for any other reason (Tika unavailable, skipped by the skiplearner or
+# pdfscreen, errors) are not marked, and are worth trying again.
+TIKA_FAILED_HEADER = 'WARC-Tika-Failed'
 
 #####
 #CLASSES
@@ -78,12 +95,53 @@ class WarcTikaException(Exception):
 class WarcTikaNoResultException(WarcTikaException):
     pass
 
+class WarcTikaUnavailableException(WarcTikaNoResultException):
+    """No result because Tika timed out or was down, rather than because
+    of anything about the document."""
+    pass
+
 class WARCTikaProcessor(object):
     """Processes WARCs by decomposing them, sending the records through
        Apache Tika to produce plain text, then reconstructing a WARC file
        with appropriate Transformation records.
 
        tikaurl: URL of an instance of Tika's JAX-RS server for processing;
+       tikaclient: a tikaclient.TikaClient to use instead of one built from
+           tikaurl, for setting timeouts, circuit breaker parameters and a
+           separate endpoint for heavy documents;
+       batchsize: if non-zero, documents of up to batchmaxdoc bytes are
+           sent to Tika in batches of this many, packed into one zip
+           archive (see TikaClient.put_batch). Documents Tika fails on
+           within a batch are resubmitted individually;
+       localextract: if True, OOXML, ODF and RTF documents are first
+           converted in-process by localextract, with Tika only used if
+           that fails. Counts of documents handled by each tier are kept
+           in tiercounts;
+       pdfscreen: confidence threshold (0.0-1.0) at which a PDF judged by
+           pdfscreen.screen_pdf() to contain no text is kept as it is
+           rather than sent to Tika, or None to send every PDF. Counts
+           of skipped and passed PDFs (and of short Tika outputs, to tune
+           against) are kept in tiercounts;
+       skiplearner: a tikaskip.SkipLearner, which learns from the results
+           of conversion which (host, MIME type) buckets are consistently
+           unproductive and stops sending most of their documents. Its
+           table is saved at the end of each file. Skipped documents are
+           counted in tiercounts;
+       dedup: a warcdedup.DigestIndex. Response records copied through
+           unchanged (those of no Content-Type to be Tikaised) whose
+           payload digest it has seen before are written as revisit
+           records referring to the first capture, which is itself kept
+           intact. Counted in tiercounts;
+       normalise: if True, the text of conversion records is normalised
+           (see textnorm.normalise_text) before it is checked against
+           mintikalen and written, and the size reduction per MIME type
+           reported for each file and kept in tiercounts;
+       monitor: a warcmonitor.RecordMonitor, to log records which are slow
+           to process (with the time spent in each stage) and for opt-in
+           profiling;
+       zstddictionary: dictionary data (see warcwriter.py) for compressing
+           .warc.zst output. The output format follows outfn's extension
+           (.warc.gz, .warc.zst or plain); input format is detected;
        mimemappings: a list regex/content-type tuples. The regex should
            match the Content-Types you wish to process, with the
            corresponding content-type being the "canonical" type for that
@@ -94,41 +152,45 @@ class WARCTikaProcessor(object):
     def __init__(
             self,
             tikaurl='http://localhost:9998/tika',
-            mimemappings=[
-                # Content-Types taken from a crawl of .gov.uk.
-                # It is astonishing what junk some web servers will supply
-                # for a Content-Type.
-                (r'^application/pdf$',
-                    'application/pdf'),
-                (r'^application/(x-)?(vnd\.?)?(ms-?)?(excel)|(xls)',
-                    'application/vnd.ms-excel'),
-                (r'^application/(x-)?(vnd\.?)?(ms-?)?(powerpoint)|(pps)|(ppt)',
-                    'application/vnd.ms-powerpoint'),
-                (r'^application/(x-)?(vnd\.?)?(ms-?)?(word$)|(doc$)',
-                    'application/msword'),
-                (r'^application/vnd\.openxmlformats-officedocument',
-                    None),
-                (r'^((text)|(application))/((rtf)|(richtext))$',
-                    'text/rtf'),
-                (r'^application/vnd\.oasis\.opendocument',
-                    None),
-                (r'^acrobat$',
-                    'application/pdf')
-                ],
-                mintikalen=256):
+            mimemappings=DEFAULT_MIMEMAPPINGS,
+                mintikalen=256,
+                tikaclient=None,
+                batchsize=0,
+                batchmaxdoc=256*1024,
+                localextract=True,
+                pdfscreen=0.9,
+                skiplearner=None,
+                dedup=None,
+                normalise=False,
+                monitor=None,
+                zstddictionary=None):
         self._tikaurl = tikaurl
+        if tikaclient is None:
+            tikaclient = TikaClient(tikaurl)
+        self._tikaclient = tikaclient
         self._mintikalen = mintikalen
+        self._batchsize = batchsize
+        self._batchmaxdoc = batchmaxdoc
+        self._localextract = localextract
+        self._pdfscreen = pdfscreen
+        self._skiplearner = skiplearner
+        self._dedup = dedup
+        self._normstats = NormaliseStats() if normalise else None
+        if monitor is None:
+            monitor = NULL_MONITOR
+        self._monitor = monitor
+        self._zstddictionary = zstddictionary
         self._mimemappings = mimemappings
-        self._description = (
-            "Items collected with content types matching the following "
-            "regular expressions have been processed by Apache Tika to "
-            "attempt to produce plain text formats for storage. These "
-            "processed items have been stored as WARC conversion records: ")
+        self._description = DESCRIPTION_PREFIX
         for item in self._mimemappings:
             self._description += item[0]+'; '
         self._description = self._description[:-2]+'.'
         # Count of return codes
         self.tikacodes = defaultdict(int)
+        # Count of documents (and bytes) handled by each extraction tier
+        self.tiercounts = defaultdict(int)
+        # Counts from the last file processed
+        self.filecounts = {}
         self._openfiles = set()
         atexit.register(self._remove_open_files)
         print "Initialised WARCTikaProcessor"
@@ -138,7 +200,7 @@ class WARCTikaProcessor(object):
         where suitable, and writing a new WARC file to outfn."""
         # These are objects of type RecordStream (or a subclass), unlike with
         # the IA library
-        inwf = WarcRecord.open_archive(infn, mode='rb')
+        inwf = open_archive(infn)
         outf = open(outfn, 'wb')
         self._openfiles.add(outfn)
 #        try:
@@ -150,40 +212,72 @@ class WARCTikaProcessor(object):
 #                   "try later")
 #            return False
         print "Processing", infn
-        for record in inwf:
-            try:
-                if record.type == WarcRecord.WARCINFO:
-                    self.add_description_to_warcinfo(record)
-                elif (record.type == WarcRecord.RESPONSE
-                      or record.type == WarcRecord.RESOURCE):
-                    if record.get_header('WARC-Segment-Number'):
-                        raise WarcTikaException("Segmented response/resource "
-                                                "record. Not processing.")
-                    else:
-                        record = self.generate_new_record(record)
-                # If 'metadata', 'request', 'revisit', 'continuation',
-                # 'conversion' or something exotic, we can't do anything more
-                # interesting than immediately re-writing it to the new file
-
-                newrecord = WarcRecord(headers=record.headers,
-                        content=record.content)
-
-            except Exception as e:
-                print ("Warning: WARCTikaProcessor.process() failed on "+
-                       record.url+": "+str(e.message)+
-                       "\n\tWriting old record to new WARC.")
-                traceback.print_exc()
-                newrecord = record
-            finally:
-                newrecord.write_to(outf, gzip=outfn.endswith('.gz'))
+        compression = compression_for(outfn)
+        outwf = RecordWriter(outf, compression, self._zstddictionary)
+        # With batching on, small Tika-bound records are held back until a
+        # batch is full. Records read after the first of them are queued
+        # in pending so that the output keeps the input order.
+        batch = []
+        pending = []
+        monitor = self._monitor
+        monitor.start_file(infn)
+        try:
+            for record in inwf:
+                monitor.start_record(record.url)
+                prepared = None
+                revisit = None
+                if self._dedup is not None:
+                    revisit = self.revisit_record(record)
+                if revisit is not None:
+                    record = revisit
+                elif self._batchsize:
+                    prepared = self._prepare_quietly(record)
+                if prepared and self._batchable(prepared):
+                    batch.append((len(pending), record, prepared))
+                    pending.append(record)
+                elif batch:
+                    if revisit is None:
+                        record = self.rewrite_record(record, prepared)
+                    pending.append(record)
+                else:
+                    if revisit is None:
+                        record = self.rewrite_record(record, prepared)
+                    monitor.mark('write')
+                    outwf.write(record)
+                if batch and (len(batch) >= self._batchsize
+                              or len(pending) >= self._batchsize * 16):
+                    # Charged to the record which fills the batch
+                    monitor.mark('batch')
+                    self._flush_batch(batch, pending, outwf)
+                monitor.end_record()
+            if batch:
+                self._flush_batch(batch, pending, outwf)
+        finally:
+            monitor.end_file()
         print "****Finished file. Tika status codes:", self.tikacodes.items()
+        if self._normstats is not None:
+            print "****Normalisation:\n"+self._normstats.report()
+            self.tiercounts.update(self._normstats.counts())
+            self._normstats.clear()
+        print "****Extraction tiers:", self.tiercounts.items()
+        # Both sets of counts for the file, for callers to collect
+        self.filecounts = dict(self.tiercounts)
+        for code, n in self.tikacodes.items():
+            self.filecounts['tika-status-'+str(code)] = n
         self.tikacodes = defaultdict(int)
+        self.tiercounts = defaultdict(int)
+        if self._skiplearner is not None:
+            self._skiplearner.save()
         inwf.close()
         outf.close()
         self._openfiles.remove(outfn)
 
         # Check that the file has written correctly - for an excess of caution
-        validrc = os.system("warcvalid "+outfn)
+        if compression == 'zstd':
+            # warcvalid can't read .warc.zst
+            validrc = not self.valid_zstd_warc(outfn)
+        else:
+            validrc = os.system("warcvalid "+outfn)
 
         if validrc:
             print "New file", outfn, "appears not to be valid. Deleting it." 
@@ -193,6 +287,165 @@ class WARCTikaProcessor(object):
             os.unlink(infn)
         return True
 
+    def valid_zstd_warc(self, fn):
+        """Return True if every record of the .warc.zst file fn can be
+        read back."""
+        try:
+            inwf = open_archive(fn, gzip='zstd')
+            for offset, record, errors in inwf.read_records(limit=None):
+                if errors:
+                    return False
+                if record is None:
+                    break
+                record.content
+            inwf.close()
+        except Exception:
+            return False
+        return True
+
+    def rewrite_record(self, record, prepared=None):
+        """Return the record to be written to the output WARC in place of
+        the given input record.
+
+           :prepared: the result of prepare_record(record), if known"""
+        try:
+            if record.type == WarcRecord.WARCINFO:
+                self.add_description_to_warcinfo(record)
+            elif (record.type == WarcRecord.RESPONSE
+                  or record.type == WarcRecord.RESOURCE):
+                if record.get_header('WARC-Segment-Number'):
+                    raise WarcTikaException("Segmented response/resource "
+                                            "record. Not processing.")
+                else:
+                    record = self.generate_new_record(record, prepared)
+            # If 'metadata', 'request', 'revisit', 'continuation',
+            # 'conversion' or something exotic, we can't do anything more
+            # interesting than immediately re-writing it to the new file
+
+            return WarcRecord(headers=record.headers, content=record.content)
+
+        except Exception as e:
+            print ("Warning: WARCTikaProcessor.process() failed on "+
+                   record.url+": "+str(e.message)+
+                   "\n\tWriting old record to new WARC.")
+            traceback.print_exc()
+            # Read the content now: the record may be held in pending
+            # while the stream moves past it
+            return self.rewrite_unchanged(record)
+
+    def _prepare_quietly(self, record):
+        """Return prepare_record(record) for a response or resource record,
+        or None for other records and for those prepare_record() fails
+        on, leaving rewrite_record() to deal with (and report) them."""
+        try:
+            if ((record.type != WarcRecord.RESPONSE
+                    and record.type != WarcRecord.RESOURCE)
+                    or record.get_header('WARC-Segment-Number')):
+                return None
+            # As generate_new_record(): only HTTP responses
+            if (record.type == WarcRecord.RESPONSE
+                    and not record.url.startswith('http')):
+                return None
+            return self.prepare_record(record)
+        except Exception:
+            return None
+
+    def _batchable(self, prepared):
+        """Return True if a prepared (mimetype, body) document is small
+        enough for batch submission and needs Tika to convert it."""
+        if len(prepared[1]) > self._batchmaxdoc:
+            return False
+        if self._localextract and localextract.can_extract(prepared[0]):
+            # Cheaper to convert in-process than in a batch
+            return False
+        return True
+
+    def _flush_batch(self, batch, pending, outwf):
+        """Submit the batched records to Tika together, substitute the
+        resulting conversion records into pending and write out
+        everything pending."""
+        try:
+            results = self._tikaclient.put_batch(
+                [prepared for (i, record, prepared) in batch])
+            self.tikacodes['batch'] += 1
+            self.tiercounts['tika-batched'] += len(batch)
+            self.tiercounts['tika-bytes'] += sum(len(prepared[1]) for
+                                                 (i, record, prepared) in batch)
+        except TikaException as e:
+            self.tikacodes[type(e).__name__] += len(batch)
+            results = [e] * len(batch)
+        for (i, record, prepared), text in zip(batch, results):
+            try:
+                if isinstance(text, TikaException):
+                    raise WarcTikaUnavailableException(str(text))
+                if text is None:
+                    # Failed or missing from the batch: try it alone.
+                    outcontent = self.tikaise(prepared, url=record.url)
+                else:
+                    self.tikacodes['batch-200'] += 1
+                    if len(text) < self._mintikalen:
+                        self.tiercounts['tika-short'] += 1
+                    outcontent = self.check_tika_output(prepared[0], text)
+                self._learn(record.url, prepared, True)
+                pending[i] = WarcRecord(
+                    headers=self.generate_cv_header(record),
+                    content=outcontent)
+            except WarcTikaNoResultException as e:
+                if not isinstance(e, WarcTikaUnavailableException):
+                    self._learn(record.url, prepared, False)
+                    record.set_header(TIKA_FAILED_HEADER, prepared[0])
+                pending[i] = self.rewrite_unchanged(record)
+            except Exception as e:
+                print e, "processing", record.url
+                pending[i] = self.rewrite_unchanged(record)
+        for record in pending:
+            outwf.write(record)
+        del batch[:]
+        del pending[:]
+
+    def revisit_record(self, record):
+        """Return a revisit record to write in place of an HTTP response
+        record whose payload digest the dedup index has seen in an
+        earlier capture, or None if it is the first (or can't be
+        deduplicated). Only records which are to be copied through
+        unchanged are indexed or deduplicated: a revisit of a document
+        converted by Tika would refer to an original which is not
+        kept."""
+        try:
+            if (record.type != WarcRecord.RESPONSE
+                    or not record.url.startswith('http')
+                    or record.get_header('WARC-Segment-Number')):
+                return None
+            digest = record.get_header(WarcRecord.PAYLOAD_DIGEST)
+            if not digest:
+                return None
+            message = record.content[1]
+            end = message.find('\r\n\r\n')
+            if end < 0:
+                return None
+            _, headers, _ = split_http_response(message)
+            ctypes = [v for k, v in headers if k.lower() == 'content-type']
+            mimetype = parse_content_type(ctypes[0])[0] if ctypes else None
+            if self.check_mimetype(mimetype):
+                # To be converted, not copied
+                return None
+            first = self._dedup.is_duplicate(digest, record.id, record.url,
+                                             record.date)
+            if first is None:
+                return None
+        except Exception as e:
+            print e, "deduplicating", record.url
+            return None
+        self.tiercounts['dedup-revisit'] += 1
+        self.tiercounts['dedup-bytes'] += len(message) - (end + 4)
+        return WarcRecord(headers=self.generate_revisit_header(record, first,
+                                                               digest),
+                          content=(record.content[0], message[:end+4]))
+
+    def rewrite_unchanged(self, record):
+        """Copy a record for writing to the output WARC unchanged."""
+        return WarcRecord(headers=record.headers, content=record.content)
+
     def add_description_to_warcinfo(self, record):
         """Add a description of our mangling to a warcinfo record's decription
         tag, creating it if necessary"""
@@ -221,10 +474,12 @@ class WARCTikaProcessor(object):
                           str(len(record.content[1])))
 
 
-    def generate_new_record(self, inrecord):
+    def generate_new_record(self, inrecord, prepared=None):
         """Produce and return a WARC conversion record based on the given
            input WARC record. If conversion is not possible, return the
-           input record."""
+           input record.
+
+           :prepared: the result of prepare_record(inrecord), if known"""
         # We can process resource records and HTTP response records.
         if not ((inrecord.type == WarcRecord.RESPONSE
                     and inrecord.url.startswith('http'))
@@ -232,29 +487,84 @@ class WARCTikaProcessor(object):
             print "Can't handle", inrecord.type, inrecord.url
             return inrecord
 
-        if inrecord.type == WarcRecord.RESOURCE:
-            inmimetype, inbody = inrecord.content
-        else: # inrecord.type == WarcRecord.RESPONSE (HTTP):
-            _, inmimetype, inbody = parse_http_response(inrecord)
-
-        mimetype = self.check_mimetype(inmimetype)
-        if not mimetype:
-            # Content-Type should not be Tikaised
+        if prepared is None:
+            prepared = self.prepare_record(inrecord)
+        if not prepared:
+            # Content-Type should not be Tikaised, or it's a PDF with no
+            # text to extract
             return inrecord
         try:
-            outcontent = self.tikaise((mimetype, inbody), url=inrecord.url)
-        except WarcTikaNoResultException:
+            outcontent = self.extract_locally(prepared)
+            if outcontent is None:
+                outcontent = self.tikaise(prepared, url=inrecord.url)
+        except WarcTikaNoResultException as e:
             # Tika hasn't done the business (image PDF, unparseable source,
             # whatever. Don't report, as these are very common.
+            if not isinstance(e, WarcTikaUnavailableException):
+                self._learn(inrecord.url, prepared, False)
+                inrecord.set_header(TIKA_FAILED_HEADER, prepared[0])
             return inrecord
         except Exception as e:
             print e, "processing", inrecord.url
             return inrecord
+        self._learn(inrecord.url, prepared, True)
         outheader = self.generate_cv_header(inrecord)
         # The Content-length header is regenerated, and the Content-Type
         # header is replaced by content[0].
         return WarcRecord(headers=outheader, content=outcontent)
 
+    def prepare_record(self, inrecord):
+        """Return the (canonical mimetype, body) to send to Tika for a
+        response or resource record, or False if its Content-Type should
+        not be Tikaised, the skiplearner has learnt that its host's
+        documents of that type are not worth sending, or it is a PDF
+        which screen_pdf() is confident has no text to extract."""
+        self._monitor.mark('parse')
+        if inrecord.type == WarcRecord.RESOURCE:
+            inmimetype, inbody = inrecord.content
+        else: # inrecord.type == WarcRecord.RESPONSE (HTTP):
+            _, inmimetype, inbody = parse_http_response(inrecord)
+        self._monitor.note(inmimetype, len(inbody))
+
+        mimetype = self.check_mimetype(inmimetype)
+        if not mimetype:
+            return False
+        if (self._skiplearner is not None and
+                not self._skiplearner.should_send(inrecord.url, mimetype)):
+            self.tiercounts['skiplearn-skipped'] += 1
+            return False
+        if mimetype == 'application/pdf' and self._pdfscreen is not None:
+            self._monitor.mark('pdfscreen')
+            if pdfscreen.screen_pdf(inbody) >= self._pdfscreen:
+                self.tiercounts['pdfscreen-skipped'] += 1
+                return False
+            self.tiercounts['pdfscreen-passed'] += 1
+        return (mimetype, inbody)
+
+    def _learn(self, url, prepared, success):
+        """Tell the skiplearner, if any, whether a document converted."""
+        if self._skiplearner is not None:
+            self._skiplearner.record(url, prepared[0], success,
+                                     len(prepared[1]))
+
+    def extract_locally(self, content):
+        """Try to convert a document to plain text in-process, without
+           Tika. Returns a ('text/plain', text) content tuple, or None if
+           the document should go to Tika instead.
+
+           :content: a (mimetype, body) tuple"""
+        if not self._localextract or not localextract.can_extract(content[0]):
+            return None
+        self._monitor.mark('local')
+        try:
+            text = localextract.extract_text(content[0], content[1])
+        except localextract.LocalExtractionException:
+            self.tiercounts['local-failed'] += 1
+            return None
+        self.tiercounts['local'] += 1
+        self.tiercounts['local-bytes'] += len(content[1])
+        return self.check_tika_output(content[0], text)
+
     def tikaise(self, content, url=None):
         """Process a file through Apache Tika, reducing to plain text
            if possible.
@@ -263,20 +573,39 @@ class WARCTikaProcessor(object):
         # TODO: Consider carefully whether to send Tika the filename to help
         # guess the MIME type, which can be done by setting the (unofficial)
         # {'File-Name': string} header.
-        resp = requests.put(self._tikaurl, data=content[1],
-                                headers={'Content-Type': content[0]}) 
+        self.tiercounts['tika'] += 1
+        self.tiercounts['tika-bytes'] += len(content[1])
+        self._monitor.mark('tika')
+        try:
+            resp = self._tikaclient.put(content[1],
+                                        headers={'Content-Type': content[0]})
+        except TikaException as e:
+            # Timeout, or Tika is down. Keep the original record rather
+            # than holding up the rest of the file.
+            self.tikacodes[type(e).__name__] += 1
+            raise WarcTikaUnavailableException(str(e))
         self.tikacodes[resp.status_code] += 1
         if resp.status_code != 200:
             raise WarcTikaNoResultException("Bad response code from Tika ("+
                             str(resp.status_code)+") "+
                             "trying to submit Content-Type "+content[0])
+#       print "Success from Tika:",url, content[0], "Length:",len(resp.content)
         if len(resp.content) < self._mintikalen:
+            self.tiercounts['tika-short'] += 1
+        return self.check_tika_output(content[0], resp.content)
+
+    def check_tika_output(self, mimetype, text):
+        """Return a ('text/plain', text) content tuple for Tika's output,
+        normalised if so configured, or raise WarcTikaNoResultException if
+        it is too short to be worth keeping in place of the original."""
+        if self._normstats is not None:
+            text = self._normstats.normalise(text, mimetype)
+        if len(text) < self._mintikalen:
             raise WarcTikaNoResultException("Content from Tika only "+
-                            str(len(resp.content))+
+                            str(len(text))+
                             " bytes. Probably image-based PDF. Using original"+
                             " record.")
-#       print "Success from Tika:",url, content[0], "Length:",len(resp.content)
-        return ('text/plain', resp.content)
+        return ('text/plain', text)
 
 #    def strip_header(self, obj):
 #        """Strips the first HTTP/WARC header from an object, returning the
@@ -325,6 +654,25 @@ class WARCTikaProcessor(object):
         newrecord.set_header(WarcRecord.ID, newrecord.random_warc_uuid())
         return newrecord.headers
 
+    def generate_revisit_header(self, oldrecord, first, digest):
+        """Produce the header of an identical-payload-digest revisit
+        record standing for oldrecord, whose payload is that of the first
+        capture, a (record ID, URI, date) tuple. The block is to be the
+        HTTP header block of oldrecord."""
+        keep = [WarcRecord.URL, WarcRecord.DATE, WarcRecord.IP_ADDRESS,
+                WarcRecord.WARCINFO_ID, WarcRecord.CONCURRENT_TO]
+        headers = [(WarcRecord.TYPE, WarcRecord.REVISIT),
+                   (WarcRecord.ID, oldrecord.random_warc_uuid())]
+        headers += [(k, v) for (k, v) in oldrecord.headers if k in keep]
+        headers += [(WarcRecord.PROFILE,
+                     WarcRecord.PROFILE_IDENTICAL_PAYLOAD_DIGEST),
+                    (WarcRecord.REFERS_TO, first[0]),
+                    (WarcRecord.REFERS_TO_TARGET_URI, first[1]),
+                    (WarcRecord.REFERS_TO_DATE, first[2]),
+                    (WarcRecord.PAYLOAD_DIGEST, digest),
+                    ('WARC-Truncated', 'length')]
+        return headers
+
     def _remove_open_files(self):
         """Clean up open files, if they exist"""
         try:
@@ -333,12 +681,40 @@ class WARCTikaProcessor(object):
         except KeyError:
             return
 
+class TikaProvenance(object):
+    """What WARCTikaProcessor has already done to a WARC file being read,
+    so that its work need not be repeated.
+
+    Conversion records, from WARCTikaProcessor or elsewhere, are noted by
+    the record they refer to, so that the original need not be converted
+    again. Originals which Tika failed on, or produced too little text
+    from, carry TIKA_FAILED_HEADER and are noted by ID in failed. Any
+    other original left in a processed file may only have been kept
+    because Tika was unavailable (and files from before the header was
+    added don't carry it), so it is converted as usual."""
+    def __init__(self):
+        self.converted = set()
+        self.failed = set()
+
+    def add_conversion(self, refersto):
+        """Note a conversion record of the record with ID refersto."""
+        if refersto:
+            self.converted.add(refersto)
+
+    def already_failed(self, record):
+        """True if record is an original WARCTikaProcessor has tried and
+        failed to convert, noting it in failed if so."""
+        if record.get_header(TIKA_FAILED_HEADER) is None:
+            return False
+        self.failed.add(record.id)
+        return True
+
 class WARCNonTikaProcessor(WARCTikaProcessor):
     """A dummy class for testing WARC throughput, which does everything
     WARCTikaProcessor does except the actual Tikaisation"""
     def add_description_to_warcinfo(self, record):
         pass
-    def generate_new_record(self, inrecord):
+    def generate_new_record(self, inrecord, prepared=None):
         return inrecord
     def tikaise(self, content, mimetype):
         raise NotImplementedError
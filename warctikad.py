@@ -26,28 +26,161 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>
 import sys
 import os
 from warctika import *
+from tikaclient import TikaClient
+from tikafleet import TikaFleet, tika_command, stub_command
+from warcpool import parse_size
+from warcdedup import DigestIndex
+from tikaskip import SkipLearner
+from warcmonitor import RecordMonitor
+from multiprocessing.pool import ThreadPool
+import argparse
+import threading
+import signal
 import re
 import time
 
-if len(sys.argv) < 2:
-    print "Must give name of WARC directory to watch"
-    sys.exit(1)
+parser = argparse.ArgumentParser(description='Watch a directory for WARC '
+    'files, reduce them through Tika to -ViaTika WARC files and delete the '
+    'originals.')
+parser.add_argument('dirname', help='WARC directory to watch.')
+parser.add_argument('--tika-url', default='http://localhost:9998/tika',
+                    help='Tika server to use, unless --fleet is given. '
+                         'Default: http://localhost:9998/tika.')
+parser.add_argument('-j', '--threads', type=int, default=None,
+                    help='Number of files to process at once. Default: '
+                         'the --fleet size, or 1.')
+parser.add_argument('--dedup', action='store_true',
+                    help='Write response records not converted by Tika '
+                         'whose payload digest has been seen before as '
+                         'revisit records referring to the first capture.')
+parser.add_argument('--dedup-db', metavar='dbfn',
+                    help='With --dedup, keep the digests seen in this '
+                         'SQLite database, to deduplicate against earlier '
+                         'runs and other processes.')
+parser.add_argument('--skip-table', metavar='tablefn',
+                    help='Learn which hosts\' documents of each type Tika '
+                         'fails on, and stop sending most of them, keeping '
+                         'the table in this file. It may be shared with '
+                         'other processes: each merges its results in.')
+parser.add_argument('--normalise', action='store_true',
+                    help='Normalise the text of conversion records '
+                         '(collapsing whitespace, dropping control '
+                         'characters and repeated page headers and '
+                         'footers), reporting the saving per MIME type.')
+parser.add_argument('--slow-log', metavar='logfn',
+                    help='Log records taking longer than --slow-threshold, '
+                         'with the time spent in each stage, to this file.')
+parser.add_argument('--slow-threshold', type=float, default=5.0,
+                    help='Seconds a record must take to be logged as slow. '
+                         'Default: 5.')
+parser.add_argument('--profile-dir', metavar='dir',
+                    help='Profile each file with cProfile, writing the '
+                         'stats to this directory.')
+parser.add_argument('--mem-every', type=int, default=0, metavar='N',
+                    help='Log memory use (top allocation sites if '
+                         'tracemalloc is available, otherwise RSS) every N '
+                         'records processed by each thread.')
+parser.add_argument('--dump-on-usr1', action='store_true',
+                    help='On SIGUSR1, write the record each thread is '
+                         'processing and their stacks to stderr.')
+fleetargs = parser.add_argument_group('local Tika fleet')
+fleetargs.add_argument('--fleet', type=int, default=0, metavar='N',
+                       help='Launch and supervise up to N local Tika '
+                            'servers, scaled with the number of files '
+                            'waiting, instead of using --tika-url.')
+fleetargs.add_argument('--min-servers', type=int, default=1,
+                       help='Servers to keep running when idle. Default: 1.')
+fleetargs.add_argument('--tika-jar', metavar='jar',
+                       help='Tika server jar to run.')
+fleetargs.add_argument('--stub', action='store_true',
+                       help='Run tikastub.py servers instead of Tika, for '
+                            'testing.')
+fleetargs.add_argument('--base-port', type=int, default=9998,
+                       help='Port of the first server. Default: 9998.')
+fleetargs.add_argument('--max-rss', default=None,
+                       help='Recycle a server once its RSS exceeds this '
+                            'size (e.g. 2G).')
+fleetargs.add_argument('--max-docs', type=int, default=None,
+                       help='Recycle a server after this many documents.')
+args = parser.parse_args()
 
-dirname = sys.argv[1]
+dirname = args.dirname
+
+fleet = None
+if args.fleet:
+    if args.stub:
+        command = stub_command()
+    elif args.tika_jar:
+        command = tika_command(args.tika_jar)
+    else:
+        sys.exit("--fleet needs --tika-jar or --stub")
+    fleet = TikaFleet(command, args.base_port, args.min_servers, args.fleet,
+                      maxrss=parse_size(args.max_rss),
+                      maxdocs=args.max_docs)
+    fleet.start()
+threads = args.threads or args.fleet or 1
+
+# One digest index and skip learner, shared by all the threads
+dedup = None
+if args.dedup:
+    dedup = DigestIndex(args.dedup_db)
+skiplearner = None
+if args.skip_table:
+    skiplearner = SkipLearner(args.skip_table)
+
+monitoring = (args.slow_log or args.profile_dir or args.mem_every or
+              args.dump_on_usr1)
+def make_monitor(dumpsignal=None):
+    return RecordMonitor(args.slow_log, args.slow_threshold,
+                         args.profile_dir, args.mem_every, dumpsignal)
+
+# The signal handler can only be installed from the main thread; it
+# describes the records of all the threads' monitors
+if args.dump_on_usr1:
+    make_monitor(signal.SIGUSR1)
+
+# WARCTikaProcessors and RecordMonitors keep per-file state, so each thread
+# has its own
+local = threading.local()
+def get_processor():
+    if not hasattr(local, 'processor'):
+        if fleet is not None:
+            client = TikaClient(fleet=fleet)
+        else:
+            client = TikaClient(args.tika_url)
+        monitor = make_monitor() if monitoring else None
+        local.processor = WARCTikaProcessor(tikaclient=client, dedup=dedup,
+                                            skiplearner=skiplearner,
+                                            normalise=args.normalise,
+                                            monitor=monitor)
+    return local.processor
 
-warcprocessor = WARCTikaProcessor()
 oldsuffix = '.warc.gz'
 newsuffix = '-ViaTika.warc.gz'
 
-while True:
-    for fn in os.listdir(dirname):
-        if fn.endswith(oldsuffix) and not fn.endswith(newsuffix):
-            infn = dirname+"/"+fn
-            outfn = re.sub(oldsuffix+'$', newsuffix, infn)
-            if os.path.exists(outfn):
-                print "File", infn, "has already been processed. Skipping."
-            else:
-                warcprocessor.process(infn=infn, outfn=outfn, delete=True)
-                print "Done."
-    time.sleep(15)
+def process(infn):
+    outfn = re.sub(oldsuffix+'$', newsuffix, infn)
+    if os.path.exists(outfn):
+        print "File", infn, "has already been processed. Skipping."
+    else:
+        get_processor().process(infn=infn, outfn=outfn, delete=True)
+        print "Done."
 
+pool = ThreadPool(threads)
+try:
+    while True:
+        pending = [dirname+"/"+fn for fn in os.listdir(dirname)
+                   if fn.endswith(oldsuffix) and not fn.endswith(newsuffix)]
+        if fleet is not None:
+            fleet.set_demand(min(len(pending), threads))
+        if pending:
+            result = pool.map_async(process, pending, 1)
+            # Waiting with a timeout, unlike map(), lets the main thread
+            # run signal handlers while the files are processed
+            while not result.ready():
+                result.wait(1)
+            result.get()
+        time.sleep(15)
+finally:
+    if fleet is not None:
+        fleet.stop()
@@ -5,6 +5,13 @@ Unpacks a warc file (optionally gzipped) into a series of uncompressed
 warc files, one per each record in the original.
 The aim of this process is to obtain an easily diff-able set of files.
 
+Files are written into a directory tree sharded by a hash of their names,
+so that no one directory gets millions of entries. Names are derived from
+the WARC-Record-ID (or, failing that, the payload digest), so they cannot
+collide. A record whose WARC-Payload-Digest has already been seen is not
+written again: its file is a hard link to the first record with that
+payload. A JSON manifest maps each file to the record(s) it stands for.
+
 This work is available under the terms of the GNU General Purpose Licence
 This program is free software: you can redistribute it and/or modify
 it under the terms of the GNU General Public License as published by
@@ -28,30 +35,211 @@ from __future__ import print_function
 
 import sys
 import os
-import warctika
 import re
-import string
+import errno
+import hashlib
+import json
+import argparse
+import threading
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+from hanzo.warctools import WarcRecord
+from warcreader import (iter_lazy_records, is_plain_warc, MmapRecord,
+                        MmapRecordStream)
+
+_unsafe_re = re.compile(r'[^A-Za-z0-9._-]')
 
 def warning(*objs):
     print("WARNING: ", *objs, file=sys.stderr)
 
-def sanitise_url(s):
-    return s.translate(string.maketrans('/*#', '___'))[:200]
-
-if len(sys.argv) < 2:
-    sys.exit("Must give name of file to unpack.")
-
-wf = warctika.WARCFile(sys.argv[1], 'rb')
-for record in wf:
-    if (record.type == 'metadata' or
-        record.type == 'request' or
-        record.type == 'warcinfo'):
-        continue
-    outwn = sanitise_url(record.url)+'.warc'
-    outwarc = warctika.WARCFile(outwn, 'wb')
-    outwarc.write_record(
-			warctika.WARCRecord(header=record.header,
-            payload=record.payload,
-            defaults=False))
-    outwarc.close()
-wf.close()
+#####
+#UTILITY FUNCTIONS
+#####
+def record_name(record):
+    """Return a collision-free, filesystem-safe base name for a record,
+    from its WARC-Record-ID (or payload digest if it has no ID)."""
+    name = record.get_header(WarcRecord.ID)
+    if name:
+        # <urn:uuid:...> -> the uuid
+        name = name.strip('<>').rsplit(':', 1)[-1]
+    else:
+        name = record.get_header(WarcRecord.PAYLOAD_DIGEST)
+        if not name:
+            raise ValueError("Record for "+str(record.url)+" has neither a "
+                             "record ID nor a payload digest")
+    return _unsafe_re.sub('_', name)
+
+def shard_path(name, depth=2):
+    """Return the relative path at which to store a file called name,
+    under depth levels of two-hex-digit directories taken from the SHA-1
+    of the name."""
+    h = hashlib.sha1(name).hexdigest()
+    return os.path.join(*([h[2*i:2*i+2] for i in range(depth)] +
+                          [name + '.warc']))
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        # Another thread may have got there first
+        if e.errno != errno.EEXIST:
+            raise
+
+def _write_file(path, data):
+    _makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def _link_file(src, first, path):
+    """Hard link path to src, once the AsyncResult first (which writes
+    src) has completed."""
+    first.wait()
+    _makedirs(os.path.dirname(path))
+    try:
+        os.link(src, path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        os.unlink(path)
+        os.link(src, path)
+
+class _ManifestWriter(object):
+    """Writes a JSON list of manifest entries one at a time, so that the
+    whole manifest never has to be held in memory."""
+    def __init__(self, f):
+        self._f = f
+        self._first = True
+        f.write('[\n')
+
+    def write(self, entry):
+        if not self._first:
+            self._f.write(',\n')
+        self._first = False
+        json.dump(entry, self._f, sort_keys=True)
+
+    def close(self):
+        self._f.write('\n]\n')
+        self._f.close()
+
+def unpack(infn, outdir, manifest, threads=8, depth=2, dedup=True):
+    """Unpack the records of infn (other than metadata, request and
+    warcinfo records) into single-record WARC files under outdir, writing
+    an entry for each to manifest (a _ManifestWriter). Files are written
+    by a pool of threads while the main thread reads the input.
+
+    Returns (written, linked, errors): the numbers of files written and
+    of duplicate payloads hard linked, and a list of (path, exception)
+    for files which could not be written (or (URL, exception) for records
+    which could not be named, and were skipped)."""
+    pool = ThreadPool(threads)
+    # Bound the number of records read ahead of the writer threads
+    slots = threading.BoundedSemaphore(threads * 4)
+    errors = []
+    def run(path, func, *args):
+        try:
+            func(*args)
+        except Exception as e:
+            errors.append((path, e))
+        finally:
+            slots.release()
+    # Payload digest -> (relative path, AsyncResult) of its first record
+    firsts = {}
+    written = linked = 0
+    if is_plain_warc(infn):
+        # Memory-map uncompressed input, and write records straight from
+        # the mapping
+        inwf = MmapRecordStream(infn)
+        records = iter(inwf)
+    else:
+        inwf = WarcRecord.open_archive(infn, mode='rb', gzip='auto')
+        records = iter_lazy_records(inwf)
+    for record in records:
+        if (record.type == WarcRecord.METADATA or
+            record.type == WarcRecord.REQUEST or
+            record.type == WarcRecord.WARCINFO):
+            continue
+        try:
+            name = record_name(record)
+        except ValueError as e:
+            # Can't be stored without a name; report it with the others
+            errors.append((record.url, e))
+            continue
+        relpath = shard_path(name, depth)
+        path = os.path.join(outdir, relpath)
+        digest = record.get_header(WarcRecord.PAYLOAD_DIGEST)
+        entry = {'path': relpath, 'url': record.url, 'type': record.type,
+                 'record_id': record.get_header(WarcRecord.ID),
+                 'payload_digest': digest, 'duplicate_of': None}
+        slots.acquire()
+        if dedup and digest in firsts:
+            firstpath, first = firsts[digest]
+            entry['duplicate_of'] = firstpath
+            src = os.path.join(outdir, firstpath)
+            pool.apply_async(run, (path, _link_file, src, first, path))
+            linked += 1
+        else:
+            if isinstance(record, MmapRecord):
+                data = record.view
+            else:
+                buf = StringIO()
+                record.write_to(buf, gzip=False)
+                data = buf.getvalue()
+            result = pool.apply_async(run, (path, _write_file, path, data))
+            if dedup and digest:
+                firsts[digest] = (relpath, result)
+            written += 1
+        manifest.write(entry)
+    pool.close()
+    pool.join()
+    # Only now: pending writes may be views into a memory-mapped inwf
+    inwf.close()
+    return written, linked, errors
+
+#####
+#ARGUMENT PARSER
+#####
+
+parser = argparse.ArgumentParser(description='Unpack a WARC file into a '
+    'hash-sharded directory tree of single-record WARC files, with a JSON '
+    'manifest mapping files to URLs. Metadata, request and warcinfo records '
+    'are skipped.')
+parser.add_argument('infn', help='Input WARC filename (optionally gzipped).')
+parser.add_argument('-o', '--output-dir', metavar='outdir', default='.',
+                    help='Directory to unpack into. Default: current '
+                         'directory.')
+parser.add_argument('-m', '--manifest', metavar='manifestfn',
+                    help='Manifest filename. Default: manifest.json in the '
+                         'output directory.')
+parser.add_argument('-j', '--threads', type=int, default=8,
+                    help='Number of file-writing threads. Default: 8.')
+parser.add_argument('-d', '--shard-depth', type=int, default=2,
+                    help='Levels of directory sharding (each 256-way). '
+                         'Default: 2.')
+parser.add_argument('--no-dedup', action='store_true',
+                    help='Write every record out in full, rather than hard '
+                         'linking records with the same WARC-Payload-Digest '
+                         'to the first one written.')
+
+#####
+#MAIN
+#####
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    manifestfn = args.manifest
+    if manifestfn is None:
+        manifestfn = os.path.join(args.output_dir, 'manifest.json')
+    _makedirs(args.output_dir)
+    manifest = _ManifestWriter(open(manifestfn, 'w'))
+    try:
+        written, linked, errors = unpack(args.infn, args.output_dir, manifest,
+                                         args.threads, args.shard_depth,
+                                         not args.no_dedup)
+    finally:
+        manifest.close()
+    for path, e in errors:
+        warning("Failed to write", path, ":", e)
+    print("Wrote %d files and %d hard links to duplicate payloads from %s."
+          % (written, linked, args.infn), file=sys.stderr)
+    if errors:
+        sys.exit(1)
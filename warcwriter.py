@@ -0,0 +1,143 @@
+#!/usr/bin/env python2
+"""Writing WARC records with a choice of compression: none, gzip (one
+member per record, as hanzo's write_to(gzip=True)) or Zstandard (one frame
+per record, as .warc.zst).
+
+Zstandard decompresses several times faster than gzip and, with a
+dictionary trained on records like those being written, compresses small
+records much better. It is meant for our own intermediate files; archive
+deliverables should stay .warc.gz. Following the .warc.zst convention, a
+dictionary used to write a file is stored in a skippable frame at its
+start, so that warcreader.open_archive() can read the file back without
+being told about it.
+
+Run as a script to train a dictionary from sample WARC files.
+
+Copyright 2014-2016 Tom Nicholls
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+
+#####
+#SETUP
+#####
+
+import sys
+import struct
+import argparse
+from cStringIO import StringIO
+try:
+    import zstandard
+except ImportError:
+    # Only needed for .warc.zst files
+    zstandard = None
+
+ZSTD_MAGIC = '\x28\xb5\x2f\xfd'
+# Skippable frame holding the dictionary, as used by .warc.zst
+DICT_MAGIC = '\x5d\x2a\x4d\x18'
+
+#####
+#UTILITY FUNCTIONS
+#####
+def require_zstandard():
+    if zstandard is None:
+        raise ImportError("The zstandard module is needed for .warc.zst "
+                          "files: pip install zstandard")
+
+def compression_for(filename):
+    """Return the compression implied by a WARC filename's extension:
+    'zstd', 'gzip' or None."""
+    if filename.endswith('.zst'):
+        return 'zstd'
+    if filename.endswith('.gz'):
+        return 'gzip'
+    return None
+
+def train_dictionary(records, size=112640, samplesize=16384):
+    """Train a Zstandard dictionary from an iterable of records, each of
+    which contributes its first samplesize bytes as written. Returns the
+    dictionary as a string."""
+    require_zstandard()
+    samples = []
+    for record in records:
+        buf = StringIO()
+        record.write_to(buf)
+        samples.append(buf.getvalue()[:samplesize])
+    return zstandard.train_dictionary(size, samples).as_bytes()
+
+#####
+#CLASSES
+#####
+
+class RecordWriter(object):
+    """Writes records to a file handle, compressed record by record.
+
+       :compression: None, 'gzip' or 'zstd' (see compression_for())
+       :dictionary: for zstd, optional dictionary data (a string, as from
+                    train_dictionary()), written to the start of the file
+       :level: zstd compression level"""
+    def __init__(self, fh, compression=None, dictionary=None, level=3):
+        self._fh = fh
+        self.compression = compression
+        if compression == 'zstd':
+            require_zstandard()
+            kw = {}
+            if dictionary:
+                fh.write(DICT_MAGIC + struct.pack('<I', len(dictionary)) +
+                         dictionary)
+                kw['dict_data'] = zstandard.ZstdCompressionDict(dictionary)
+            self._writer = zstandard.ZstdCompressor(
+                level=level, **kw).stream_writer(fh)
+        elif compression not in (None, 'gzip'):
+            raise ValueError("Unknown compression: "+str(compression))
+
+    def write(self, record):
+        """Write one record (a hanzo record, LazyRecord or MmapRecord)."""
+        if self.compression == 'zstd':
+            record.write_to(self._writer)
+            self._writer.flush(zstandard.FLUSH_FRAME)
+        else:
+            record.write_to(self._fh, gzip=self.compression == 'gzip')
+
+#####
+#MAIN
+#####
+
+if __name__ == '__main__':
+    from itertools import islice
+    from hanzo.warctools import WarcRecord
+    from warcreader import open_archive
+    parser = argparse.ArgumentParser(description='Train a Zstandard '
+        'dictionary for writing .warc.zst files from sample WARC files.')
+    parser.add_argument('outfn', help='Dictionary filename to write.')
+    parser.add_argument('infns', nargs='+', help='Sample WARC files.')
+    parser.add_argument('-s', '--size', type=int, default=112640,
+                        help='Dictionary size in bytes. Default: 112640.')
+    parser.add_argument('-n', '--max-records', type=int, default=10000,
+                        help='Maximum records to sample from each file. '
+                             'Default: 10000.')
+    args = parser.parse_args()
+
+    def sample():
+        for infn in args.infns:
+            inwf = open_archive(infn)
+            for record in islice(inwf, args.max_records):
+                yield WarcRecord(headers=record.headers,
+                                 content=record.content)
+            inwf.close()
+    dictionary = train_dictionary(sample(), args.size)
+    with open(args.outfn, 'wb') as f:
+        f.write(dictionary)
+    sys.stderr.write("Wrote "+str(len(dictionary))+" byte dictionary to "+
+                     args.outfn+"\n")